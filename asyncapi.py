@@ -0,0 +1,319 @@
+import asyncio, os, json, logging, math, time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
+from datetime import datetime
+import httpx
+from starlette.applications import Starlette
+from starlette.responses import JSONResponse, StreamingResponse, PlainTextResponse
+from starlette.routing import Route
+import exchangeapi
+from exchangeapi import validate_conversion, MAX_TRANSACTIONS_PAGE_SIZE
+from conversion import convert_amount
+from providers import RateProviderError
+from ratelimit import RequestShed
+from metrics import REGISTRY, UPSTREAM_DURATION, UPSTREAM_ERRORS, SHED_REQUESTS
+
+# asyncio serving path (run it with an ASGI server, e.g.
+# "uvicorn asyncapi:app"): the upstream calls share a pool of keep-alive
+# connections and never block a worker, and the database calls run on a
+# dedicated thread pool
+
+logger = logging.getLogger(__name__)
+
+class AsyncRateClient:
+    def __init__(self, max_connections=100, max_concurrency=100):
+        self.max_connections = max_connections
+        self.client = None
+        # bounds how many upstream calls are in flight at once
+        self._semaphore = asyncio.Semaphore(max_concurrency)
+        self._inflight = {}
+        self._revalidations = set()
+        # hedged provider calls still running after another one answered
+        self._slow_calls = set()
+
+    async def start(self):
+        # each call has the timeout of its provider
+        self.client = httpx.AsyncClient(limits=httpx.Limits(max_connections=self.max_connections,
+                                                            max_keepalive_connections=self.max_connections))
+
+    async def close(self):
+        if self.client is not None:
+            await self.client.aclose()
+            self.client = None
+
+    async def fetch_rates(self, base_currency):
+        # the hedged calls of the synchronous path (HedgedRateSource.fetch),
+        # natively: the providers (and their circuit breakers) in priority
+        # order, the next one is called when the previous fails or has not
+        # answered after 'hedge_delay' seconds, and the first answer wins
+        source = exchangeapi.rate_source
+        candidates = iter(source.providers)
+        pending = set()
+        errors = []
+
+        def call_next():
+            # allow() takes the trial call of a half-open breaker, so it is
+            # asked only of the provider about to be called
+            for provider in candidates:
+                if provider.breaker.allow():
+                    pending.add(asyncio.ensure_future(self._call(provider, base_currency)))
+                    return True
+            return False
+
+        if not call_next():
+            raise RateProviderError("failure getting exchange rate on the external API. Every provider is unavailable (circuit open)")
+
+        try:
+            while pending:
+                done, _ = await asyncio.wait(pending, timeout=source.hedge_delay, return_when=asyncio.FIRST_COMPLETED)
+                if not done:
+                    # hedge: the providers called so far are slow
+                    if call_next():
+                        source.hedges += 1
+                    continue
+
+                for task in done:
+                    pending.discard(task)
+                    if task.exception() is None:
+                        return task.result()
+                    errors.append(task.exception())
+                    call_next()
+        finally:
+            # the slower calls are left to finish (still feeding their
+            # breakers)
+            for task in pending:
+                self._slow_calls.add(task)
+                task.add_done_callback(self._slow_calls.discard)
+
+        raise errors[0]
+
+    async def _call(self, provider, base_currency):
+        try:
+            rates = await self._fetch_from(provider, base_currency)
+        except Exception as e:
+            provider.breaker.record_failure()
+            logger.warning(f'failure getting rates from {provider.name}: {e}')
+            raise
+        provider.breaker.record_success()
+        return rates
+
+    async def _fetch_from(self, provider, base_currency):
+        async with self._semaphore:
+            started = time.perf_counter()
+            try:
+                response = await self.client.get(provider.url(base_currency), timeout=provider.timeout)
+            except httpx.TimeoutException:
+                UPSTREAM_ERRORS.inc(provider=provider.name, status_code='timeout')
+                raise RateProviderError(f"failure getting exchange rate on the external API. Timeout after {provider.timeout}s")
+            except httpx.HTTPError as e:
+                UPSTREAM_ERRORS.inc(provider=provider.name, status_code='connection_error')
+                raise RateProviderError(f"failure getting exchange rate on the external API. Error: {e}")
+            finally:
+                UPSTREAM_DURATION.observe(time.perf_counter() - started, provider=provider.name)
+
+        return provider.parse(response)
+
+    async def get_rate_table(self, base_currency):
+        # same cache as the synchronous path, only the misses differ
+        table, revalidate = exchangeapi.rate_cache.get_cached(base_currency)
+        if table is None:
+            return await self.refresh(base_currency)
+
+        if revalidate and base_currency not in self._inflight:
+            task = asyncio.create_task(self._revalidate(base_currency))
+            self._revalidations.add(task)
+            task.add_done_callback(self._revalidations.discard)
+        return table
+
+    async def refresh(self, base_currency):
+        # single-flight: concurrent misses await the same upstream call
+        future = self._inflight.get(base_currency)
+        if future is None:
+            future = asyncio.ensure_future(self._fetch_and_store(base_currency))
+            self._inflight[base_currency] = future
+            future.add_done_callback(lambda _: self._inflight.pop(base_currency, None))
+
+        return await asyncio.shield(future)
+
+    async def get_exchange_rate(self, source_currency, target_currency):
+        base_currency = exchangeapi.settings.get('RATE_BASE_CURRENCY', 'EUR')
+
+        rate_table = await self.get_rate_table(base_currency)
+
+        return rate_table.cross_rates().rate(source_currency, target_currency)
+
+    async def _fetch_and_store(self, base_currency):
+        try:
+            rates = await self.fetch_rates(base_currency)
+        except Exception:
+            exchangeapi.rate_cache.store_failure(base_currency)
+            raise
+        # storing also records the table in the rates history (a database
+        # insert), so it runs off the event loop
+        return await run_db(exchangeapi.rate_cache.store, base_currency, rates)
+
+    async def _revalidate(self, base_currency):
+        try:
+            await self.refresh(base_currency)
+        except Exception as e:
+            logger.warning(f'failure refreshing {base_currency} rates, serving stale table: {e}')
+
+rate_client = None
+db_executor = ThreadPoolExecutor(max_workers=int(os.environ.get('ASYNC_DB_THREADS', 4)),
+                                 thread_name_prefix='async-db')
+
+async def run_db(function, *args, **kwargs):
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(db_executor, lambda: function(*args, **kwargs))
+
+def error_response(message, status_code=400):
+    return JSONResponse({ 'message': message }, status_code=status_code)
+
+async def convert(request):
+    try:
+        data = await request.json()
+    except ValueError:
+        data = None
+
+    if not isinstance(data, dict):
+        return error_response('Invalid conversion. expected a json object')
+
+    # a retry would convert (and persist) again, so the key is refused
+    # instead of ignored
+    if 'Idempotency-Key' in request.headers:
+        return error_response('Invalid Idempotency-Key. it is only supported by the wsgi app, not by the asyncio path')
+
+    user_id = data.get('user_id')
+    source_currency = data.get('source_currency')
+    target_currency = data.get('target_currency')
+    amount = data.get('amount')
+
+    error = validate_conversion(user_id, amount, source_currency, target_currency)
+    if error is not None:
+        return error_response(error)
+
+    # the same per user rate limit as the WSGI app (the concurrency here is
+    # bounded by the upstream semaphore instead of the admission control)
+    if exchangeapi.rate_limiter is not None:
+        try:
+            await run_db(exchangeapi.rate_limiter.check, user_id)
+        except RequestShed as e:
+            SHED_REQUESTS.inc(reason=e.reason)
+            return JSONResponse({ 'message': f'{e}' }, status_code=429,
+                                headers={ 'Retry-After': str(math.ceil(e.retry_after)) })
+
+    try:
+        exchange_rate = await rate_client.get_exchange_rate(source_currency, target_currency)
+    except RateProviderError as e:
+        return error_response(f'{e}', status_code=502)
+    except Exception as e:
+        return error_response(f'{e}')
+
+    converted_amount = convert_amount(amount, exchange_rate, source_currency, target_currency)
+
+    timestamp = datetime.now().strftime("%Y-%m-%dT%H:%M:%SZ")
+
+    transaction = (user_id, source_currency, amount, target_currency, converted_amount, exchange_rate, timestamp)
+    if exchangeapi.transaction_writer is not None:
+        # a journal write (and maybe an fsync, or a block of ids reserved in
+        # the database), so also off the event loop
+        transaction_id = await run_db(exchangeapi.transaction_writer.submit, *transaction)
+    else:
+        transaction_id = await run_db(exchangeapi.dbh.insert_transaction, *transaction)
+
+    return JSONResponse({
+        'transaction_id': transaction_id,
+        'user_id': user_id,
+        'source_currency': source_currency,
+        'amount': amount,
+        'target_currency': target_currency,
+        'converted_amount': converted_amount,
+        'exchange_rate': exchange_rate,
+        'timestamp': timestamp
+    })
+
+def get_int_param(request, name, minimum):
+    value = request.query_params.get(name)
+    if value is None:
+        return None
+
+    try:
+        value = int(value)
+    except ValueError:
+        value = None
+
+    if value is None or value < minimum:
+        raise ValueError(f'Invalid {name}. {name} must be an integer greater than or equal to {minimum}')
+
+    return value
+
+async def user_transactions(request):
+    user_id = request.path_params['user_id']
+
+    try:
+        limit = get_int_param(request, 'limit', 1)
+        after = get_int_param(request, 'after', 0)
+    except ValueError as e:
+        return error_response(f'{e}')
+
+    stream = request.query_params.get('stream')
+    if stream is not None:
+        if stream == 'ndjson':
+            lines = (json.dumps(t) + '\n' async for t in iter_user_transactions(user_id, after))
+            return StreamingResponse(lines, media_type='application/x-ndjson')
+        if stream == 'json':
+            return StreamingResponse(stream_json_list(iter_user_transactions(user_id, after)),
+                                     media_type='application/json')
+        return error_response('Invalid stream. stream must be "json" or "ndjson"')
+
+    if limit is None and after is None:
+        return JSONResponse(await run_db(exchangeapi.dbh.get_user_transactions, user_id))
+
+    limit = min(limit or MAX_TRANSACTIONS_PAGE_SIZE, MAX_TRANSACTIONS_PAGE_SIZE)
+    transactions = await run_db(exchangeapi.dbh.get_user_transactions, user_id, limit=limit, after=after)
+
+    headers = {}
+    if len(transactions) == limit:
+        headers['X-Next-After'] = str(transactions[-1]['transaction_id'])
+    return JSONResponse(transactions, headers=headers)
+
+async def iter_user_transactions(user_id, after, page_size=500):
+    # every page is a keyset query run on the database thread pool
+    while True:
+        transactions = await run_db(exchangeapi.dbh.get_user_transactions, user_id, limit=page_size, after=after)
+        for t in transactions:
+            yield t
+        if len(transactions) < page_size:
+            break
+        after = transactions[-1]['transaction_id']
+
+async def stream_json_list(items):
+    yield '['
+    first = True
+    async for item in items:
+        yield ('' if first else ',') + json.dumps(item)
+        first = False
+    yield ']'
+
+async def metrics(request):
+    return PlainTextResponse(REGISTRY.render(), media_type='text/plain; version=0.0.4')
+
+@asynccontextmanager
+async def lifespan(app):
+    # the app components are shared with the WSGI app (see
+    # exchangeapi.start), the client is bound to the event loop of the server
+    exchangeapi.start()
+    global rate_client
+    rate_client = AsyncRateClient(max_connections=int(exchangeapi.settings.get('UPSTREAM_MAX_CONNECTIONS', 100)),
+                                  max_concurrency=int(exchangeapi.settings.get('UPSTREAM_MAX_CONCURRENCY', 100)))
+    await rate_client.start()
+    try:
+        yield
+    finally:
+        await rate_client.close()
+
+app = Starlette(routes=[
+    Route('/convert', convert, methods=['POST']),
+    Route('/transactions/{user_id:int}', user_transactions, methods=['GET']),
+    Route('/metrics', metrics, methods=['GET'])
+], lifespan=lifespan)
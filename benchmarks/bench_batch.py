@@ -0,0 +1,59 @@
+import os, sys, tempfile, time, random
+
+# compares N single POST /convert calls against one POST /convert/batch
+#
+# usage: python benchmarks/bench_batch.py [N]
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import database
+
+database_file = os.path.join(tempfile.mkdtemp(), 'bench_batch.db')
+database.DATABASE_FILE = database_file
+
+from exchangeapi import app, rate_cache
+from tools.stub_rate_server import StubRateServer
+
+CURRENCIES = ['USD', 'BRL', 'GBP', 'JPY', 'CHF']
+
+def make_conversions(n):
+    return [{
+        'user_id': random.choice([1, 2]),
+        'source_currency': 'EUR',
+        'target_currency': random.choice(CURRENCIES),
+        'amount': round(random.uniform(1, 1000), 2)
+    } for _ in range(n)]
+
+def main():
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 1000
+
+    server = StubRateServer().start()
+    os.environ['EXCHANGE_API_URL'] = server.url
+    os.environ.setdefault('ACCESS_KEY', 'bench')
+
+    client = app.test_client()
+    conversions = make_conversions(n)
+
+    try:
+        rate_cache.clear()
+        started = time.perf_counter()
+        for conversion in conversions:
+            response = client.post('/convert', json=conversion)
+            assert response.status_code == 200, response.get_json()
+        single_elapsed = time.perf_counter() - started
+
+        rate_cache.clear()
+        started = time.perf_counter()
+        response = client.post('/convert/batch', json=conversions)
+        assert response.status_code == 200, response.get_json()
+        batch_elapsed = time.perf_counter() - started
+    finally:
+        server.stop()
+        os.remove(database_file)
+
+    print(f'{n} single calls: {single_elapsed:.3f}s ({n / single_elapsed:.0f} conversions/s)')
+    print(f'1 batch call:    {batch_elapsed:.3f}s ({n / batch_elapsed:.0f} conversions/s)')
+    print(f'speedup:         {single_elapsed / batch_elapsed:.1f}x')
+
+if __name__ == '__main__':
+    main()
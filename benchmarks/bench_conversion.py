@@ -0,0 +1,42 @@
+import os, sys, time, random
+from array import array
+from decimal import Decimal, ROUND_HALF_EVEN
+
+# cost per conversion of the float path (amount * rate), of Python Decimal,
+# and of the fixed-point conversion, one call per amount and in batch
+#
+# usage: python benchmarks/bench_conversion.py [CONVERSIONS]
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from conversion import to_minor_units, convert_amount, convert_many
+
+def measure(name, conversions, run):
+    started = time.perf_counter()
+    run()
+    elapsed = time.perf_counter() - started
+    print(f'{name:<26}{elapsed:.3f}s ({elapsed / conversions * 1e9:.0f} ns per conversion)')
+
+def main():
+    conversions = int(sys.argv[1]) if len(sys.argv) > 1 else 1000000
+
+    amounts = [random.randint(1, 10 ** 7) / 100 for _ in range(conversions)]
+    rate = 5.244123 / 1.104252
+    cent = Decimal('0.01')
+
+    print(f'{conversions} USD -> BRL conversions')
+    measure('float', conversions, lambda: [amount * rate for amount in amounts])
+
+    decimal_rate = Decimal(repr(rate))
+    measure('Decimal', conversions,
+            lambda: [(Decimal(repr(amount)) * decimal_rate).quantize(cent, ROUND_HALF_EVEN) for amount in amounts])
+
+    measure('convert_amount', conversions,
+            lambda: [convert_amount(amount, rate, 'USD', 'BRL') for amount in amounts])
+
+    minor_amounts = array('q', (to_minor_units(amount, 'USD') for amount in amounts))
+    measure('convert_many (minor units)', conversions,
+            lambda: convert_many(minor_amounts, rate, 'USD', 'BRL'))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,64 @@
+import os, sys, tempfile, time, threading, sqlite3
+
+# insert throughput of DatabaseHandler (persistent WAL connections) against
+# the former connect/insert/commit/close per call, with many writer threads
+#
+# usage: python benchmarks/bench_database.py [WRITERS] [INSERTS_PER_WRITER]
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from database import DatabaseHandler, INSERT_TRANSACTION_SQL
+
+ROW = ('EUR', 100, 'USD', 110.4252, 1.104252, '2023-07-22T09:15:00Z')
+
+def connect_per_call_insert(database_file, user_id):
+    conn = sqlite3.connect(database_file)
+    cursor = conn.cursor()
+    cursor.execute(INSERT_TRANSACTION_SQL, (user_id,) + ROW)
+    conn.commit()
+    conn.close()
+
+def run(insert, writers, inserts_per_writer):
+    errors = []
+
+    def writer(user_id):
+        for _ in range(inserts_per_writer):
+            try:
+                insert(user_id)
+            except sqlite3.OperationalError as e:
+                errors.append(e)
+
+    threads = [threading.Thread(target=writer, args=(user_id,)) for user_id in range(writers)]
+    started = time.perf_counter()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    elapsed = time.perf_counter() - started
+
+    return writers * inserts_per_writer / elapsed, len(errors)
+
+def main():
+    writers = int(sys.argv[1]) if len(sys.argv) > 1 else 16
+    inserts_per_writer = int(sys.argv[2]) if len(sys.argv) > 2 else 200
+
+    for name in ('connect per call', 'DatabaseHandler'):
+        database_file = os.path.join(tempfile.mkdtemp(), 'bench_database.db')
+        dbh = DatabaseHandler(database_file)
+        dbh.create_tables()
+
+        if name == 'DatabaseHandler':
+            insert = lambda user_id: dbh.insert_transaction(user_id, *ROW)
+        else:
+            # the old handler used the default rollback journal
+            dbh._connection().execute('PRAGMA journal_mode=DELETE')
+            dbh.close()
+            insert = lambda user_id: connect_per_call_insert(database_file, user_id)
+
+        throughput, errors = run(insert, writers, inserts_per_writer)
+        dbh.close()
+
+        print(f'{name:>16}: {throughput:8.0f} inserts/s, {errors} lock errors')
+
+if __name__ == '__main__':
+    main()
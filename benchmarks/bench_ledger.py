@@ -0,0 +1,67 @@
+import os, sys, tempfile, time, random, shutil, json
+
+# bulk export and import throughput of the transactions table: the per user
+# JSON pages against the CSV and columnar exports, and importing them back
+#
+# usage: python benchmarks/bench_ledger.py [TRANSACTIONS] [USERS]
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from database import DatabaseHandler
+from ledger import export_blocks, import_file
+from tools.stub_rate_server import DEFAULT_RATES
+
+def main():
+    transactions_count = int(sys.argv[1]) if len(sys.argv) > 1 else 500000
+    users_count = int(sys.argv[2]) if len(sys.argv) > 2 else 1000
+
+    directory = tempfile.mkdtemp()
+    dbh = DatabaseHandler(os.path.join(directory, 'bench_ledger.db'))
+    dbh.create_tables()
+
+    currencies = list(DEFAULT_RATES)
+    for start in range(0, transactions_count, 50000):
+        dbh.insert_transactions([
+            (random.randint(1, users_count), random.choice(currencies), random.uniform(1, 1000), random.choice(currencies),
+             random.uniform(1, 5000), random.uniform(0.5, 5), f'2023-07-{1 + i % 28:02d}T09:15:00Z')
+            for i in range(start, min(transactions_count, start + 50000))
+        ])
+
+    def rate(elapsed):
+        return f'{elapsed:.3f}s ({transactions_count / elapsed:.0f} rows/s)'
+
+    try:
+        # what a full pull costs today: every user history as JSON
+        started = time.perf_counter()
+        size = 0
+        for user_id in range(1, users_count + 1):
+            size += len(json.dumps(dbh.get_user_transactions(user_id)))
+        json_elapsed = time.perf_counter() - started
+        print(f'{transactions_count} transactions of {users_count} users')
+        print(f'per user JSON:      {rate(json_elapsed)}, {size / 2 ** 20:.1f} MiB')
+
+        exports = {}
+        for export_format in ('csv', 'columnar'):
+            path = os.path.join(directory, f'export.{export_format}')
+            started = time.perf_counter()
+            with open(path, 'wb') as f:
+                for block in export_blocks(dbh, export_format):
+                    f.write(block.encode('UTF-8') if isinstance(block, str) else block)
+            exports[export_format] = path
+            print(f'{export_format} export:{" " * (11 - len(export_format))}{rate(time.perf_counter() - started)}, '
+                  f'{os.path.getsize(path) / 2 ** 20:.1f} MiB')
+
+        for export_format, path in exports.items():
+            target = DatabaseHandler(os.path.join(directory, f'import_{export_format}.db'))
+            target.create_tables()
+            started = time.perf_counter()
+            with open(path, 'rb') as f:
+                import_file(target, f, export_format)
+            print(f'{export_format} import:{" " * (11 - len(export_format))}{rate(time.perf_counter() - started)}')
+            target.close()
+    finally:
+        dbh.close()
+        shutil.rmtree(directory)
+
+if __name__ == '__main__':
+    main()
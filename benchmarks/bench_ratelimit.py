@@ -0,0 +1,53 @@
+import os, sys, tempfile, time, shutil
+from multiprocessing import Process
+
+# cost of a per user rate limit check (a write transaction on the shared
+# SQLite buckets), with one worker process and with many of them sharing
+# the database
+#
+# usage: python benchmarks/bench_ratelimit.py [CHECKS] [PROCESSES] [USERS]
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from database import DatabaseHandler
+from ratelimit import UserRateLimiter
+
+def worker(path, checks, users):
+    # a limit never reached, so every check takes its token
+    dbh = DatabaseHandler(path)
+    limiter = UserRateLimiter(dbh, 1e6, 1e6)
+    for i in range(checks):
+        limiter.check(i % users)
+    dbh.close()
+
+def measure(path, checks, processes, users):
+    workers = [Process(target=worker, args=(path, checks // processes, users)) for _ in range(processes)]
+    started = time.perf_counter()
+    for p in workers:
+        p.start()
+    for p in workers:
+        p.join()
+    elapsed = time.perf_counter() - started
+    print(f'{processes} process(es): {elapsed:.3f}s ({checks / elapsed:.0f} checks/s, '
+          f'{elapsed / checks * 1e6:.1f} µs per check)')
+
+def main():
+    checks = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    processes = int(sys.argv[2]) if len(sys.argv) > 2 else 4
+    users = int(sys.argv[3]) if len(sys.argv) > 3 else 100
+
+    directory = tempfile.mkdtemp()
+    path = os.path.join(directory, 'bench_ratelimit.db')
+    dbh = DatabaseHandler(path)
+    dbh.create_tables()
+    dbh.close()
+
+    try:
+        print(f'{checks} rate limit checks of {users} users')
+        measure(path, checks, 1, users)
+        measure(path, checks, processes, users)
+    finally:
+        shutil.rmtree(directory)
+
+if __name__ == '__main__':
+    main()
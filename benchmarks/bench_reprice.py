@@ -0,0 +1,53 @@
+import os, sys, tempfile, time, random, shutil
+
+# re-pricing historical conversions with one RateHistory.reprice pass
+# against one RateHistory.rate_at lookup per conversion
+#
+# usage: python benchmarks/bench_reprice.py [CONVERSIONS] [RECORDED_TABLES]
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from database import DatabaseHandler
+from ratecache import RateTable
+from ratehistory import RateHistory
+from tools.stub_rate_server import DEFAULT_RATES
+
+def main():
+    conversions_count = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+    tables_count = int(sys.argv[2]) if len(sys.argv) > 2 else 1000
+
+    directory = tempfile.mkdtemp()
+    dbh = DatabaseHandler(os.path.join(directory, 'bench_reprice.db'))
+    dbh.create_tables()
+
+    # one table per hour
+    started_at = 1690156800
+    history = RateHistory(dbh)
+    for i in range(tables_count):
+        rates = { c: r * random.uniform(0.95, 1.05) for c, r in DEFAULT_RATES.items() }
+        history.record(RateTable('EUR', rates, started_at + i * 3600))
+
+    currencies = list(DEFAULT_RATES)
+    conversions = [(started_at + random.uniform(0, tables_count * 3600), random.choice(currencies),
+                    random.choice(currencies), random.uniform(1, 1000)) for _ in range(conversions_count)]
+
+    try:
+        started = time.perf_counter()
+        for timestamp, source_currency, target_currency, amount in conversions:
+            amount * history.rate_at(timestamp, source_currency, target_currency)
+        loop_elapsed = time.perf_counter() - started
+
+        history = RateHistory(dbh)
+        started = time.perf_counter()
+        history.reprice(conversions)
+        pass_elapsed = time.perf_counter() - started
+    finally:
+        dbh.close()
+        shutil.rmtree(directory)
+
+    print(f'{conversions_count} conversions over {tables_count} recorded tables')
+    print(f'rate_at per conversion: {loop_elapsed:.3f}s ({conversions_count / loop_elapsed:.0f} conversions/s)')
+    print(f'one reprice pass:       {pass_elapsed:.3f}s ({conversions_count / pass_elapsed:.0f} conversions/s)')
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,79 @@
+import os, sys, subprocess, statistics, tempfile, shutil
+
+# worker startup time: importing the app in a fresh interpreter, and the
+# time to the first conversion of a cold worker (a fresh process calling the
+# external API) against one forked from a master that warmed up the rate
+# cache (what tools/gunicorn.conf.py does)
+#
+# usage: python benchmarks/bench_startup.py [RUNS] [UPSTREAM_DELAY]
+
+PROJECT_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, PROJECT_DIR)
+
+from tools.stub_rate_server import StubRateServer
+
+CONVERSION = { 'user_id': 1, 'source_currency': 'EUR', 'target_currency': 'USD', 'amount': 100 }
+
+IMPORT_SCRIPT = '''
+import time
+started = time.perf_counter()
+import exchangeapi
+print(time.perf_counter() - started)
+'''
+
+COLD_SCRIPT = '''
+import sys, time
+started = time.perf_counter()
+import exchangeapi
+app = exchangeapi.create_app(database_file=sys.argv[1])
+response = app.test_client().post('/convert', json=%r)
+assert response.status_code == 200, response.get_json()
+print(time.perf_counter() - started)
+''' % (CONVERSION,)
+
+FORKED_SCRIPT = '''
+import os, sys, time
+import exchangeapi
+app = exchangeapi.create_app(database_file=sys.argv[1])
+exchangeapi.warmup()
+for _ in range(int(sys.argv[2])):
+    started = time.perf_counter()
+    pid = os.fork()
+    if pid == 0:
+        response = app.test_client().post('/convert', json=%r)
+        assert response.status_code == 200, response.get_json()
+        print(time.perf_counter() - started, flush=True)
+        os._exit(0)
+    os.waitpid(pid, 0)
+''' % (CONVERSION,)
+
+def run_script(script, *args):
+    result = subprocess.run([sys.executable, '-c', script, *args], cwd=PROJECT_DIR,
+                            capture_output=True, text=True, check=True)
+    return [float(line) for line in result.stdout.split()]
+
+def report(name, timings):
+    print(f'{name:<28}p50 {statistics.median(timings) * 1000:8.1f} ms   max {max(timings) * 1000:8.1f} ms')
+
+def main():
+    runs = int(sys.argv[1]) if len(sys.argv) > 1 else 10
+    upstream_delay = float(sys.argv[2]) if len(sys.argv) > 2 else 0.1
+
+    server = StubRateServer().start()
+    server.delay = upstream_delay
+    os.environ['EXCHANGE_API_URL'] = server.url
+    os.environ.setdefault('ACCESS_KEY', 'bench')
+
+    directory = tempfile.mkdtemp()
+    database_file = os.path.join(directory, 'bench_startup.db')
+    try:
+        print(f'{runs} runs, external API answering in {upstream_delay * 1000:.0f} ms')
+        report('import', [t for _ in range(runs) for t in run_script(IMPORT_SCRIPT)])
+        report('cold worker, 1st request', [t for _ in range(runs) for t in run_script(COLD_SCRIPT, database_file)])
+        report('forked worker, 1st request', run_script(FORKED_SCRIPT, database_file, str(runs)))
+    finally:
+        server.stop()
+        shutil.rmtree(directory)
+
+if __name__ == '__main__':
+    main()
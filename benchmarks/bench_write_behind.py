@@ -0,0 +1,57 @@
+import os, sys, tempfile, time, threading
+
+# requests/s of POST /convert with direct inserts against write-behind mode
+#
+# usage: python benchmarks/bench_write_behind.py [THREADS] [REQUESTS_PER_THREAD]
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import exchangeapi
+
+directory = tempfile.mkdtemp()
+exchangeapi.create_app(database_file=os.path.join(directory, 'bench_write_behind.db'))
+from journal import WriteBehindWriter
+from tools.stub_rate_server import StubRateServer
+
+CONVERSION = { 'user_id': 1, 'source_currency': 'EUR', 'target_currency': 'USD', 'amount': 100 }
+
+def run(threads, requests_per_thread):
+    def client():
+        test_client = exchangeapi.app.test_client()
+        for _ in range(requests_per_thread):
+            response = test_client.post('/convert', json=CONVERSION)
+            assert response.status_code == 200, response.get_json()
+
+    workers = [threading.Thread(target=client) for _ in range(threads)]
+    started = time.perf_counter()
+    for w in workers:
+        w.start()
+    for w in workers:
+        w.join()
+    return threads * requests_per_thread / (time.perf_counter() - started)
+
+def main():
+    threads = int(sys.argv[1]) if len(sys.argv) > 1 else 8
+    requests_per_thread = int(sys.argv[2]) if len(sys.argv) > 2 else 250
+
+    server = StubRateServer().start()
+    os.environ['EXCHANGE_API_URL'] = server.url
+    os.environ.setdefault('ACCESS_KEY', 'bench')
+
+    try:
+        exchangeapi.transaction_writer = None
+        direct = run(threads, requests_per_thread)
+
+        writer = WriteBehindWriter(exchangeapi.dbh, os.path.join(directory, 'bench.journal')).start()
+        exchangeapi.transaction_writer = writer
+        write_behind = run(threads, requests_per_thread)
+        writer.close()
+    finally:
+        server.stop()
+        exchangeapi.dbh.close()
+
+    print(f'direct inserts: {direct:8.0f} req/s')
+    print(f'write-behind:   {write_behind:8.0f} req/s ({writer.batches_written} batches for {writer.records_written} records)')
+
+if __name__ == '__main__':
+    main()
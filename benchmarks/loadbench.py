@@ -0,0 +1,202 @@
+import argparse, json, os, subprocess, sys, tempfile, threading, time, socket, shutil
+import requests
+
+# load benchmark of POST /convert and GET /transactions/<user_id>
+#
+# the app runs in a separate process against the stub rate server and a
+# temporary SQLite file, and the results are printed as json:
+#
+#   python benchmarks/loadbench.py --concurrency 16 --requests 2000 --history 10000 > baseline.json
+#   python benchmarks/loadbench.py --concurrency 16 --requests 2000 --history 10000 --compare baseline.json
+
+PROJECT_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, PROJECT_DIR)
+
+from tools.stub_rate_server import StubRateServer
+
+USER_ID = 1
+CONVERSION = { 'user_id': USER_ID, 'source_currency': 'USD', 'target_currency': 'BRL', 'amount': 100 }
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+def serve(args):
+    # runs in the app process
+    from exchangeapi import create_app
+    app = create_app(database_file=args.database)
+
+    if args.app == 'asgi':
+        import uvicorn
+        from asyncapi import app
+        uvicorn.run(app, host='127.0.0.1', port=args.port, log_level='warning')
+    else:
+        import logging
+        from werkzeug.serving import make_server
+        logging.getLogger('werkzeug').setLevel(logging.ERROR)
+        make_server('127.0.0.1', args.port, app, threaded=True).serve_forever()
+
+def seed_history(database_file, history):
+    import database
+    dbh = database.DatabaseHandler(database_file)
+    dbh.create_tables()
+
+    rows = [(USER_ID, 'USD', 100, 'BRL', 474.9, 4.749, '2023-07-22T09:15:00Z')] * 10000
+    for start in range(0, history, len(rows)):
+        dbh.insert_transactions(rows[:min(len(rows), history - start)])
+    dbh.close()
+
+def start_app(args, database_file, rates_url):
+    port = free_port()
+    env = dict(os.environ, ACCESS_KEY='loadbench', EXCHANGE_API_URL=rates_url)
+    process = subprocess.Popen([sys.executable, os.path.abspath(__file__), '--serve',
+                                '--app', args.app, '--port', str(port), '--database', database_file],
+                               cwd=os.path.dirname(database_file), env=env)
+
+    url = f'http://127.0.0.1:{port}'
+    deadline = time.monotonic() + 30
+    while time.monotonic() < deadline:
+        try:
+            requests.get(f'{url}/transactions/0', timeout=1)
+            return process, url
+        except requests.ConnectionError:
+            if process.poll() is not None:
+                break
+            time.sleep(0.1)
+
+    process.kill()
+    raise RuntimeError('the app did not start')
+
+def percentile(sorted_values, p):
+    if not sorted_values:
+        return None
+    index = min(len(sorted_values) - 1, max(0, int(round(p / 100 * len(sorted_values))) - 1))
+    return sorted_values[index]
+
+def run_scenario(send, concurrency, total_requests):
+    latencies = []
+    errors = []
+    counter = iter(range(total_requests))
+    lock = threading.Lock()
+
+    def worker():
+        session = requests.Session()
+        while True:
+            with lock:
+                if next(counter, None) is None:
+                    break
+            started = time.perf_counter()
+            try:
+                response = send(session)
+                ok = response.status_code == 200
+            except requests.RequestException:
+                ok = False
+            elapsed = time.perf_counter() - started
+            with lock:
+                (latencies if ok else errors).append(elapsed)
+        session.close()
+
+    threads = [threading.Thread(target=worker) for _ in range(concurrency)]
+    started = time.perf_counter()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    elapsed = time.perf_counter() - started
+
+    latencies.sort()
+    return {
+        'requests': len(latencies) + len(errors),
+        'errors': len(errors),
+        'elapsed_s': round(elapsed, 3),
+        'req_per_s': round(len(latencies) / elapsed, 1),
+        'p50_ms': round(percentile(latencies, 50) * 1000, 3) if latencies else None,
+        'p95_ms': round(percentile(latencies, 95) * 1000, 3) if latencies else None,
+        'p99_ms': round(percentile(latencies, 99) * 1000, 3) if latencies else None
+    }
+
+def compare(results, baseline, threshold):
+    # a regression is a throughput drop or a latency rise over 'threshold'
+    regressions = []
+    for scenario, current in results['results'].items():
+        previous = baseline['results'].get(scenario)
+        if previous is None:
+            continue
+
+        if previous['req_per_s'] and current['req_per_s'] < previous['req_per_s'] * (1 - threshold):
+            regressions.append(f"{scenario}: req_per_s {previous['req_per_s']} -> {current['req_per_s']}")
+
+        for metric in ('p50_ms', 'p95_ms', 'p99_ms'):
+            if previous[metric] and current[metric] and current[metric] > previous[metric] * (1 + threshold):
+                regressions.append(f'{scenario}: {metric} {previous[metric]} -> {current[metric]}')
+
+        if current['errors'] > previous['errors']:
+            regressions.append(f"{scenario}: errors {previous['errors']} -> {current['errors']}")
+
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description='load benchmark of the conversion and user transactions endpoints')
+    parser.add_argument('--app', choices=['wsgi', 'asgi'], default='wsgi')
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--requests', type=int, default=1000, help='requests per scenario')
+    parser.add_argument('--history', type=int, default=1000, help='transactions of the queried user')
+    parser.add_argument('--transactions-query', default='limit=100',
+                        help='query string of the user transactions requests')
+    parser.add_argument('--output', help='write the json results to this file')
+    parser.add_argument('--compare', metavar='BASELINE', help='json results to compare against')
+    parser.add_argument('--threshold', type=float, default=0.1, help='tolerated relative change (default: 0.1)')
+    parser.add_argument('--serve', action='store_true', help=argparse.SUPPRESS)
+    parser.add_argument('--port', type=int, help=argparse.SUPPRESS)
+    parser.add_argument('--database', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.serve:
+        return serve(args)
+
+    directory = tempfile.mkdtemp()
+    database_file = os.path.join(directory, 'loadbench.db')
+    seed_history(database_file, args.history)
+
+    rates_server = StubRateServer().start()
+    process, url = start_app(args, database_file, rates_server.url)
+
+    transactions_url = f'{url}/transactions/{USER_ID}?{args.transactions_query}'
+    try:
+        results = {
+            'config': {
+                'app': args.app,
+                'concurrency': args.concurrency,
+                'requests': args.requests,
+                'history': args.history,
+                'transactions_query': args.transactions_query
+            },
+            'results': {
+                'convert': run_scenario(lambda s: s.post(f'{url}/convert', json=CONVERSION),
+                                        args.concurrency, args.requests),
+                'transactions': run_scenario(lambda s: s.get(transactions_url),
+                                             args.concurrency, args.requests)
+            }
+        }
+    finally:
+        process.terminate()
+        process.wait()
+        rates_server.stop()
+        shutil.rmtree(directory)
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        results['regressions'] = compare(results, baseline, args.threshold)
+
+    output = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output + '\n')
+    print(output)
+
+    return 1 if results.get('regressions') else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
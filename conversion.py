@@ -0,0 +1,117 @@
+import math
+from array import array
+from decimal import Decimal, ROUND_HALF_EVEN
+from functools import lru_cache
+
+# exact conversions in integer minor units (cents for USD, yen for JPY):
+# the amount is scaled to minor units of its currency, multiplied by the
+# rate as a fixed-point integer and rounded once (half to even) to minor
+# units of the target currency, so no float rounding error reaches the
+# stored amounts
+
+DEFAULT_EXPONENT = 2
+
+# ISO 4217 minor units of the currencies not using 2 decimals (and BTC,
+# quoted by the external API)
+EXPONENTS = {
+    'BIF': 0, 'CLP': 0, 'DJF': 0, 'GNF': 0, 'ISK': 0, 'JPY': 0, 'KMF': 0, 'KRW': 0, 'PYG': 0,
+    'RWF': 0, 'UGX': 0, 'UYI': 0, 'VND': 0, 'VUV': 0, 'XAF': 0, 'XOF': 0, 'XPF': 0,
+    'BHD': 3, 'IQD': 3, 'JOD': 3, 'KWD': 3, 'LYD': 3, 'OMR': 3, 'TND': 3,
+    'CLF': 4, 'UYW': 4,
+    'BTC': 8
+}
+
+# digits kept of an exchange rate
+RATE_DECIMALS = 18
+RATE_SCALE = 10 ** RATE_DECIMALS
+
+# precomputed: 10 ** exponent per currency, and per (source exponent,
+# target exponent) the (multiplier, divisor) taking source minor units
+# times a fixed-point rate to target minor units
+_UNITS = { currency: 10 ** e for currency, e in EXPONENTS.items() }
+_DEFAULT_UNIT = 10 ** DEFAULT_EXPONENT
+_ALL_EXPONENTS = set(EXPONENTS.values()) | { DEFAULT_EXPONENT }
+_FACTORS = {
+    (s, t): (10 ** max(t - s, 0), RATE_SCALE * 10 ** max(s - t, 0))
+    for s in _ALL_EXPONENTS for t in _ALL_EXPONENTS
+}
+
+def exponent(currency):
+    return EXPONENTS.get(currency, DEFAULT_EXPONENT)
+
+def to_minor_units(amount, currency):
+    # the amount as an integer of minor units, ValueError if it has more
+    # decimals than the currency
+    unit = _UNITS.get(currency, _DEFAULT_UNIT)
+    if isinstance(amount, int):
+        return amount * unit
+
+    try:
+        units = int(amount * unit + (0.5 if amount > 0 else -0.5))
+    except (OverflowError, ValueError):
+        raise ValueError('Invalid amount. amount must be a finite number')
+
+    # true division of integers is correctly rounded, so this holds only
+    # when the amount is the float closest to units / unit
+    if units / unit != amount:
+        raise ValueError(f'Invalid amount. {currency} amounts have at most {exponent(currency)} decimals')
+    return units
+
+def from_minor_units(units, currency):
+    # the float closest to the exact amount
+    return units / _UNITS.get(currency, _DEFAULT_UNIT)
+
+@lru_cache(maxsize=4096)
+def fixed_rate(exchange_rate):
+    # the shortest decimal of the float (the one sent by the external API
+    # for a direct rate), as a fixed-point integer
+    return int(Decimal(repr(exchange_rate)).scaleb(RATE_DECIMALS).to_integral_value(ROUND_HALF_EVEN))
+
+def convert_minor(amount, rate, source_currency, target_currency):
+    # 'amount' in source minor units and 'rate' from fixed_rate, returns
+    # target minor units
+    multiplier, divisor = _FACTORS[(exponent(source_currency), exponent(target_currency))]
+    q, r = divmod(amount * rate * multiplier, divisor)
+    if 2 * r > divisor or (2 * r == divisor and q & 1):
+        q += 1
+    return q
+
+# {(exchange_rate, source_currency, target_currency): (factor, divisor,
+# half of the divisor, target unit)}, everything a conversion of this pair
+# at this rate needs
+_pairs = {}
+MAX_CACHED_PAIRS = 4096
+
+def _pair(exchange_rate, source_currency, target_currency):
+    key = (exchange_rate, source_currency, target_currency)
+    pair = _pairs.get(key)
+    if pair is None:
+        multiplier, divisor = _FACTORS[(exponent(source_currency), exponent(target_currency))]
+        pair = (fixed_rate(exchange_rate) * multiplier, divisor, divisor // 2, _UNITS.get(target_currency, _DEFAULT_UNIT))
+        if len(_pairs) >= MAX_CACHED_PAIRS:
+            _pairs.clear()
+        _pairs[key] = pair
+    return pair
+
+def convert_amount(amount, exchange_rate, source_currency, target_currency):
+    # the same as amount * exchange_rate, rounded exactly to the minor unit
+    # of the target currency (convert_minor, with the pair lookups cached)
+    factor, divisor, half, target_unit = _pair(exchange_rate, source_currency, target_currency)
+    q, r = divmod(to_minor_units(amount, source_currency) * factor, divisor)
+    if r > half or (r == half and q & 1):
+        q += 1
+    return q / target_unit
+
+def convert_many(amounts, exchange_rate, source_currency, target_currency):
+    # converts many amounts of the same pair in one call: 'amounts' in
+    # source minor units (e.g. an array('q')), returns an array('q') of
+    # target minor units (so each one must fit in 64 bits)
+    factor, divisor, half, _ = _pair(exchange_rate, source_currency, target_currency)
+
+    # rounds half up, then fixes the exact halves (only possible when
+    # factor and divisor share the factors of half) to half to even
+    converted = [(a * factor + half) // divisor for a in amounts]
+    if half % math.gcd(factor, divisor) == 0:
+        converted = [q - 1 if q & 1 and a * factor % divisor == half else q for a, q in zip(amounts, converted)]
+
+    return array('q', converted)
@@ -0,0 +1,38 @@
+from array import array
+
+class CrossRateMatrix:
+    def __init__(self, base_currency, rates):
+        rates = dict(rates)
+        rates.setdefault(base_currency, 1)
+
+        self.currencies = sorted(rates)
+        self.index = { currency: i for i, currency in enumerate(self.currencies) }
+
+        # N x N matrix stored row-major: matrix[i * N + j] is the rate to
+        # convert currencies[i] into currencies[j], i.e. rates[j] / rates[i]
+        n = len(self.currencies)
+        values = [rates[currency] for currency in self.currencies]
+        self.matrix = array('d', bytes(8 * n * n))
+        for i, source_rate in enumerate(values):
+            if not source_rate:
+                continue
+            row = i * n
+            for j, target_rate in enumerate(values):
+                self.matrix[row + j] = target_rate / source_rate
+
+    def __contains__(self, currency):
+        return currency in self.index
+
+    def rate(self, source_currency, target_currency):
+        i = self.index.get(source_currency)
+        if i is None:
+            raise ValueError(f"exchange rate for {source_currency} not available in the external API response")
+
+        j = self.index.get(target_currency)
+        if j is None:
+            raise ValueError(f"exchange rate for {target_currency} not available in the external API response")
+
+        exchange_rate = self.matrix[i * len(self.currencies) + j]
+        if not exchange_rate:
+            raise ValueError(f"exchange rate for {source_currency} not available in the external API response")
+        return exchange_rate
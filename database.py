@@ -1,73 +1,720 @@
-import sqlite3
+import sqlite3, threading, os, sys, heapq, pathlib, weakref
+from contextlib import contextmanager
+from datetime import datetime
+from itertools import islice
 
 DATABASE_FILE = 'currency_conversion.db'
 
-class DatabaseHandler:
-    def create_tables(self):
-        conn = sqlite3.connect(DATABASE_FILE)
-        cursor = conn.cursor()
+# the statements are kept as constants so every persistent connection
+# compiles them once and reuses them from its statement cache
+INSERT_TRANSACTION_SQL = '''
+    INSERT INTO transactions (user_id, source_currency, amount, target_currency, converted_amount, exchange_rate, timestamp)
+    VALUES (?, ?, ?, ?, ?, ?, ?)
+'''
 
-        # Create a table to store transaction details
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS transactions (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                user_id INTEGER,
-                source_currency TEXT,
-                amount REAL,
-                target_currency TEXT,
-                converted_amount REAL,
-                exchange_rate REAL,
-                timestamp DATETIME
+# used by the write-behind writer: ids are allocated up front, and OR IGNORE
+# makes replaying an already written record a no-op
+INSERT_TRANSACTION_WITH_ID_SQL = '''
+    INSERT OR IGNORE INTO transactions (id, user_id, source_currency, amount, target_currency, converted_amount, exchange_rate, timestamp)
+    VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+'''
+
+SELECT_USER_TRANSACTIONS_SQL = '''
+    SELECT * FROM transactions WHERE user_id = ? AND id > ? ORDER BY id
+'''
+
+SELECT_USER_TRANSACTIONS_PAGE_SQL = '''
+    SELECT * FROM transactions WHERE user_id = ? AND id > ? ORDER BY id LIMIT ?
+'''
+
+# rebuilds the rollup rows of a transactions table
+SUMMARIZE_TRANSACTIONS_SQL = '''
+    SELECT user_id, substr(timestamp, 1, 10), source_currency, target_currency, COUNT(*), SUM(amount), SUM(converted_amount)
+    FROM transactions
+    GROUP BY user_id, substr(timestamp, 1, 10), source_currency, target_currency
+'''
+
+# the closed months moved out of the hot database by archive_partitions,
+# each one to its own read-only file
+SELECT_PARTITIONS_SQL = '''
+    SELECT file, first_id, last_id, first_timestamp, last_timestamp FROM transaction_partitions ORDER BY first_id
+'''
+
+ARCHIVE_SCHEMA = [
+    '''
+        CREATE TABLE IF NOT EXISTS archive.transactions (
+            id INTEGER PRIMARY KEY,
+            user_id INTEGER,
+            source_currency TEXT,
+            amount REAL,
+            target_currency TEXT,
+            converted_amount REAL,
+            exchange_rate REAL,
+            timestamp DATETIME
+        )
+    ''',
+    '''
+        CREATE INDEX IF NOT EXISTS archive.transactions_user_id_idx ON transactions (user_id, id)
+    '''
+]
+
+# page cache used by bulk imports (negative means KiB, so 256 MiB)
+IMPORT_CACHE_SIZE = -262144
+
+# applied in order by create_tables, PRAGMA user_version keeps how many of
+# them the database file already has: each statement is numbered below by
+# the user_version of a database that has it
+SCHEMA_MIGRATIONS = [
+    # 1: user history queries seek the index instead of scanning the table
+    '''
+        CREATE INDEX IF NOT EXISTS transactions_user_id_idx ON transactions (user_id, id)
+    ''',
+    # 2, 3: per user, day and currency pair rollup of the transactions, kept
+    # up to date by a trigger in the same transaction as every insert (run
+    # "python database.py backfill-summaries" once to include the
+    # transactions inserted before this migration)
+    '''
+        CREATE TABLE IF NOT EXISTS transaction_summaries (
+            user_id INTEGER,
+            day TEXT,
+            source_currency TEXT,
+            target_currency TEXT,
+            transactions INTEGER,
+            amount REAL,
+            converted_amount REAL,
+            PRIMARY KEY (user_id, day, source_currency, target_currency)
         )
-        ''')
+    ''',
+    '''
+        CREATE TRIGGER IF NOT EXISTS transactions_summarize AFTER INSERT ON transactions
+        BEGIN
+            INSERT INTO transaction_summaries (user_id, day, source_currency, target_currency, transactions, amount, converted_amount)
+            VALUES (NEW.user_id, substr(NEW.timestamp, 1, 10), NEW.source_currency, NEW.target_currency, 1, NEW.amount, NEW.converted_amount)
+            ON CONFLICT (user_id, day, source_currency, target_currency) DO UPDATE SET
+                transactions = transactions + 1,
+                amount = amount + excluded.amount,
+                converted_amount = converted_amount + excluded.converted_amount;
+        END
+    ''',
+    # 4, 5: every rates table fetched from the external API, one row per fetch
+    # with the rates packed as an array of doubles in 'currencies' order
+    '''
+        CREATE TABLE IF NOT EXISTS rate_history (
+            id INTEGER PRIMARY KEY,
+            fetched_at REAL NOT NULL,
+            base_currency TEXT,
+            currencies TEXT,
+            rates BLOB
+        )
+    ''',
+    '''
+        CREATE INDEX IF NOT EXISTS rate_history_fetched_at_idx ON rate_history (fetched_at)
+    ''',
+    # 6: catalog of the archived partitions, with the id and time range of
+    # each one so queries only open the partitions they need
+    '''
+        CREATE TABLE IF NOT EXISTS transaction_partitions (
+            month TEXT PRIMARY KEY,
+            file TEXT,
+            transactions INTEGER,
+            first_id INTEGER,
+            last_id INTEGER,
+            first_timestamp TEXT,
+            last_timestamp TEXT
+        )
+    ''',
+    # 7: responses of the conversions sent with an Idempotency-Key, the
+    # primary key makes a single request claim each key (the response is
+    # NULL while that request is in progress)
+    '''
+        CREATE TABLE IF NOT EXISTS idempotency_keys (
+            key TEXT PRIMARY KEY,
+            fingerprint TEXT,
+            created_at REAL,
+            response TEXT
+        )
+    ''',
+    # 8: token buckets of the per user rate limits, shared by every worker
+    # process using the database
+    '''
+        CREATE TABLE IF NOT EXISTS rate_limits (
+            key TEXT PRIMARY KEY,
+            tokens REAL,
+            updated_at REAL
+        )
+    ''',
+    # 9: the Idempotency-Key responses past their retention are deleted by
+    # creation time
+    '''
+        CREATE INDEX IF NOT EXISTS idempotency_keys_created_at ON idempotency_keys (created_at)
+    ''',
+    # 10: the transaction inserted by the request holding a key, written in
+    # the same transaction as the insert, so a response lost after it (a
+    # crash, a busy timeout) is rebuilt from it instead of converting again
+    '''
+        ALTER TABLE idempotency_keys ADD COLUMN transaction_id INTEGER
+    ''',
+]
 
-        conn.commit()
-        conn.close()
+# group_by values of the summaries and their columns
+SUMMARY_GROUPS = {
+    'day': ('day',),
+    'pair': ('source_currency', 'target_currency'),
+    'source_currency': ('source_currency',),
+    'target_currency': ('target_currency',)
+}
 
-    def insert_transaction(self, user_id, source_currency, amount, target_currency, converted_amount, exchange_rate, timestamp):
-        conn = sqlite3.connect(DATABASE_FILE)
-        cursor = conn.cursor()
+def _close_connections(connections, pid):
+    # a forked child leaves the connections of its parent alone
+    if os.getpid() != pid:
+        return
+    for conn in connections:
+        try:
+            conn.close()
+        except sqlite3.Error:
+            pass
+    connections.clear()
 
-        cursor.execute('''
-            INSERT INTO transactions (user_id, source_currency, amount, target_currency, converted_amount, exchange_rate, timestamp)
-            VALUES (?, ?, ?, ?, ?, ?, ?)
-        ''', (user_id, source_currency, amount, target_currency, converted_amount, exchange_rate, timestamp))
+class _ThreadConnections:
+    # the connections of one thread, closed once the thread exits (its
+    # thread-local storage, and so this object, is released)
+    def __init__(self, generation):
+        self.conn = None
+        self.archives = {}
+        self.connections = []
+        self.pid = os.getpid()
+        self.generation = generation
+        weakref.finalize(self, _close_connections, self.connections, self.pid)
+
+class DatabaseHandler:
+    def __init__(self, database_file=None, busy_timeout=5.0, archive_directory=None):
+        # when no file is given DATABASE_FILE is used, and the archived
+        # partitions go to a directory next to it
+        self.database_file = database_file
+        self.busy_timeout = busy_timeout
+        self.archive_directory = archive_directory
+        self._local = threading.local()
+        self._threads = weakref.WeakSet()
+        self._generation = 0
+        self._lock = threading.Lock()
+
+    def _thread_connections(self):
+        # one persistent connection per thread (and per process, so a forked
+        # worker never reuses the connections of its parent)
+        holder = getattr(self._local, 'holder', None)
+        if holder is None or holder.pid != os.getpid() or holder.generation != self._generation:
+            conn = sqlite3.connect(self.database_file or DATABASE_FILE,
+                                   timeout=self.busy_timeout,
+                                   isolation_level=None,
+                                   check_same_thread=False)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            conn.execute(f'PRAGMA busy_timeout={int(self.busy_timeout * 1000)}')
+
+            holder = _ThreadConnections(self._generation)
+            holder.conn = conn
+            holder.connections.append(conn)
+            with self._lock:
+                self._threads.add(holder)
+            self._local.holder = holder
+
+        return holder
+
+    def _connection(self):
+        return self._thread_connections().conn
 
-        transaction_id = cursor.lastrowid
+    def _archive_directory(self):
+        if self.archive_directory is not None:
+            return self.archive_directory
+        return os.path.splitext(self.database_file or DATABASE_FILE)[0] + '-archive'
 
-        conn.commit()
-        conn.close()
+    def _archive_connection(self, file):
+        # read-only connections to the archived partitions, also one per
+        # thread and opened on first use
+        holder = self._thread_connections()
+        conn = holder.archives.get(file)
+        if conn is None:
+            uri = pathlib.Path(self._archive_directory(), file).absolute().as_uri() + '?mode=ro'
+            conn = sqlite3.connect(uri, uri=True, timeout=self.busy_timeout, check_same_thread=False)
+            holder.connections.append(conn)
+            holder.archives[file] = conn
+
+        return conn
+
+    def _archives(self):
+        cursor = self._connection().cursor()
+        cursor.execute(SELECT_PARTITIONS_SQL)
+        return cursor.fetchall()
+
+    def _sources(self, after=0, since=None, until=None):
+        # the connections to the archived partitions overlapping the id and
+        # time range, in id order, and the hot database (which may also hold
+        # old rows imported after their month was archived)
+        sources = []
+        for file, first_id, last_id, first_timestamp, last_timestamp in self._archives():
+            if last_id <= after:
+                continue
+            if since is not None and last_timestamp < since:
+                continue
+            if until is not None and first_timestamp >= until:
+                continue
+            sources.append((first_id, self._archive_connection(file)))
+
+        sources.append((0, self._connection()))
+        return sources
+
+    @contextmanager
+    def _transaction(self):
+        # BEGIN IMMEDIATE takes the write lock up front, so concurrent
+        # writers wait on the busy timeout instead of failing on a lock
+        # upgrade with 'database is locked'
+        cursor = self._connection().cursor()
+        cursor.execute('BEGIN IMMEDIATE')
+        try:
+            yield cursor
+        except BaseException:
+            cursor.execute('ROLLBACK')
+            raise
+        else:
+            cursor.execute('COMMIT')
+
+    def close(self):
+        # shutdown hook: closes the connections of every thread
+        with self._lock:
+            holders, self._threads = list(self._threads), weakref.WeakSet()
+            self._generation += 1
+
+        for holder in holders:
+            _close_connections(holder.connections, holder.pid)
+
+    def create_tables(self):
+        with self._transaction() as cursor:
+            # Create a table to store transaction details
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS transactions (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    user_id INTEGER,
+                    source_currency TEXT,
+                    amount REAL,
+                    target_currency TEXT,
+                    converted_amount REAL,
+                    exchange_rate REAL,
+                    timestamp DATETIME
+            )
+            ''')
+
+            cursor.execute('PRAGMA user_version')
+            version = cursor.fetchone()[0]
+            for migration in SCHEMA_MIGRATIONS[version:]:
+                cursor.execute(migration)
+            cursor.execute(f'PRAGMA user_version = {len(SCHEMA_MIGRATIONS)}')
+
+    def insert_transaction(self, user_id, source_currency, amount, target_currency, converted_amount, exchange_rate, timestamp,
+                           idempotency_key=None):
+        # the transaction is also recorded on the Idempotency-Key claimed for
+        # it, atomically
+        with self._transaction() as cursor:
+            cursor.execute(INSERT_TRANSACTION_SQL,
+                           (user_id, source_currency, amount, target_currency, converted_amount, exchange_rate, timestamp))
+
+            transaction_id = cursor.lastrowid
+            if idempotency_key is not None:
+                cursor.execute('UPDATE idempotency_keys SET transaction_id = ? WHERE key = ?',
+                               (transaction_id, idempotency_key))
 
         return transaction_id
 
-    def get_user_transactions(self, user_id):
-        conn = sqlite3.connect(DATABASE_FILE)
-        cursor = conn.cursor()
+    def insert_transactions(self, transactions):
+        # 'transactions' is a list of (user_id, source_currency, amount,
+        # target_currency, converted_amount, exchange_rate, timestamp)
+        with self._transaction() as cursor:
+            # the write lock is held for the whole batch, so the ids
+            # generated by AUTOINCREMENT are consecutive
+            cursor.executemany(INSERT_TRANSACTION_SQL, transactions)
 
-        cursor.execute('''
-            SELECT * FROM transactions WHERE user_id = ?
-        ''', (user_id,))
+            cursor.execute('SELECT last_insert_rowid()')
+            last_id = cursor.fetchone()[0]
+
+        return list(range(last_id - len(transactions) + 1, last_id + 1))
+
+    def reserve_transaction_ids(self, count):
+        # moves the AUTOINCREMENT sequence forward, so the reserved ids are
+        # never given to another insert (by this or any other process)
+        with self._transaction() as cursor:
+            cursor.execute("SELECT seq FROM sqlite_sequence WHERE name = 'transactions'")
+            row = cursor.fetchone()
+
+            if row is None:
+                cursor.execute('SELECT COALESCE(MAX(id), 0) FROM transactions')
+                last_id = cursor.fetchone()[0]
+                cursor.execute("INSERT INTO sqlite_sequence (name, seq) VALUES ('transactions', ?)", (last_id + count,))
+            else:
+                last_id = row[0]
+                cursor.execute("UPDATE sqlite_sequence SET seq = ? WHERE name = 'transactions'", (last_id + count,))
+
+        return range(last_id + 1, last_id + count + 1)
 
-        raw_transactions = cursor.fetchall()
+    def write_transactions(self, transactions):
+        # 'transactions' is a list of (id, user_id, source_currency, amount,
+        # target_currency, converted_amount, exchange_rate, timestamp) with
+        # ids from reserve_transaction_ids
+        transactions = self._skip_archived(transactions)
+        with self._transaction() as cursor:
+            cursor.executemany(INSERT_TRANSACTION_WITH_ID_SQL, transactions)
+
+    def get_user_transactions(self, user_id, limit=None, after=None):
+        # keyset pagination: 'after' is the last transaction id already seen
+        raw_transactions = []
+        for first_id, conn in self._sources(after or 0):
+            # partitions are in id order, so once the page is full the
+            # later ones have nothing to add (the hot database is always read)
+            if limit is not None and len(raw_transactions) >= limit and first_id > raw_transactions[-1][0]:
+                continue
+
+            cursor = conn.cursor()
+            if limit is None:
+                cursor.execute(SELECT_USER_TRANSACTIONS_SQL, (user_id, after or 0))
+            else:
+                cursor.execute(SELECT_USER_TRANSACTIONS_PAGE_SQL, (user_id, after or 0, limit))
+
+            raw_transactions = list(heapq.merge(raw_transactions, cursor.fetchall()))[:limit]
 
         # Convert the fetched data to a list of dictionaries
-        transactions_dict_list = []
-        for t in raw_transactions:
-            transaction_dict = {
-                'transaction_id': t[0],
-                'user_id': t[1],
-                'source_currency': t[2],
-                'amount': t[3],
-                'target_currency': t[4],
-                'converted_amount': t[5],
-                'exchange_rate': t[6],
-                'timestamp': t[7]
-            }
-            transactions_dict_list.append(transaction_dict)
-
-        conn.close()
-        return transactions_dict_list
+        return [transaction_dict(t) for t in raw_transactions]
+
+    def iter_user_transactions(self, user_id, after=None, chunk_size=500):
+        # yields the transactions reading 'chunk_size' rows at a time, so the
+        # memory used does not grow with the user history
+        rows = heapq.merge(*(_iter_rows(conn, SELECT_USER_TRANSACTIONS_SQL, (user_id, after or 0), chunk_size)
+                             for _, conn in self._sources(after or 0)))
+        for t in rows:
+            yield transaction_dict(t)
+
+    def iter_transaction_chunks(self, since=None, until=None, chunk_size=10000):
+        # yields the raw rows of the whole ledger as lists of up to
+        # 'chunk_size' tuples, in id order ('since' is inclusive and 'until'
+        # exclusive, both formatted as the stored timestamps)
+        conditions = []
+        params = []
+        if since is not None:
+            conditions.append('timestamp >= ?')
+            params.append(since)
+        if until is not None:
+            conditions.append('timestamp < ?')
+            params.append(until)
+
+        sql = 'SELECT * FROM transactions'
+        if conditions:
+            sql += f' WHERE {" AND ".join(conditions)}'
+
+        # only the partitions overlapping the time range are read
+        rows = heapq.merge(*(_iter_rows(conn, sql + ' ORDER BY id', params, chunk_size)
+                             for _, conn in self._sources(since=since, until=until)))
+        while True:
+            chunk = list(islice(rows, chunk_size))
+            if not chunk:
+                break
+            yield chunk
+
+    def import_transactions(self, transactions, batch_size=50000):
+        # 'transactions' is an iterable of (id, user_id, source_currency,
+        # amount, target_currency, converted_amount, exchange_rate,
+        # timestamp), written 'batch_size' rows per transaction. rows whose
+        # id is already there are skipped, so an import can be resumed
+        conn = self._connection()
+        previous_cache_size = conn.execute('PRAGMA cache_size').fetchone()[0]
+        # the rollup trigger updates pages all over the summaries table, a
+        # bigger page cache (while importing only) keeps them in memory
+        conn.execute(f'PRAGMA cache_size={IMPORT_CACHE_SIZE}')
+
+        imported = 0
+        batch = []
+        try:
+            for t in transactions:
+                batch.append(t)
+                if len(batch) >= batch_size:
+                    imported += self._import_batch(batch)
+                    batch = []
+            if batch:
+                imported += self._import_batch(batch)
+        finally:
+            conn.execute(f'PRAGMA cache_size={previous_cache_size}')
+
+        return imported
+
+    def _import_batch(self, batch):
+        batch = self._skip_archived(batch)
+        with self._transaction() as cursor:
+            cursor.executemany(INSERT_TRANSACTION_WITH_ID_SQL, batch)
+            return cursor.rowcount
+
+    def _skip_archived(self, transactions):
+        # drops the rows (with ids) already moved to an archived partition,
+        # OR IGNORE only sees the hot database. new ids are past every
+        # archived one, so this usually costs a single catalog read
+        archives = self._archives()
+        if not archives:
+            return transactions
+
+        last_archived_id = max(a[2] for a in archives)
+        candidates = [t[0] for t in transactions if t[0] <= last_archived_id]
+        if not candidates:
+            return transactions
+
+        archived = set()
+        for file, first_id, last_id, _, _ in archives:
+            ids = [i for i in candidates if first_id <= i <= last_id]
+            for start in range(0, len(ids), 500):
+                part = ids[start:start + 500]
+                cursor = self._archive_connection(file).cursor()
+                cursor.execute(f'SELECT id FROM transactions WHERE id IN ({", ".join("?" * len(part))})', part)
+                archived.update(row[0] for row in cursor.fetchall())
+
+        return [t for t in transactions if t[0] not in archived]
+
+    def get_user_summary(self, user_id, group_by, since=None, until=None):
+        # reads the rollup table, so the cost depends on the number of
+        # groups and not on the number of transactions ('since' and 'until'
+        # are inclusive YYYY-MM-DD days)
+        columns = []
+        for group in group_by:
+            for column in SUMMARY_GROUPS[group]:
+                if column not in columns:
+                    columns.append(column)
+
+        # amounts are only summed when they are all in the same currency
+        totals = ['transactions']
+        if 'source_currency' in columns:
+            totals.append('amount')
+        if 'target_currency' in columns:
+            totals.append('converted_amount')
+
+        sql = f'SELECT {", ".join(columns + [f"SUM({t})" for t in totals])} FROM transaction_summaries WHERE user_id = ?'
+        params = [user_id]
+        if since is not None:
+            sql += ' AND day >= ?'
+            params.append(since)
+        if until is not None:
+            sql += ' AND day <= ?'
+            params.append(until)
+        if columns:
+            sql += f' GROUP BY {", ".join(columns)} ORDER BY {", ".join(columns)}'
+
+        cursor = self._connection().cursor()
+        cursor.execute(sql, params)
+
+        summaries = [dict(zip(columns + totals, row)) for row in cursor.fetchall()]
+        # without groups the totals of a user with no transactions are NULL
+        return [s for s in summaries if s['transactions']]
+
+    def backfill_summaries(self):
+        # rebuilds the rollup table from the transactions table and the
+        # archived partitions
+        with self._transaction() as cursor:
+            cursor.execute('DELETE FROM transaction_summaries')
+            cursor.execute(f'INSERT INTO transaction_summaries {SUMMARIZE_TRANSACTIONS_SQL}')
+
+            for file, *_ in self._archives():
+                archive = self._archive_connection(file).cursor()
+                archive.execute(SUMMARIZE_TRANSACTIONS_SQL)
+                cursor.executemany('''
+                    INSERT INTO transaction_summaries VALUES (?, ?, ?, ?, ?, ?, ?)
+                    ON CONFLICT (user_id, day, source_currency, target_currency) DO UPDATE SET
+                        transactions = transactions + excluded.transactions,
+                        amount = amount + excluded.amount,
+                        converted_amount = converted_amount + excluded.converted_amount
+                ''', archive.fetchall())
+
+            cursor.execute('SELECT COUNT(*) FROM transaction_summaries')
+            return cursor.fetchone()[0]
+
+    def archive_partitions(self, before=None):
+        # moves the transactions of every month before 'before' (YYYY-MM,
+        # default: the current month) to one compacted, read-only file per
+        # month, so the hot database only keeps the open months. returns
+        # [(month, transactions moved)]
+        if before is None:
+            # the month of the transactions written now (in the local time of
+            # the server, as their timestamps)
+            before = datetime.now().strftime('%Y-%m')
+        try:
+            datetime.strptime(before, '%Y-%m')
+        except ValueError:
+            raise ValueError(f'Invalid month "{before}". expected YYYY-MM')
+
+        cursor = self._connection().cursor()
+        cursor.execute('SELECT DISTINCT substr(timestamp, 1, 7) FROM transactions WHERE timestamp < ? ORDER BY 1', (before,))
+        months = [row[0] for row in cursor.fetchall()]
+
+        os.makedirs(self._archive_directory(), exist_ok=True)
+        return [(month, self._archive_month(month)) for month in months]
+
+    def _archive_month(self, month):
+        file = f'transactions-{month}.db'
+        path = os.path.join(self._archive_directory(), file)
+        if os.path.exists(path):
+            # rows imported after the month was archived are appended
+            os.chmod(path, 0o644)
+
+        conn = self._connection()
+        conn.execute('ATTACH DATABASE ? AS archive', (path,))
+        try:
+            for statement in ARCHIVE_SCHEMA:
+                conn.execute(statement)
+
+            # the copy only locks the archive, writers of the hot database
+            # keep going
+            conn.execute('BEGIN')
+            try:
+                conn.execute('''
+                    INSERT OR IGNORE INTO archive.transactions SELECT * FROM main.transactions WHERE substr(timestamp, 1, 7) = ?
+                ''', (month,))
+            except BaseException:
+                conn.execute('ROLLBACK')
+                raise
+            conn.execute('COMMIT')
+
+            # the catalog and the hot database change together, so readers
+            # see every row either in the hot database or in the archive
+            with self._transaction() as cursor:
+                cursor.execute('''
+                    SELECT COUNT(*), MIN(id), MAX(id), MIN(timestamp), MAX(timestamp) FROM archive.transactions
+                ''')
+                cursor.execute('''
+                    INSERT OR REPLACE INTO transaction_partitions
+                    (month, file, transactions, first_id, last_id, first_timestamp, last_timestamp)
+                    VALUES (?, ?, ?, ?, ?, ?, ?)
+                ''', (month, file) + cursor.fetchone())
+                cursor.execute('''
+                    DELETE FROM main.transactions WHERE substr(timestamp, 1, 7) = ?
+                    AND id IN (SELECT id FROM archive.transactions)
+                ''', (month,))
+                moved = cursor.rowcount
+        finally:
+            conn.execute('DETACH DATABASE archive')
+
+        archive = sqlite3.connect(path)
+        try:
+            archive.execute('VACUUM')
+        finally:
+            archive.close()
+        os.chmod(path, 0o444)
+
+        return moved
+
+    def claim_idempotency_key(self, key, fingerprint, now, expired_before, retained_after=None):
+        # True when this request now owns the key: it was not there, or the
+        # request holding it never finished (claimed before 'expired_before'
+        # and without a transaction). The keys created before 'retained_after'
+        # are deleted first
+        with self._transaction() as cursor:
+            if retained_after is not None:
+                cursor.execute('DELETE FROM idempotency_keys WHERE created_at < ?', (retained_after,))
+            cursor.execute('''
+                INSERT INTO idempotency_keys (key, fingerprint, created_at) VALUES (?, ?, ?)
+                ON CONFLICT (key) DO UPDATE SET fingerprint = excluded.fingerprint, created_at = excluded.created_at
+                WHERE response IS NULL AND transaction_id IS NULL AND created_at < ?
+            ''', (key, fingerprint, now, expired_before))
+            return cursor.rowcount == 1
+
+    def get_idempotency_key(self, key):
+        # (fingerprint, response, created_at, transaction_id) or None
+        cursor = self._connection().cursor()
+        cursor.execute('SELECT fingerprint, response, created_at, transaction_id FROM idempotency_keys WHERE key = ?', (key,))
+        return cursor.fetchone()
+
+    def complete_idempotency_key(self, key, response):
+        with self._transaction() as cursor:
+            cursor.execute('UPDATE idempotency_keys SET response = ? WHERE key = ?', (response, key))
+
+    def release_idempotency_key(self, key):
+        # the request failed, so a retry with the same key runs again (unless
+        # its transaction was inserted)
+        with self._transaction() as cursor:
+            cursor.execute('DELETE FROM idempotency_keys WHERE key = ? AND response IS NULL AND transaction_id IS NULL', (key,))
+
+    def get_transaction(self, transaction_id):
+        for _, conn in reversed(self._sources(transaction_id - 1)):
+            cursor = conn.cursor()
+            cursor.execute('SELECT * FROM transactions WHERE id = ?', (transaction_id,))
+            t = cursor.fetchone()
+            if t is not None:
+                return transaction_dict(t)
+        return None
+
+    def take_tokens(self, key, cost, rate, burst, now):
+        # takes 'cost' tokens from the bucket of 'key' (refilled with 'rate'
+        # tokens per second, holding up to 'burst'): returns 0 when they were
+        # taken, or how many seconds until there are enough of them
+        with self._transaction() as cursor:
+            cursor.execute('''
+                INSERT INTO rate_limits (key, tokens, updated_at) VALUES (?, ?, ?)
+                ON CONFLICT (key) DO UPDATE SET
+                    tokens = MIN(?, tokens + MAX(0, excluded.updated_at - updated_at) * ?) - ?,
+                    updated_at = excluded.updated_at
+                WHERE MIN(?, tokens + MAX(0, excluded.updated_at - updated_at) * ?) >= ?
+            ''', (key, burst - cost, now, burst, rate, cost, burst, rate, cost))
+            if cursor.rowcount == 1:
+                return 0
+
+            cursor.execute('SELECT tokens, updated_at FROM rate_limits WHERE key = ?', (key,))
+            tokens, updated_at = cursor.fetchone()
+            return (cost - min(burst, tokens + max(0, now - updated_at) * rate)) / rate
+
+    def insert_rate_table(self, fetched_at, base_currency, currencies, rates):
+        # 'currencies' is a comma separated list and 'rates' the packed rates
+        with self._transaction() as cursor:
+            cursor.execute('''
+                INSERT INTO rate_history (fetched_at, base_currency, currencies, rates) VALUES (?, ?, ?, ?)
+            ''', (fetched_at, base_currency, currencies, rates))
+            return cursor.lastrowid
+
+    def get_rate_history_index(self, after_id=0):
+        # (id, fetched_at) of the recorded rates tables
+        cursor = self._connection().cursor()
+        cursor.execute('SELECT id, fetched_at FROM rate_history WHERE id > ? ORDER BY id', (after_id,))
+        return cursor.fetchall()
+
+    def get_rate_table(self, rate_table_id):
+        cursor = self._connection().cursor()
+        cursor.execute('''
+            SELECT fetched_at, base_currency, currencies, rates FROM rate_history WHERE id = ?
+        ''', (rate_table_id,))
+        return cursor.fetchone()
+
+def _iter_rows(conn, sql, params, chunk_size):
+    cursor = conn.cursor()
+    cursor.execute(sql, params)
+
+    try:
+        while True:
+            rows = cursor.fetchmany(chunk_size)
+            if not rows:
+                break
+            yield from rows
+    finally:
+        cursor.close()
+
+def transaction_dict(t):
+    return {
+        'transaction_id': t[0],
+        'user_id': t[1],
+        'source_currency': t[2],
+        'amount': t[3],
+        'target_currency': t[4],
+        'converted_amount': t[5],
+        'exchange_rate': t[6],
+        'timestamp': t[7]
+    }
 
 if __name__ == '__main__':
     dbh = DatabaseHandler()
     dbh.create_tables()
+
+    if sys.argv[1:] == ['backfill-summaries']:
+        print(f'{dbh.backfill_summaries()} summaries rebuilt')
+    elif sys.argv[1:2] == ['archive']:
+        for month, moved in dbh.archive_partitions(*sys.argv[2:3]):
+            print(f'{month}: {moved} transactions archived')
+
+    dbh.close()
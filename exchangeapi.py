@@ -1,78 +1,377 @@
-import requests, os
+import os, atexit, json, time, hashlib, math, threading, logging
 from datetime import datetime
-from flask import Flask, request, abort, jsonify
+from flask import Flask, Response, request, abort, jsonify, g
 from flask_restful import Api, Resource
-from database import DatabaseHandler
+from database import DatabaseHandler, SUMMARY_GROUPS
+from ratecache import RateCache, RatePrefetcher
+from journal import WriteBehindWriter
+from ratehistory import RateHistory, parse_timestamp, format_timestamp
+from array import array
+from conversion import to_minor_units, from_minor_units, convert_amount, convert_many
+from ledger import FORMATS as EXPORT_FORMATS, export_blocks
+from idempotency import IdempotencyStore, IdempotencyKeyInProgress, IdempotencyKeyReused
+from ratelimit import RequestShed, UserRateLimiter, AdmissionController
+from providers import PROVIDERS, CircuitBreaker, HedgedRateSource, RateProviderError
+from metrics import REGISTRY, REQUEST_DURATION, STAGE_DURATION, DB_DURATION, REJECTED_REQUESTS, \
+                    IDEMPOTENT_REPLAYS, SHED_REQUESTS, CallbackMetric, SamplingProfiler
+
+logger = logging.getLogger(__name__)
 
 app = Flask(__name__)
 api = Api(app)
 
-# database setup
-dbh = DatabaseHandler()
-dbh.create_tables()
+# the app components are built by configure(), from the environment
+# variables (at import) or from the settings given to create_app. Building
+# them touches no file and starts no thread or connection: start() does that
+# once in each process, so workers forked from a master that imported the
+# app (and maybe warmed up its rate cache) each open their own
+settings = {}
+dbh = None
+transaction_writer = None
+rate_source = None
+idempotency_store = None
+rate_limit_dbh = None
+rate_limiter = None
+admission_controller = None
+rate_history = None
+rate_cache = None
+profiler = None
+rate_prefetcher = None
+
+# the process that ran start()
+started_pid = None
+start_lock = threading.Lock()
+
+def optional_int(name):
+    return int(settings[name]) if settings.get(name) else None
+
+def configure(database_file=None, **overrides):
+    global settings, dbh, transaction_writer, rate_source, idempotency_store, rate_limit_dbh, rate_limiter, \
+           admission_controller, rate_history, rate_cache, profiler, rate_prefetcher
+    settings = dict(os.environ, **{ name: str(value) for name, value in overrides.items() })
+
+    # database setup (DATABASE_FILE, or currency_conversion.db in the
+    # working directory)
+    dbh = DatabaseHandler(database_file or settings.get('DATABASE_FILE'))
+
+    # optional write-behind mode (enabled by setting WRITE_BEHIND_JOURNAL to
+    # the journal file path): transactions are journaled and queued, and a
+    # background writer group commits them to the database
+    transaction_writer = None
+    if settings.get('WRITE_BEHIND_JOURNAL'):
+        transaction_writer = WriteBehindWriter(dbh, settings['WRITE_BEHIND_JOURNAL'],
+                                               batch_size=int(settings.get('WRITE_BEHIND_BATCH_SIZE', 500)),
+                                               flush_interval=float(settings.get('WRITE_BEHIND_FLUSH_INTERVAL', 0.05)),
+                                               fsync=settings.get('WRITE_BEHIND_FSYNC') == '1')
+
+    # rate providers setup: RATE_PROVIDERS lists them in priority order, the
+    # next one is called when the previous fails or is slower than
+    # RATE_HEDGE_DELAY seconds, and a provider failing
+    # CIRCUIT_BREAKER_FAILURES times in a row is not called for
+    # CIRCUIT_BREAKER_COOLDOWN seconds
+    rate_source = HedgedRateSource([
+        PROVIDERS[name.strip()](timeout=float(settings.get('UPSTREAM_TIMEOUT', 5)),
+                                breaker=CircuitBreaker(int(settings.get('CIRCUIT_BREAKER_FAILURES', 5)),
+                                                       float(settings.get('CIRCUIT_BREAKER_COOLDOWN', 30))))
+        for name in settings.get('RATE_PROVIDERS', 'exchangeratesapi').split(',')
+    ], hedge_delay=float(settings.get('RATE_HEDGE_DELAY', 0.5)))
+
+    # responses of the conversions sent with an Idempotency-Key, so retries
+    # do not convert (and persist) again, kept for IDEMPOTENCY_RETENTION hours
+    idempotency_store = IdempotencyStore(dbh,
+                                         cache_size=int(settings.get('IDEMPOTENCY_CACHE_SIZE', 10000)),
+                                         wait_timeout=float(settings.get('IDEMPOTENCY_WAIT_TIMEOUT', 10)),
+                                         claim_timeout=float(settings.get('IDEMPOTENCY_CLAIM_TIMEOUT', 60)),
+                                         retention=float(settings.get('IDEMPOTENCY_RETENTION', 24)) * 3600)
+
+    # per user rate limit of the conversion endpoints (enabled by setting
+    # RATE_LIMIT_PER_SECOND): RATE_LIMIT_BURST requests may come at once,
+    # the buckets are kept in the database (or in RATE_LIMIT_DATABASE) so
+    # every worker process shares them
+    rate_limit_dbh = DatabaseHandler(settings['RATE_LIMIT_DATABASE']) if settings.get('RATE_LIMIT_DATABASE') else dbh
+    rate_limiter = None
+    if settings.get('RATE_LIMIT_PER_SECOND'):
+        rate_limiter = UserRateLimiter(rate_limit_dbh, float(settings['RATE_LIMIT_PER_SECOND']),
+                                       float(settings.get('RATE_LIMIT_BURST', 10)))
+
+    # conversions are refused (429, retry after ADMISSION_RETRY_AFTER
+    # seconds) while this process serves ADMISSION_MAX_INFLIGHT of them, or
+    # while ADMISSION_MAX_UPSTREAM_WAITERS of them wait on the external API
+    admission_controller = AdmissionController(max_inflight=optional_int('ADMISSION_MAX_INFLIGHT'),
+                                               max_upstream_waiters=optional_int('ADMISSION_MAX_UPSTREAM_WAITERS'),
+                                               retry_after=float(settings.get('ADMISSION_RETRY_AFTER', 1)))
+
+    # every fetched rates table is recorded, for point-in-time conversions
+    rate_history = RateHistory(dbh)
+
+    # rate tables cache setup (the whole 'rates' table of a base currency is
+    # kept for RATE_CACHE_TTL seconds, and may be served up to
+    # RATE_MAX_STALENESS seconds past it while being refreshed)
+    rate_cache = RateCache(ttl=float(settings.get('RATE_CACHE_TTL', 60)),
+                           max_staleness=float(settings.get('RATE_MAX_STALENESS', 300)),
+                           on_store=rate_history.record)
+
+    # opt-in sampling profiler of the serving threads (enabled by setting
+    # PROFILE_SAMPLING_INTERVAL, in seconds), its stats are at /debug/profile
+    # and written to PROFILE_DUMP_FILE (if set) on shutdown
+    profiler = None
+    if settings.get('PROFILE_SAMPLING_INTERVAL'):
+        profiler = SamplingProfiler(float(settings['PROFILE_SAMPLING_INTERVAL']))
+
+    # background refresher of the rates table (enabled by setting
+    # RATE_PREFETCH=1): every pair is served from the RATE_BASE_CURRENCY
+    # table, so it is the only one kept warm
+    rate_prefetcher = None
+    if settings.get('RATE_PREFETCH') == '1':
+        rate_prefetcher = RatePrefetcher(rate_cache, fetch_rates, [settings.get('RATE_BASE_CURRENCY', 'EUR')])
+
+def create_app(database_file=None, **settings):
+    # app factory, e.g. gunicorn "exchangeapi:create_app()": 'settings' take
+    # precedence over the environment variables of the same name (see the
+    # README). There is a single app per process, so it must be called
+    # before the app serves anything
+    if started_pid is not None:
+        raise RuntimeError('the app was already started, create_app must be called before serving')
+
+    configure(database_file, **settings)
+    return app
+
+def start():
+    # per process initialization, run by the first request of a worker (or
+    # by the post_fork hook of the server): the schema migrations, the
+    # write-behind writer and the background threads
+    global started_pid
+    if started_pid == os.getpid():
+        return
+
+    with start_lock:
+        if started_pid == os.getpid():
+            return
+
+        dbh.create_tables()
+        atexit.register(dbh.close)
+        if rate_limit_dbh is not dbh:
+            rate_limit_dbh.create_tables()
+            atexit.register(rate_limit_dbh.close)
+
+        if transaction_writer is not None:
+            transaction_writer.start()
+            atexit.register(transaction_writer.close)
+
+        atexit.register(rate_source.close)
+
+        if profiler is not None:
+            profiler.start()
+            if settings.get('PROFILE_DUMP_FILE'):
+                atexit.register(dump_profile)
+
+        if rate_prefetcher is not None:
+            rate_prefetcher.start()
+
+        started_pid = os.getpid()
+
+def dump_profile():
+    with open(settings['PROFILE_DUMP_FILE'], 'w') as f:
+        f.write(profiler.dump())
+
+def warmup():
+    # pre-fork hook of the master process: loads the rates tables once, so
+    # every worker forked after it starts with a warm rate cache instead of
+    # each one calling the external API on its first conversion. Nothing it
+    # opens is left for the workers to inherit
+    dbh.create_tables()
+    base_currency = settings.get('RATE_BASE_CURRENCY', 'EUR')
+    try:
+        rate_cache.get(base_currency, fetch_rates)
+    except Exception as e:
+        logger.warning(f'failure warming up the {base_currency} rates: {e}')
+    finally:
+        rate_source.close()
+        dbh.close()
+
+configure()
+
+REGISTRY.register(CallbackMetric('exchangeapi_provider_circuit_open', 'Whether calls to a rate provider are cut off',
+                                 'gauge', 'provider',
+                                 lambda: { p.name: int(p.breaker.state == 'open') for p in rate_source.providers }))
+
+REGISTRY.register(CallbackMetric('exchangeapi_admission_requests', 'Conversion requests being served, and waiting on the external API',
+                                 'gauge', 'state', lambda: admission_controller.stats()))
+
+REGISTRY.register(CallbackMetric('exchangeapi_rate_cache_events_total', 'Rate cache lookups and refreshes, by result',
+                                 'counter', 'result',
+                                 lambda: { k: v for k, v in rate_cache.stats().items() if k != 'entries' }))
 
 ALLOWED_USERS = { 1, 'John Doe',
                   2, 'Jane Doe' }
 
+MAX_TRANSACTIONS_PAGE_SIZE = 1000
+
+# a batch is inserted in a single write transaction, holding the database
+# write lock meanwhile
+MAX_BATCH_SIZE = 1000
+
+def fetch_rates(base_currency):
+    return rate_source.fetch(base_currency)
+
 def get_exchange_rate(source_currency, target_currency):
-    access_key = os.environ['ACCESS_KEY']
+    # the free API key allows only rates based on EUR, so every pair is
+    # computed from the single RATE_BASE_CURRENCY table (A -> B is
+    # rates[B] / rates[A]) and no extra call is made per currency
+    base_currency = settings.get('RATE_BASE_CURRENCY', 'EUR')
 
-    # the free API key allows only rates based on EUR (remove this
-    # check if your key is supports other currencies)
-    if source_currency != 'EUR':
-        raise ValueError(f"free API supports only EUR as base currency")
+    with admission_controller.upstream_wait():
+        rate_table = rate_cache.get(base_currency, fetch_rates)
 
-    api_url = f'http://api.exchangeratesapi.io/latest?base={source_currency}&access_key={access_key}'
+    return rate_table.cross_rates().rate(source_currency, target_currency)
 
-    response = requests.get(api_url)
+def validate_conversion(user_id, amount, source_currency, target_currency):
+    # returns the error message of an invalid conversion request (a list or
+    # a dict is not hashable, so it is checked before the allowed users)
+    if not isinstance(user_id, (int, str)) or user_id not in ALLOWED_USERS:
+        return f'user id "{user_id}" is not allowed!'
 
-    if response.status_code == 200:
-        response_data = response.json()
+    if not isinstance(source_currency, str) or not isinstance(target_currency, str):
+        return 'Invalid currency. source_currency and target_currency must be strings'
 
-        if response_data['success'] is True:
-            exchange_rate = response_data['rates'].get(target_currency)
-            if exchange_rate is not None:
-                return exchange_rate
-            else:
-                # 'target_currency' not found in the response data
-                raise ValueError(f"exchange rate for {target_currency} not available in the external API response")
-        else:
-            # API call failed by value
-            raise ValueError(f"failure getting exchange rate on the external API. Error: {response_data['error']}")
-    else:
-        # API call failed by status code
-        raise RuntimeError(f"failure getting exchange rate on the external API. Status Code: {response.status_code}")
+    if not isinstance(amount, (int, float)) or amount <= 0:
+        return 'Invalid amount. amount must be a positive number'
+
+    try:
+        to_minor_units(amount, source_currency)
+    except ValueError as e:
+        return f'{e}'
+
+    return None
+
+def admitted(handler, conversions=None):
+    # runs 'handler' unless the process is overloaded or a user is over its
+    # rate limit, which is a 429 telling when to retry. 'conversions' is
+    # {user id: conversions of the request}, each one costs a token
+    if conversions is None:
+        conversions = {}
+
+    try:
+        with admission_controller.admit():
+            if rate_limiter is not None:
+                for user_id, cost in conversions.items():
+                    try:
+                        rate_limiter.check(user_id, cost)
+                    except ValueError as e:
+                        REJECTED_REQUESTS.inc(reason='invalid_request')
+                        abort(400, description=f'{e}')
+            return handler()
+    except RequestShed as e:
+        SHED_REQUESTS.inc(reason=e.reason)
+        abort(429, description=f'{e}', retry_after=math.ceil(e.retry_after))
+
+def conversions_per_user(items):
+    # how many conversions each allowed user has in the request (the other
+    # users are refused by validate_conversion anyway)
+    conversions = {}
+    for item in items:
+        user_id = item.get('user_id') if isinstance(item, dict) else None
+        if isinstance(user_id, (int, str)) and user_id in ALLOWED_USERS:
+            conversions[user_id] = conversions.get(user_id, 0) + 1
+    return conversions
+
+MAX_IDEMPOTENCY_KEY_LENGTH = 255
 
 class ConversionResource(Resource):
     def post(self):
+        data = request.get_json(silent=True)
+        return admitted(self.convert_once, conversions_per_user([data]))
+
+    def convert_once(self):
+        idempotency_key = request.headers.get('Idempotency-Key')
+        if idempotency_key is None:
+            return self.convert()
+
+        if not 0 < len(idempotency_key) <= MAX_IDEMPOTENCY_KEY_LENGTH:
+            REJECTED_REQUESTS.inc(reason='invalid_request')
+            abort(400, description=f'Invalid Idempotency-Key. it must have 1 to {MAX_IDEMPOTENCY_KEY_LENGTH} characters')
+
+        # the same key must come with the same request
+        request_data = json.dumps([request.get_json(silent=True), request.args.get('at')], sort_keys=True)
+        fingerprint = hashlib.sha256(request_data.encode('UTF-8')).hexdigest()
+
+        try:
+            response, replayed = idempotency_store.run(idempotency_key, fingerprint,
+                                                       lambda: self.convert(idempotency_key)[0])
+        except IdempotencyKeyReused as e:
+            REJECTED_REQUESTS.inc(reason='idempotency_key_reused')
+            abort(422, description=f'{e}')
+        except IdempotencyKeyInProgress as e:
+            REJECTED_REQUESTS.inc(reason='idempotency_key_in_progress')
+            abort(409, description=f'{e}')
+
+        if replayed:
+            IDEMPOTENT_REPLAYS.inc()
+            return response, 200, { 'Idempotent-Replayed': 'true' }
+        return response, 200
+
+    def convert(self, idempotency_key=None):
+        started = time.perf_counter()
+
         data = request.get_json()
+        if not isinstance(data, dict):
+            REJECTED_REQUESTS.inc(reason='invalid_request')
+            abort(400, description='Invalid conversion. expected a json object')
+
         user_id = data.get('user_id')
         source_currency = data.get('source_currency')
         target_currency = data.get('target_currency')
         amount = data.get('amount')
 
-        if user_id not in ALLOWED_USERS:
-            abort(400, description=f'user id "{user_id}" is not allowed!')
+        error = validate_conversion(user_id, amount, source_currency, target_currency)
+        if error is not None:
+            REJECTED_REQUESTS.inc(reason='invalid_request')
+            abort(400, description=error)
 
-        if not isinstance(amount, (int, float)) or amount <= 0:
-            abort(400, description='Invalid amount. amount must be a positive number')
+        STAGE_DURATION.observe(time.perf_counter() - started, stage='parse')
+
+        at = request.args.get('at')
+        if at is not None:
+            return self.convert_at(at, user_id, source_currency, target_currency, amount)
 
         try:
-            exchange_rate = get_exchange_rate(source_currency, target_currency)
+            with STAGE_DURATION.time(stage='rate_lookup'):
+                exchange_rate = get_exchange_rate(source_currency, target_currency)
+        except RateProviderError as e:
+            # the external API failed, not the request
+            REJECTED_REQUESTS.inc(reason='upstream_failure')
+            abort(502, description=f'{e}')
         except Exception as e:
+            REJECTED_REQUESTS.inc(reason='rate_unavailable')
             abort(400, description=f'{e}')
 
-        converted_amount = amount * exchange_rate
+        converted_amount = convert_amount(amount, exchange_rate, source_currency, target_currency)
 
         timestamp = datetime.now().strftime("%Y-%m-%dT%H:%M:%SZ")
 
-        transaction_id = dbh.insert_transaction(user_id,
-                                                source_currency,
-                                                amount,
-                                                target_currency,
-                                                converted_amount,
-                                                exchange_rate,
-                                                timestamp)
+        persist_started = time.perf_counter()
+        if transaction_writer is not None:
+            transaction_id = transaction_writer.submit(user_id,
+                                                       source_currency,
+                                                       amount,
+                                                       target_currency,
+                                                       converted_amount,
+                                                       exchange_rate,
+                                                       timestamp)
+        else:
+            with DB_DURATION.time(operation='insert_transaction'):
+                transaction_id = dbh.insert_transaction(user_id,
+                                                        source_currency,
+                                                        amount,
+                                                        target_currency,
+                                                        converted_amount,
+                                                        exchange_rate,
+                                                        timestamp,
+                                                        idempotency_key=idempotency_key)
+        STAGE_DURATION.observe(time.perf_counter() - persist_started, stage='persist')
+
+        # the response is serialized after returning, see record_request_duration
+        g.handler_finished = time.perf_counter()
 
         return {
             'transaction_id': transaction_id,
@@ -85,13 +384,275 @@ class ConversionResource(Resource):
             'timestamp': timestamp
         }, 200
 
+    def convert_at(self, at, user_id, source_currency, target_currency, amount):
+        # point-in-time conversion, answered from the recorded rates tables
+        # (nothing is persisted, so there is no transaction id)
+        try:
+            timestamp = parse_timestamp(at)
+            rate_table = rate_history.table_at(timestamp)
+            exchange_rate = rate_table.cross_rates().rate(source_currency, target_currency)
+        except ValueError as e:
+            REJECTED_REQUESTS.inc(reason='rate_unavailable')
+            abort(400, description=f'{e}')
+
+        return {
+            'transaction_id': None,
+            'user_id': user_id,
+            'source_currency': source_currency,
+            'amount': amount,
+            'target_currency': target_currency,
+            'converted_amount': convert_amount(amount, exchange_rate, source_currency, target_currency),
+            'exchange_rate': exchange_rate,
+            'timestamp': format_timestamp(timestamp),
+            'rate_timestamp': format_timestamp(rate_table.fetched_at)
+        }, 200
+
+def convert_batch(items, rates):
+    # the converted amount of each item: the amounts of a currency pair are
+    # converted together in minor units (convert_many), the same exact
+    # rounding as convert_amount
+    positions = {}
+    for position, item in enumerate(items):
+        positions.setdefault((item['source_currency'], item['target_currency']), []).append(position)
+
+    converted_amounts = [None] * len(items)
+    for (source_currency, target_currency), pair_positions in positions.items():
+        exchange_rate = rates[pair_positions[0]]
+        try:
+            amounts = array('q', (to_minor_units(items[p]['amount'], source_currency) for p in pair_positions))
+            converted = [from_minor_units(units, target_currency)
+                         for units in convert_many(amounts, exchange_rate, source_currency, target_currency)]
+        except OverflowError:
+            # minor units beyond 64 bits
+            converted = [convert_amount(items[p]['amount'], exchange_rate, source_currency, target_currency)
+                         for p in pair_positions]
+
+        for p, converted_amount in zip(pair_positions, converted):
+            converted_amounts[p] = converted_amount
+
+    return converted_amounts
+
+class BatchConversionResource(Resource):
+    def post(self):
+        # every conversion of the batch counts against the rate limit of its
+        # user
+        data = request.get_json(silent=True)
+        if isinstance(data, list) and len(data) > MAX_BATCH_SIZE:
+            REJECTED_REQUESTS.inc(reason='invalid_request')
+            abort(400, description=f'Invalid batch. a batch has at most {MAX_BATCH_SIZE} conversions')
+        return admitted(self.convert, conversions_per_user(data if isinstance(data, list) else []))
+
+    def convert(self):
+        data = request.get_json()
+
+        if not isinstance(data, list) or not data:
+            abort(400, description='Invalid batch. expected a non-empty list of conversions')
+
+        # validate every item, then resolve each distinct currency pair once
+        errors = {}
+        exchange_rates = {}
+        for index, item in enumerate(data):
+            if not isinstance(item, dict):
+                errors[index] = 'Invalid conversion. expected an object'
+                continue
+
+            error = validate_conversion(item.get('user_id'), item.get('amount'),
+                                        item.get('source_currency'), item.get('target_currency'))
+            if error is not None:
+                errors[index] = error
+                continue
+
+            pair = (item.get('source_currency'), item.get('target_currency'))
+            if pair not in exchange_rates:
+                try:
+                    exchange_rates[pair] = get_exchange_rate(*pair)
+                except Exception as e:
+                    exchange_rates[pair] = e
+
+            if isinstance(exchange_rates[pair], Exception):
+                errors[index] = f'{exchange_rates[pair]}'
+
+        valid = [(index, item) for index, item in enumerate(data) if index not in errors]
+
+        rates = [exchange_rates[(item['source_currency'], item['target_currency'])] for _, item in valid]
+        converted_amounts = convert_batch([item for _, item in valid], rates)
+
+        timestamp = datetime.now().strftime("%Y-%m-%dT%H:%M:%SZ")
+
+        # persist the whole batch in a single transaction
+        rows = [(item['user_id'], item['source_currency'], item['amount'], item['target_currency'],
+                 converted_amount, exchange_rate, timestamp)
+                for (_, item), converted_amount, exchange_rate in zip(valid, converted_amounts, rates)]
+        if not rows:
+            transaction_ids = []
+        elif transaction_writer is not None:
+            transaction_ids = transaction_writer.submit_many(rows)
+        else:
+            with DB_DURATION.time(operation='insert_transactions'):
+                transaction_ids = dbh.insert_transactions(rows)
+
+        results = [{ 'error': errors[index] } if index in errors else None for index in range(len(data))]
+        for (index, _), transaction_id, row in zip(valid, transaction_ids, rows):
+            results[index] = {
+                'transaction_id': transaction_id,
+                'user_id': row[0],
+                'source_currency': row[1],
+                'amount': row[2],
+                'target_currency': row[3],
+                'converted_amount': row[4],
+                'exchange_rate': row[5],
+                'timestamp': row[6]
+            }
+
+        return { 'results': results }, 200
+
+def get_int_arg(name, minimum):
+    value = request.args.get(name)
+    if value is None:
+        return None
+
+    try:
+        value = int(value)
+    except ValueError:
+        value = None
+
+    if value is None or value < minimum:
+        abort(400, description=f'Invalid {name}. {name} must be an integer greater than or equal to {minimum}')
+
+    return value
+
 class UserTransactionsResource(Resource):
     def get(self, user_id):
-        # retrieve user transactions from the database
-        transactions = dbh.get_user_transactions(user_id)
+        limit = get_int_arg('limit', 1)
+        after = get_int_arg('after', 0)
+        stream = request.args.get('stream')
+
+        if stream is not None:
+            return self.stream(user_id, after, stream)
+
+        if limit is None and after is None:
+            # retrieve user transactions from the database
+            with DB_DURATION.time(operation='get_user_transactions'):
+                transactions = dbh.get_user_transactions(user_id)
+
+            # return the transactions as a list of dictionaries
+            return jsonify(transactions)
+
+        # keyset pagination, the id of the last transaction of a full page
+        # is the 'after' value of the next page
+        limit = min(limit or MAX_TRANSACTIONS_PAGE_SIZE, MAX_TRANSACTIONS_PAGE_SIZE)
+        with DB_DURATION.time(operation='get_user_transactions'):
+            transactions = dbh.get_user_transactions(user_id, limit=limit, after=after)
+
+        response = jsonify(transactions)
+        if len(transactions) == limit:
+            response.headers['X-Next-After'] = str(transactions[-1]['transaction_id'])
+        return response
+
+    def stream(self, user_id, after, stream):
+        transactions = dbh.iter_user_transactions(user_id, after=after)
+
+        if stream == 'ndjson':
+            lines = (json.dumps(t) + '\n' for t in transactions)
+            return Response(lines, mimetype='application/x-ndjson')
+
+        if stream == 'json':
+            return Response(stream_json_list(transactions), mimetype='application/json')
+
+        abort(400, description='Invalid stream. stream must be "json" or "ndjson"')
+
+class UserTransactionsSummaryResource(Resource):
+    def get(self, user_id):
+        group_by = [g for g in request.args.get('group_by', 'day,pair').split(',') if g]
+        invalid = [g for g in group_by if g not in SUMMARY_GROUPS]
+        if invalid:
+            abort(400, description=f'Invalid group_by. groups must be in: {", ".join(SUMMARY_GROUPS)}')
+
+        since = get_day_arg('since')
+        until = get_day_arg('until')
+
+        with DB_DURATION.time(operation='get_user_summary'):
+            summaries = dbh.get_user_summary(user_id, group_by, since=since, until=until)
+
+        return jsonify(summaries)
+
+class TransactionsExportResource(Resource):
+    def get(self):
+        # every user's transactions at once, only when explicitly enabled
+        if settings.get('TRANSACTIONS_EXPORT_ENDPOINT') != '1':
+            abort(404, description='transactions export disabled, set TRANSACTIONS_EXPORT_ENDPOINT=1 to enable it')
+
+        export_format = request.args.get('format', 'csv')
+        if export_format not in EXPORT_FORMATS:
+            abort(400, description=f'Invalid format. format must be in: {", ".join(EXPORT_FORMATS)}')
+
+        since = get_timestamp_arg('since')
+        until = get_timestamp_arg('until')
+
+        # the whole ledger, streamed one chunk of rows at a time
+        blocks = export_blocks(dbh, export_format, since, until)
+        if export_format == 'csv':
+            return Response(blocks, mimetype='text/csv')
+        return Response(blocks, mimetype='application/octet-stream')
+
+def get_timestamp_arg(name):
+    value = request.args.get(name)
+    if value is None:
+        return None
+
+    try:
+        return parse_timestamp(value)
+    except ValueError as e:
+        abort(400, description=f'{e}')
+
+def get_day_arg(name):
+    value = request.args.get(name)
+    if value is None:
+        return None
+
+    try:
+        datetime.strptime(value, '%Y-%m-%d')
+    except ValueError:
+        abort(400, description=f'Invalid {name}. {name} must be a YYYY-MM-DD date')
+
+    return value
+
+def stream_json_list(items):
+    yield '['
+    for i, item in enumerate(items):
+        yield (',' if i else '') + json.dumps(item)
+    yield ']'
+
+@app.before_request
+def start_worker():
+    start()
+
+@app.before_request
+def start_request_timer():
+    g.request_started = time.perf_counter()
+
+@app.after_request
+def record_request_duration(response):
+    now = time.perf_counter()
+    if 'handler_finished' in g:
+        STAGE_DURATION.observe(now - g.handler_finished, stage='serialize')
+    if 'request_started' in g:
+        endpoint = request.url_rule.rule if request.url_rule is not None else 'unmatched'
+        REQUEST_DURATION.observe(now - g.request_started, endpoint=endpoint)
+    return response
+
+@app.route('/metrics')
+def metrics():
+    return Response(REGISTRY.render(), content_type='text/plain; version=0.0.4; charset=utf-8')
 
-        # return the transactions as a list of dictionaries
-        return jsonify(transactions)
+@app.route('/debug/profile')
+def profile():
+    if profiler is None:
+        abort(404, description='profiler disabled, set PROFILE_SAMPLING_INTERVAL to enable it')
+    return Response(profiler.dump(), content_type='text/plain; charset=utf-8')
 
 api.add_resource(ConversionResource, '/convert')
+api.add_resource(BatchConversionResource, '/convert/batch')
 api.add_resource(UserTransactionsResource, '/transactions/<int:user_id>')
+api.add_resource(UserTransactionsSummaryResource, '/transactions/<int:user_id>/summary')
+api.add_resource(TransactionsExportResource, '/transactions/export')
@@ -0,0 +1,124 @@
+import collections, json, threading, time
+
+class IdempotencyKeyInProgress(RuntimeError):
+    pass
+
+class IdempotencyKeyReused(ValueError):
+    pass
+
+class IdempotencyStore:
+    def __init__(self, dbh, cache_size=10000, wait_timeout=10, claim_timeout=60, poll_interval=0.05, retention=None):
+        self.dbh = dbh
+        self.cache_size = cache_size
+        # seconds a key is kept after its request (None keeps it forever):
+        # an older key is forgotten, and used again it runs a new request
+        self.retention = retention
+        # how long a duplicate waits for the request holding its key
+        self.wait_timeout = wait_timeout
+        # a key claimed this many seconds ago without a response belongs to
+        # a request that died, and may be claimed again
+        self.claim_timeout = claim_timeout
+        self.poll_interval = poll_interval
+        # completed keys: {key: (fingerprint, response, created_at)}, least
+        # recently used first
+        self._responses = collections.OrderedDict()
+        # keys being executed by this process
+        self._inflight = {}
+        self._lock = threading.Lock()
+
+    def run(self, key, fingerprint, execute):
+        # returns (response, replayed): the stored response of 'key', or the
+        # one returned by 'execute' (called at most once per key, across
+        # threads and processes). 'fingerprint' identifies the request, a
+        # key reused for a different request is an error
+        deadline = time.monotonic() + self.wait_timeout
+        while True:
+            stored = self._lookup(key)
+            if stored is not None:
+                stored_fingerprint, response = stored
+                if stored_fingerprint != fingerprint:
+                    raise IdempotencyKeyReused(f'Idempotency-Key "{key}" was already used with a different request')
+                if response is not None:
+                    return response, True
+
+            with self._lock:
+                inflight = self._inflight.get(key)
+                leader = inflight is None
+                if leader:
+                    inflight = self._inflight[key] = threading.Event()
+
+            if not leader:
+                # a duplicate in this process: wait for the first request,
+                # then read its response (or run, if it failed)
+                if not inflight.wait(max(0.0, deadline - time.monotonic())):
+                    raise IdempotencyKeyInProgress(f'a request with Idempotency-Key "{key}" is still in progress')
+                continue
+
+            try:
+                now = time.time()
+                retained_after = None if self.retention is None else now - self.retention
+                if self.dbh.claim_idempotency_key(key, fingerprint, now, now - self.claim_timeout, retained_after):
+                    return self._execute(key, fingerprint, execute, now), False
+            finally:
+                with self._lock:
+                    del self._inflight[key]
+                inflight.set()
+
+            # the key is held by another process, poll for its response
+            if time.monotonic() >= deadline:
+                raise IdempotencyKeyInProgress(f'a request with Idempotency-Key "{key}" is still in progress')
+            time.sleep(self.poll_interval)
+
+    def _execute(self, key, fingerprint, execute, created_at):
+        try:
+            response = execute()
+        except BaseException:
+            self.dbh.release_idempotency_key(key)
+            raise
+
+        self.dbh.complete_idempotency_key(key, json.dumps(response))
+        self._remember(key, fingerprint, response, created_at)
+        return response
+
+    def _expired(self, created_at):
+        return self.retention is not None and created_at < time.time() - self.retention
+
+    def _lookup(self, key):
+        with self._lock:
+            stored = self._responses.get(key)
+            if stored is not None:
+                fingerprint, response, created_at = stored
+                if not self._expired(created_at):
+                    self._responses.move_to_end(key)
+                    return fingerprint, response
+                del self._responses[key]
+
+        stored = self.dbh.get_idempotency_key(key)
+        if stored is None:
+            return None
+
+        fingerprint, response, created_at, transaction_id = stored
+        if self._expired(created_at):
+            # deleted by the next claim
+            return None
+        if response is None:
+            if transaction_id is None:
+                return fingerprint, None
+
+            # the request inserted its transaction but its response was lost
+            # (the process died, or storing it failed): it is rebuilt from
+            # the transaction, as running the request again would insert a
+            # second one
+            response = self.dbh.get_transaction(transaction_id)
+            self.dbh.complete_idempotency_key(key, json.dumps(response))
+        else:
+            response = json.loads(response)
+        self._remember(key, fingerprint, response, created_at)
+        return fingerprint, response
+
+    def _remember(self, key, fingerprint, response, created_at):
+        with self._lock:
+            self._responses[key] = (fingerprint, response, created_at)
+            self._responses.move_to_end(key)
+            if len(self._responses) > self.cache_size:
+                self._responses.popitem(last=False)
@@ -0,0 +1,215 @@
+import fcntl, glob, itertools, json, os, queue, threading, time, logging
+
+logger = logging.getLogger(__name__)
+
+# numbers the journal segments of every writer of this process
+_segment_numbers = itertools.count()
+
+class _Segment:
+    # a journal file of a single process, locked by it until every record in
+    # it is committed (then it is deleted), so another process replays only
+    # the segments of processes that died
+    def __init__(self, path):
+        self.path = path
+        # locked under a name replay() does not look at, then renamed: a
+        # process replaying at that moment never sees it unlocked (and would
+        # delete it, leaving this writer appending to a deleted file)
+        directory, name = os.path.split(path)
+        unpublished = os.path.join(directory, f'.{name}.new')
+        self.file = open(unpublished, 'a', encoding='UTF-8')
+        fcntl.flock(self.file.fileno(), fcntl.LOCK_EX)
+        os.rename(unpublished, path)
+        self.pending = 0
+
+    def remove(self):
+        os.remove(self.path)
+        self.file.close()
+
+class WriteBehindWriter:
+    def __init__(self, dbh, journal_file, batch_size=500, flush_interval=0.05, id_block_size=1000, fsync=False):
+        self.dbh = dbh
+        self.journal_file = journal_file
+        # a batch is committed once it has 'batch_size' records or once its
+        # oldest record waited 'flush_interval' seconds
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.id_block_size = id_block_size
+        self.fsync = fsync
+        self.batches_written = 0
+        self.records_written = 0
+        self._queue = queue.Queue()
+        self._ids = iter(())
+        self._pending = 0
+        # the segment new records are appended to (opened on the first one
+        # after each committed batch), and the older ones with records not
+        # committed yet
+        self._segment = None
+        self._segments = []
+        self._running = False
+        self._lock = threading.Lock()
+        self._drained = threading.Condition(self._lock)
+        self._thread = None
+        self._closing = False
+
+    def start(self):
+        # records left in the journals of dead processes (by a crash) are
+        # written before anything new is accepted
+        self.replay()
+
+        with self._lock:
+            self._running = True
+        self._thread = threading.Thread(target=self._run, name='write-behind-writer', daemon=True)
+        self._thread.start()
+        return self
+
+    def replay(self):
+        # every process writes its own segments ("<journal_file>.<pid>-<n>"),
+        # those still locked belong to a live writer and are left alone
+        paths = sorted(glob.glob(glob.escape(self.journal_file) + '.[0-9]*-[0-9]*'))
+        if os.path.exists(self.journal_file):
+            paths.insert(0, self.journal_file)
+
+        replayed = 0
+        for path in paths:
+            try:
+                journal = open(path, 'r+', encoding='UTF-8')
+            except FileNotFoundError:
+                continue
+
+            with journal:
+                try:
+                    fcntl.flock(journal.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except BlockingIOError:
+                    continue
+
+                records = []
+                for line in journal:
+                    try:
+                        records.append(tuple(json.loads(line)))
+                    except ValueError:
+                        # a partially written last line, its request never
+                        # got a response
+                        logger.warning(f'ignoring corrupted journal record: {line!r}')
+
+                for i in range(0, len(records), self.batch_size):
+                    self.dbh.write_transactions(records[i:i + self.batch_size])
+                replayed += len(records)
+
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+
+        return replayed
+
+    def submit(self, user_id, source_currency, amount, target_currency, converted_amount, exchange_rate, timestamp):
+        return self.submit_many([(user_id, source_currency, amount, target_currency,
+                                  converted_amount, exchange_rate, timestamp)])[0]
+
+    def submit_many(self, transactions):
+        # 'transactions' is a list of (user_id, source_currency, amount,
+        # target_currency, converted_amount, exchange_rate, timestamp), the
+        # allocated transaction ids are returned
+        with self._lock:
+            if not self._running or self._closing:
+                raise RuntimeError('write-behind writer is not running')
+
+            records = [(self._next_id(),) + tuple(t) for t in transactions]
+
+            segment = self._segment
+            if segment is None:
+                segment = self._segment = _Segment(f'{self.journal_file}.{os.getpid()}-{next(_segment_numbers)}')
+                self._segments.append(segment)
+
+            segment.file.write(''.join(json.dumps(r) + '\n' for r in records))
+            segment.file.flush()
+            if self.fsync:
+                os.fsync(segment.file.fileno())
+
+            segment.pending += len(records)
+            self._pending += len(records)
+
+            for record in records:
+                self._queue.put((record, segment))
+
+        return [record[0] for record in records]
+
+    def flush(self, timeout=None):
+        # waits until every submitted record is committed to the database
+        with self._drained:
+            return self._drained.wait_for(lambda: self._pending == 0, timeout)
+
+    def close(self, timeout=None):
+        # shutdown hook: commits everything still queued
+        if self._thread is None:
+            return
+
+        with self._lock:
+            self._closing = True
+        self._queue.put(None)
+        self._thread.join(timeout)
+        self._thread = None
+
+        with self._lock:
+            self._running = False
+            for segment in self._segments:
+                segment.file.close()
+            self._segment = None
+            self._segments = []
+
+    # must be called with self._lock held
+    def _next_id(self):
+        transaction_id = next(self._ids, None)
+        if transaction_id is None:
+            self._ids = iter(self.dbh.reserve_transaction_ids(self.id_block_size))
+            transaction_id = next(self._ids)
+        return transaction_id
+
+    def _run(self):
+        stopping = False
+        while not stopping:
+            record = self._queue.get()
+            if record is None:
+                break
+
+            batch = [record]
+            deadline = time.monotonic() + self.flush_interval
+            while len(batch) < self.batch_size:
+                try:
+                    record = self._queue.get(timeout=max(0, deadline - time.monotonic()))
+                except queue.Empty:
+                    break
+                if record is None:
+                    stopping = True
+                    break
+                batch.append(record)
+
+            self._write(batch)
+
+    def _write(self, batch):
+        while True:
+            try:
+                self.dbh.write_transactions([record for record, _ in batch])
+                break
+            except Exception as e:
+                # the records are safe in the journal, keep retrying
+                logger.error(f'failure writing {len(batch)} transactions, retrying: {e}')
+                time.sleep(self.flush_interval)
+
+        with self._lock:
+            self.batches_written += 1
+            self.records_written += len(batch)
+            self._pending -= len(batch)
+            for _, segment in batch:
+                segment.pending -= 1
+
+            # new records go to a new segment, and the segments fully in the
+            # database are deleted, so the journal does not grow under a
+            # steady load that never drains the queue
+            self._segment = None
+            for segment in [s for s in self._segments if s.pending == 0]:
+                segment.remove()
+                self._segments.remove(segment)
+
+            if self._pending == 0:
+                self._drained.notify_all()
@@ -0,0 +1,197 @@
+import argparse, csv, io, json, struct, sys
+from array import array
+from database import DatabaseHandler
+from datetime import datetime
+from ratehistory import parse_timestamp
+
+# bulk export and import of the whole transactions table, as CSV or as a
+# compact columnar binary format. both are written and read one chunk at a
+# time, so the memory used does not grow with the ledger:
+#
+#   python ledger.py export --format columnar --since 2023-07-01 --until 2023-08-01 --output july.col
+#   python ledger.py import --format columnar july.col
+#
+# the columnar format is a magic header followed by blocks, each one holding
+# the next rows column by column (little endian):
+#
+#   <row count: uint32>  (0 ends the file)
+#   integer columns: row count int64 values
+#   float columns: row count float64 values
+#   text columns: dictionary encoded, <dictionary size: uint32>,
+#     <value lengths: uint32 each>, <utf-8 values>, <index typecode: 1 byte>,
+#     <row count indexes into the dictionary>
+#   value columns: like text columns, with the values JSON encoded (user_id
+#     may be an integer, a text like "John Doe" or NULL)
+
+COLUMNS = ('id', 'user_id', 'source_currency', 'amount', 'target_currency', 'converted_amount', 'exchange_rate', 'timestamp')
+COLUMN_TYPES = ('q', 'value', 'text', 'd', 'text', 'd', 'd', 'text')
+
+MAGIC = b'EXAPICOL\x02'
+FORMATS = ('csv', 'columnar')
+
+def _to_little_endian(values):
+    if sys.byteorder == 'big':
+        values.byteswap()
+    return values.tobytes()
+
+def _from_little_endian(typecode, data):
+    values = array(typecode)
+    values.frombytes(data)
+    if sys.byteorder == 'big':
+        values.byteswap()
+    return values
+
+def csv_blocks(chunks):
+    # yields the CSV text, the header and then one block per chunk
+    buffer = io.StringIO()
+    writer = csv.writer(buffer, lineterminator='\n')
+    writer.writerow(COLUMNS)
+    for rows in chunks:
+        writer.writerows(rows)
+        yield buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+
+    if buffer.tell():
+        yield buffer.getvalue()
+
+def columnar_blocks(chunks):
+    # yields the columnar file, the magic header and then one block per chunk
+    yield MAGIC
+    for rows in chunks:
+        parts = [struct.pack('<I', len(rows))]
+        for column, typecode in zip(zip(*rows), COLUMN_TYPES):
+            if typecode not in ('text', 'value'):
+                parts.append(_to_little_endian(array(typecode, column)))
+                continue
+
+            dictionary = {}
+            indexes = [dictionary.setdefault(value, len(dictionary)) for value in column]
+            if typecode == 'value':
+                encoded = [json.dumps(value).encode('UTF-8') for value in dictionary]
+            else:
+                encoded = [value.encode('UTF-8') for value in dictionary]
+            index_typecode = 'B' if len(encoded) <= 0x100 else 'H' if len(encoded) <= 0x10000 else 'I'
+
+            parts.append(struct.pack('<I', len(encoded)))
+            parts.append(_to_little_endian(array('I', map(len, encoded))))
+            parts.extend(encoded)
+            parts.append(index_typecode.encode())
+            parts.append(_to_little_endian(array(index_typecode, indexes)))
+
+        yield b''.join(parts)
+
+    yield struct.pack('<I', 0)
+
+def read_csv_rows(f):
+    # yields the rows of a CSV export ('f' is a text file)
+    reader = csv.reader(f)
+    if tuple(next(reader, ())) != COLUMNS:
+        raise ValueError(f'Invalid CSV export. expected the header {",".join(COLUMNS)}')
+
+    for t in reader:
+        yield (int(t[0]), _parse_user_id(t[1]), t[2], float(t[3]), t[4], float(t[5]), float(t[6]), t[7])
+
+def _parse_user_id(value):
+    # CSV has no types: an integer user id, a text one ("John Doe") or NULL
+    # (an empty field)
+    if value == '':
+        return None
+    try:
+        return int(value)
+    except ValueError:
+        return value
+
+def read_columnar_chunks(f):
+    # yields the rows of a columnar export as lists of tuples, one list per
+    # block ('f' is a binary file)
+    if f.read(len(MAGIC)) != MAGIC:
+        raise ValueError('Invalid columnar export. unknown file header')
+
+    def read(size):
+        data = f.read(size)
+        if len(data) != size:
+            raise ValueError('Invalid columnar export. the file is truncated')
+        return data
+
+    while True:
+        count, = struct.unpack('<I', read(4))
+        if count == 0:
+            return
+
+        columns = []
+        for typecode in COLUMN_TYPES:
+            if typecode not in ('text', 'value'):
+                columns.append(_from_little_endian(typecode, read(8 * count)))
+                continue
+
+            size, = struct.unpack('<I', read(4))
+            lengths = _from_little_endian('I', read(4 * size))
+            dictionary = [read(length).decode('UTF-8') for length in lengths]
+            if typecode == 'value':
+                dictionary = [json.loads(value) for value in dictionary]
+            index_typecode = read(1).decode()
+            indexes = _from_little_endian(index_typecode, read(array(index_typecode).itemsize * count))
+            columns.append([dictionary[i] for i in indexes])
+
+        yield list(zip(*columns))
+
+def stored_timestamp(timestamp):
+    # the transaction timestamps are written in the local time of the server
+    # (datetime.now(), with a 'Z' suffix), so a unix timestamp is compared
+    # with them on the same clock
+    return datetime.fromtimestamp(timestamp).strftime("%Y-%m-%dT%H:%M:%SZ")
+
+def export_blocks(dbh, format, since=None, until=None, chunk_size=10000):
+    # 'since' (inclusive) and 'until' (exclusive) are unix timestamps
+    since = None if since is None else stored_timestamp(since)
+    until = None if until is None else stored_timestamp(until)
+
+    chunks = dbh.iter_transaction_chunks(since, until, chunk_size)
+    return csv_blocks(chunks) if format == 'csv' else columnar_blocks(chunks)
+
+def import_file(dbh, f, format, batch_size=50000):
+    # 'f' is a binary file, returns how many transactions were imported
+    if format == 'csv':
+        rows = read_csv_rows(io.TextIOWrapper(f, encoding='UTF-8', newline=''))
+    else:
+        rows = (t for rows in read_columnar_chunks(f) for t in rows)
+
+    return dbh.import_transactions(rows, batch_size)
+
+def main():
+    parser = argparse.ArgumentParser(description='bulk export and import of the transactions table')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    export_parser = subparsers.add_parser('export')
+    export_parser.add_argument('--format', choices=FORMATS, default='csv')
+    export_parser.add_argument('--since', type=parse_timestamp, help='unix timestamp or ISO 8601 (inclusive)')
+    export_parser.add_argument('--until', type=parse_timestamp, help='unix timestamp or ISO 8601 (exclusive)')
+    export_parser.add_argument('--output', help='default: stdout')
+
+    import_parser = subparsers.add_parser('import')
+    import_parser.add_argument('--format', choices=FORMATS, default='csv')
+    import_parser.add_argument('--batch-size', type=int, default=50000, help='rows per transaction (default: 50000)')
+    import_parser.add_argument('file')
+
+    args = parser.parse_args()
+
+    dbh = DatabaseHandler()
+    dbh.create_tables()
+    try:
+        if args.command == 'export':
+            out = open(args.output, 'wb') if args.output else sys.stdout.buffer
+            try:
+                for block in export_blocks(dbh, args.format, args.since, args.until):
+                    out.write(block.encode('UTF-8') if isinstance(block, str) else block)
+            finally:
+                if args.output:
+                    out.close()
+        else:
+            with open(args.file, 'rb') as f:
+                print(f'{import_file(dbh, f, args.format, args.batch_size)} transactions imported')
+    finally:
+        dbh.close()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,188 @@
+import bisect, collections, sys, threading, time, traceback
+from contextlib import contextmanager
+
+# minimal Prometheus-style metrics: observing is a bisect and an increment
+# under a lock, rendering is done only when /metrics is scraped
+
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+def _format_labels(labelnames, values, extra=()):
+    pairs = list(zip(labelnames, values)) + list(extra)
+    if not pairs:
+        return ''
+    escaped = (str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, v in pairs)
+    return '{' + ','.join(f'{name}="{value}"' for (name, _), value in zip(pairs, escaped)) + '}'
+
+def _format_value(value):
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+class Counter:
+    type = 'counter'
+
+    def __init__(self, name, help, labelnames=()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self._values = collections.defaultdict(int)
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1, **labels):
+        key = tuple(labels[name] for name in self.labelnames)
+        with self._lock:
+            self._values[key] += amount
+
+    def value(self, **labels):
+        return self._values.get(tuple(labels[name] for name in self.labelnames), 0)
+
+    def render(self):
+        with self._lock:
+            values = sorted(self._values.items())
+        for key, value in values:
+            yield f'{self.name}{_format_labels(self.labelnames, key)} {_format_value(value)}'
+
+class Histogram:
+    type = 'histogram'
+
+    def __init__(self, name, help, labelnames=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(sorted(buckets))
+        # per label values: [count per bucket (last one is +Inf), sum]
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, **labels):
+        key = tuple(labels[name] for name in self.labelnames)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            entry = self._values.get(key)
+            if entry is None:
+                entry = self._values[key] = [[0] * (len(self.buckets) + 1), 0.0]
+            entry[0][index] += 1
+            entry[1] += value
+
+    @contextmanager
+    def time(self, **labels):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, **labels)
+
+    def count(self, **labels):
+        entry = self._values.get(tuple(labels[name] for name in self.labelnames))
+        return sum(entry[0]) if entry else 0
+
+    def render(self):
+        with self._lock:
+            values = sorted((key, (list(counts), total)) for key, (counts, total) in self._values.items())
+        for key, (counts, total) in values:
+            cumulative = 0
+            for bound, count in zip(self.buckets + ('+Inf',), counts):
+                cumulative += count
+                labels = _format_labels(self.labelnames, key, [('le', bound)])
+                yield f'{self.name}_bucket{labels} {cumulative}'
+            yield f'{self.name}_sum{_format_labels(self.labelnames, key)} {_format_value(total)}'
+            yield f'{self.name}_count{_format_labels(self.labelnames, key)} {cumulative}'
+
+class CallbackMetric:
+    # values read from somewhere else (e.g. the rate cache counters) when
+    # the metrics are rendered, 'callback' returns {label value: value}
+    def __init__(self, name, help, type, labelname, callback):
+        self.name = name
+        self.help = help
+        self.type = type
+        self.labelname = labelname
+        self.callback = callback
+
+    def render(self):
+        for label, value in sorted(self.callback().items()):
+            yield f'{self.name}{_format_labels((self.labelname,), (label,))} {_format_value(value)}'
+
+class Registry:
+    def __init__(self):
+        self.metrics = []
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def counter(self, name, help, labelnames=()):
+        return self.register(Counter(name, help, labelnames))
+
+    def histogram(self, name, help, labelnames=(), buckets=DEFAULT_BUCKETS):
+        return self.register(Histogram(name, help, labelnames, buckets))
+
+    def render(self):
+        lines = []
+        for metric in self.metrics:
+            lines.append(f'# HELP {metric.name} {metric.help}')
+            lines.append(f'# TYPE {metric.name} {metric.type}')
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+REGISTRY = Registry()
+
+REQUEST_DURATION = REGISTRY.histogram('exchangeapi_request_duration_seconds',
+                                      'Total request time', ['endpoint'])
+STAGE_DURATION = REGISTRY.histogram('exchangeapi_stage_duration_seconds',
+                                    'Time spent in each stage of a conversion request', ['stage'])
+UPSTREAM_DURATION = REGISTRY.histogram('exchangeapi_upstream_duration_seconds',
+                                       'External API call time, by provider', ['provider'])
+DB_DURATION = REGISTRY.histogram('exchangeapi_db_duration_seconds',
+                                 'Database call time', ['operation'])
+UPSTREAM_ERRORS = REGISTRY.counter('exchangeapi_upstream_errors_total',
+                                   'Failed external API calls, by provider and status code', ['provider', 'status_code'])
+REJECTED_REQUESTS = REGISTRY.counter('exchangeapi_rejected_requests_total',
+                                     'Rejected conversion requests, by reason', ['reason'])
+IDEMPOTENT_REPLAYS = REGISTRY.counter('exchangeapi_idempotent_replays_total',
+                                      'Conversion requests answered with the stored response of their Idempotency-Key')
+SHED_REQUESTS = REGISTRY.counter('exchangeapi_shed_requests_total',
+                                 'Conversion requests refused with 429, by reason', ['reason'])
+
+class SamplingProfiler(threading.Thread):
+    # samples the stack of every other thread each 'interval' seconds,
+    # counting how often each function is on top of a stack (self) and
+    # anywhere in a stack (total)
+    def __init__(self, interval=0.005):
+        super().__init__(name='sampling-profiler', daemon=True)
+        self.interval = interval
+        self.samples = 0
+        self._self_counts = collections.Counter()
+        self._total_counts = collections.Counter()
+        self._lock = threading.Lock()
+        self._stop_event = threading.Event()
+
+    def run(self):
+        while not self._stop_event.wait(self.interval):
+            self.sample()
+
+    def sample(self):
+        own_id = threading.get_ident()
+        for thread_id, frame in sys._current_frames().items():
+            if thread_id == own_id:
+                continue
+
+            stack = traceback.extract_stack(frame)
+            if not stack:
+                continue
+            functions = [f'{f.name} ({f.filename}:{f.lineno})' for f in stack]
+            with self._lock:
+                self.samples += 1
+                self._self_counts[functions[-1]] += 1
+                self._total_counts.update(set(f'{f.name} ({f.filename})' for f in stack))
+
+    def dump(self, limit=30):
+        with self._lock:
+            samples = self.samples or 1
+            lines = [f'{self.samples} samples every {self.interval}s', '', 'self%   function']
+            lines += [f'{100 * count / samples:5.1f}   {function}' for function, count in self._self_counts.most_common(limit)]
+            lines += ['', 'total%  function']
+            lines += [f'{100 * count / samples:5.1f}   {function}' for function, count in self._total_counts.most_common(limit)]
+        return '\n'.join(lines) + '\n'
+
+    def stop(self, timeout=None):
+        self._stop_event.set()
+        if self.is_alive():
+            self.join(timeout)
@@ -0,0 +1,229 @@
+import os, threading, time, logging
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+import requests
+from metrics import UPSTREAM_DURATION, UPSTREAM_ERRORS
+
+logger = logging.getLogger(__name__)
+
+class RateProviderError(RuntimeError):
+    # the external API could not provide the rates (as opposed to a
+    # currency it does not know)
+    pass
+
+class CircuitBreaker:
+    def __init__(self, failure_threshold=5, cooldown=30):
+        self.failure_threshold = failure_threshold
+        self.cooldown = cooldown
+        self.failures = 0
+        self.opened_at = None
+        self._probing = False
+        self._lock = threading.Lock()
+
+    @property
+    def state(self):
+        if self.opened_at is None:
+            return 'closed'
+        if time.monotonic() - self.opened_at >= self.cooldown:
+            return 'half_open'
+        return 'open'
+
+    def allow(self):
+        with self._lock:
+            if self.opened_at is None:
+                return True
+
+            # after the cooldown a single trial call is let through
+            if time.monotonic() - self.opened_at >= self.cooldown and not self._probing:
+                self._probing = True
+                return True
+
+            return False
+
+    def record_success(self):
+        with self._lock:
+            self.failures = 0
+            self.opened_at = None
+            self._probing = False
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            self._probing = False
+            if self.failures >= self.failure_threshold:
+                self.opened_at = time.monotonic()
+
+    def reset(self):
+        self.record_success()
+
+class RateProvider:
+    name = None
+
+    def __init__(self, timeout=5.0, breaker=None):
+        self.timeout = timeout
+        self.breaker = CircuitBreaker() if breaker is None else breaker
+        self._session = None
+        self._session_pid = None
+
+    @property
+    def session(self):
+        # keep-alive connections to the provider, opened on first use in each
+        # process (a forked worker must not share the sockets of its parent)
+        if self._session is None or self._session_pid != os.getpid():
+            self._session = requests.Session()
+            self._session_pid = os.getpid()
+        return self._session
+
+    def close(self):
+        if self._session is not None and self._session_pid == os.getpid():
+            self._session.close()
+        self._session = None
+
+    def url(self, base_currency):
+        raise NotImplementedError
+
+    def parse(self, response):
+        # returns the 'rates' table of a response (also used with the
+        # httpx responses of the asyncio path)
+        raise NotImplementedError
+
+    def fetch(self, base_currency):
+        started = time.perf_counter()
+        try:
+            response = self.session.get(self.url(base_currency), timeout=self.timeout)
+        except requests.Timeout:
+            UPSTREAM_ERRORS.inc(provider=self.name, status_code='timeout')
+            raise RateProviderError(f"failure getting exchange rate on the external API. Timeout after {self.timeout}s")
+        except requests.RequestException as e:
+            UPSTREAM_ERRORS.inc(provider=self.name, status_code='connection_error')
+            raise RateProviderError(f"failure getting exchange rate on the external API. Error: {e}")
+        finally:
+            UPSTREAM_DURATION.observe(time.perf_counter() - started, provider=self.name)
+
+        return self.parse(response)
+
+    def _check_status(self, response):
+        if response.status_code != 200:
+            # API call failed by status code
+            UPSTREAM_ERRORS.inc(provider=self.name, status_code=str(response.status_code))
+            raise RateProviderError(f"failure getting exchange rate on the external API. Status Code: {response.status_code}")
+
+class ExchangeRatesApiProvider(RateProvider):
+    # api.exchangeratesapi.io (EXCHANGE_API_URL and ACCESS_KEY are read on
+    # every call)
+    name = 'exchangeratesapi'
+
+    def url(self, base_currency):
+        access_key = os.environ['ACCESS_KEY']
+
+        api_base_url = os.environ.get('EXCHANGE_API_URL', 'http://api.exchangeratesapi.io')
+        return f'{api_base_url}/latest?base={base_currency}&access_key={access_key}'
+
+    def parse(self, response):
+        self._check_status(response)
+
+        response_data = response.json()
+        if response_data['success'] is True:
+            return response_data['rates']
+
+        # API call failed by value
+        UPSTREAM_ERRORS.inc(provider=self.name, status_code='api_error')
+        raise RateProviderError(f"failure getting exchange rate on the external API. Error: {response_data['error']}")
+
+class ErApiProvider(RateProvider):
+    # open.er-api.com, no access key needed (ERAPI_URL is read on every call)
+    name = 'erapi'
+
+    def url(self, base_currency):
+        api_base_url = os.environ.get('ERAPI_URL', 'https://open.er-api.com')
+        return f'{api_base_url}/v6/latest/{base_currency}'
+
+    def parse(self, response):
+        self._check_status(response)
+
+        response_data = response.json()
+        if response_data.get('result') == 'success':
+            return response_data['rates']
+
+        UPSTREAM_ERRORS.inc(provider=self.name, status_code='api_error')
+        raise RateProviderError(f"failure getting exchange rate on the external API. Error: {response_data.get('error-type')}")
+
+PROVIDERS = {
+    ExchangeRatesApiProvider.name: ExchangeRatesApiProvider,
+    ErApiProvider.name: ErApiProvider
+}
+
+class HedgedRateSource:
+    def __init__(self, providers, hedge_delay=0.5):
+        # 'providers' in priority order, the next one is called when the
+        # previous fails or has not answered after 'hedge_delay' seconds
+        self.providers = list(providers)
+        self.hedge_delay = hedge_delay
+        self.hedges = 0
+        self._executor = None
+        self._executor_pid = None
+
+    def _executor_for_process(self):
+        # the threads of a ThreadPoolExecutor do not survive a fork, so each
+        # process starts its own
+        if self._executor is None or self._executor_pid != os.getpid():
+            self._executor = ThreadPoolExecutor(max_workers=max(4, 2 * len(self.providers)),
+                                                thread_name_prefix='rate-provider')
+            self._executor_pid = os.getpid()
+        return self._executor
+
+    def fetch(self, base_currency):
+        candidates = iter(self.providers)
+        executor = self._executor_for_process()
+        pending = set()
+        errors = []
+
+        def call_next():
+            # allow() is asked only of the provider about to be called, as
+            # it takes the trial call of a half-open breaker
+            for provider in candidates:
+                if provider.breaker.allow():
+                    pending.add(executor.submit(self._call, provider, base_currency))
+                    return True
+            return False
+
+        if not call_next():
+            raise RateProviderError("failure getting exchange rate on the external API. Every provider is unavailable (circuit open)")
+
+        while pending:
+            done, _ = wait(pending, timeout=self.hedge_delay, return_when=FIRST_COMPLETED)
+            if not done:
+                # hedge: the providers called so far are slow
+                if call_next():
+                    self.hedges += 1
+                continue
+
+            for future in done:
+                pending.discard(future)
+                try:
+                    # the first answer wins, the slower calls are left to
+                    # finish in background (still feeding their breakers)
+                    return future.result()
+                except Exception as e:
+                    errors.append(e)
+                    call_next()
+
+        raise errors[0]
+
+    def _call(self, provider, base_currency):
+        try:
+            rates = provider.fetch(base_currency)
+        except Exception as e:
+            provider.breaker.record_failure()
+            logger.warning(f'failure getting rates from {provider.name}: {e}')
+            raise
+        provider.breaker.record_success()
+        return rates
+
+    def close(self):
+        # the next fetch opens everything again (e.g. in a worker forked
+        # after the master warmed up the rates)
+        if self._executor is not None and self._executor_pid == os.getpid():
+            self._executor.shutdown(wait=False)
+        self._executor = None
+        for provider in self.providers:
+            provider.close()
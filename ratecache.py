@@ -0,0 +1,220 @@
+import os, queue, threading, time, logging
+from crossrates import CrossRateMatrix
+
+logger = logging.getLogger(__name__)
+
+class RateTable:
+    def __init__(self, base_currency, rates, fetched_at=None):
+        self.base_currency = base_currency
+        self.rates = rates
+        self.fetched_at = time.time() if fetched_at is None else fetched_at
+        self._cross_rates = None
+
+    def age(self):
+        return max(0.0, time.time() - self.fetched_at)
+
+    def cross_rates(self):
+        # built once per fetched table, every lookup after that is O(1)
+        if self._cross_rates is None:
+            self._cross_rates = CrossRateMatrix(self.base_currency, self.rates)
+        return self._cross_rates
+
+class _Flight:
+    def __init__(self):
+        self.event = threading.Event()
+        self.result = None
+        self.error = None
+
+class RateCache:
+    def __init__(self, ttl, max_staleness=0, retry_interval=5, on_store=None):
+        self.ttl = ttl
+        # called with every fetched table (e.g. to record its history)
+        self.on_store = on_store
+        # how many seconds past the TTL an expired table may still be served
+        # while it is being refreshed (or while the upstream is failing)
+        self.max_staleness = max_staleness
+        self.retry_interval = retry_interval
+        self.hits = 0
+        self.stale_hits = 0
+        self.misses = 0
+        self.refreshes = 0
+        self.refresh_errors = 0
+        self._entries = {}
+        self._inflight = {}
+        self._failed_at = {}
+        # background revalidations, run one at a time by a single thread
+        # (started on first use in each process)
+        self._revalidations = None
+        self._revalidator_pid = None
+        self._queued = set()
+        self._lock = threading.Lock()
+
+    def get(self, base_currency, fetch):
+        table, revalidate = self.get_cached(base_currency)
+        if table is None:
+            return self.refresh(base_currency, fetch)
+
+        if revalidate:
+            # stale-while-revalidate: the stale table is served while it
+            # is refreshed in the background
+            self._schedule_revalidation(base_currency, fetch)
+        return table
+
+    def get_cached(self, base_currency):
+        # returns the table that can be served without calling the upstream
+        # (None on a miss) and whether it should be refreshed in background
+        with self._lock:
+            table = self._entries.get(base_currency)
+            if table is not None:
+                age = table.age()
+                if age < self.ttl:
+                    self.hits += 1
+                    return table, False
+
+                if age < self.ttl + self.max_staleness:
+                    self.stale_hits += 1
+                    return table, self._should_revalidate(base_currency)
+
+            self.misses += 1
+            return None, True
+
+    def refresh(self, base_currency, fetch):
+        with self._lock:
+            # single-flight: only the first caller for a base currency calls
+            # the upstream, concurrent callers wait for its result
+            flight = self._inflight.get(base_currency)
+            leader = flight is None
+            if leader:
+                flight = _Flight()
+                self._inflight[base_currency] = flight
+
+        if not leader:
+            flight.event.wait()
+            if flight.error is not None:
+                raise flight.error
+            return flight.result
+
+        try:
+            table = self.store(base_currency, fetch(base_currency))
+        except Exception as e:
+            flight.error = e
+            self.store_failure(base_currency)
+            raise
+        else:
+            flight.result = table
+            return table
+        finally:
+            with self._lock:
+                del self._inflight[base_currency]
+            flight.event.set()
+
+    def store(self, base_currency, rates):
+        table = RateTable(base_currency, rates)
+        with self._lock:
+            self._entries[base_currency] = table
+            self._failed_at.pop(base_currency, None)
+            self.refreshes += 1
+
+        if self.on_store is not None:
+            try:
+                self.on_store(table)
+            except Exception as e:
+                logger.error(f'failure handling the fetched {base_currency} rates: {e}')
+        return table
+
+    def store_failure(self, base_currency):
+        # a failed refresh is not retried in background for retry_interval
+        with self._lock:
+            self.refresh_errors += 1
+            self._failed_at[base_currency] = time.monotonic()
+
+    def peek(self, base_currency):
+        with self._lock:
+            return self._entries.get(base_currency)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._failed_at.clear()
+
+    def stats(self):
+        with self._lock:
+            return {
+                'hits': self.hits,
+                'stale_hits': self.stale_hits,
+                'misses': self.misses,
+                'refreshes': self.refreshes,
+                'refresh_errors': self.refresh_errors,
+                'entries': len(self._entries)
+            }
+
+    # must be called with self._lock held
+    def _should_revalidate(self, base_currency):
+        if base_currency in self._inflight:
+            return False
+        failed_at = self._failed_at.get(base_currency)
+        return failed_at is None or time.monotonic() - failed_at >= self.retry_interval
+
+    def _schedule_revalidation(self, base_currency, fetch):
+        with self._lock:
+            if self._revalidations is None or self._revalidator_pid != os.getpid():
+                # the thread (and the revalidations queued in the parent) do
+                # not survive a fork
+                self._revalidations = queue.SimpleQueue()
+                self._revalidator_pid = os.getpid()
+                self._queued = set()
+                threading.Thread(target=self._run_revalidations, args=(self._revalidations,),
+                                 name='rate-revalidator', daemon=True).start()
+
+            if base_currency in self._queued:
+                return
+            self._queued.add(base_currency)
+            self._revalidations.put((base_currency, fetch))
+
+    def _run_revalidations(self, revalidations):
+        while True:
+            base_currency, fetch = revalidations.get()
+            try:
+                self._revalidate(base_currency, fetch)
+            finally:
+                with self._lock:
+                    self._queued.discard(base_currency)
+
+    def _revalidate(self, base_currency, fetch):
+        try:
+            self.refresh(base_currency, fetch)
+        except Exception as e:
+            logger.warning(f'failure refreshing {base_currency} rates, serving stale table: {e}')
+
+class RatePrefetcher(threading.Thread):
+    def __init__(self, cache, fetch, currencies, interval=None, lead=None):
+        super().__init__(name='rate-prefetcher', daemon=True)
+        self.cache = cache
+        self.fetch = fetch
+        self.currencies = list(currencies)
+        # tables are reloaded once they are 'lead' seconds away from expiring
+        self.lead = cache.ttl * 0.2 if lead is None else lead
+        self.interval = max(cache.ttl * 0.1, 0.05) if interval is None else interval
+        self._stop_event = threading.Event()
+
+    def run(self):
+        while not self._stop_event.is_set():
+            self.prefetch()
+            self._stop_event.wait(self.interval)
+
+    def prefetch(self):
+        for base_currency in self.currencies:
+            table = self.cache.peek(base_currency)
+            if table is not None and table.age() < self.cache.ttl - self.lead:
+                continue
+
+            try:
+                self.cache.refresh(base_currency, self.fetch)
+            except Exception as e:
+                # keep the last known good table, the next round will retry
+                logger.warning(f'failure prefetching {base_currency} rates: {e}')
+
+    def stop(self, timeout=None):
+        self._stop_event.set()
+        if self.is_alive():
+            self.join(timeout)
@@ -0,0 +1,122 @@
+import bisect, collections, threading
+from array import array
+from datetime import datetime, timezone
+from ratecache import RateTable
+from conversion import convert_amount
+
+def parse_timestamp(value):
+    # unix seconds or ISO 8601 (UTC when no offset is given)
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        pass
+
+    try:
+        parsed = datetime.fromisoformat(value)
+    except (TypeError, ValueError):
+        raise ValueError(f'Invalid timestamp "{value}". expected unix seconds or ISO 8601')
+
+    if parsed.tzinfo is None:
+        parsed = parsed.replace(tzinfo=timezone.utc)
+    return parsed.timestamp()
+
+def format_timestamp(timestamp):
+    return datetime.fromtimestamp(timestamp, timezone.utc).strftime("%Y-%m-%dT%H:%M:%SZ")
+
+class RateHistory:
+    def __init__(self, dbh, cache_size=64):
+        self.dbh = dbh
+        self.cache_size = cache_size
+        # time index of the recorded tables, sorted by fetch time, searched
+        # with bisect
+        self._times = array('d')
+        self._ids = array('q')
+        self._last_id = 0
+        # decoded tables, least recently used first
+        self._tables = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def record(self, table):
+        currencies = sorted(table.rates)
+        rates = array('d', (table.rates[c] for c in currencies))
+        self.dbh.insert_rate_table(table.fetched_at, table.base_currency, ','.join(currencies), rates.tobytes())
+
+    def table_at(self, timestamp):
+        # the last table fetched at or before 'timestamp'
+        with self._lock:
+            if not self._times or timestamp >= self._times[-1]:
+                self._sync()
+
+            i = bisect.bisect_right(self._times, timestamp) - 1
+            if i < 0:
+                raise ValueError(f'no exchange rates recorded at or before {format_timestamp(timestamp)}')
+
+            return self._table(self._ids[i])
+
+    def rate_at(self, timestamp, source_currency, target_currency):
+        return self.table_at(timestamp).cross_rates().rate(source_currency, target_currency)
+
+    def reprice(self, conversions):
+        # 'conversions' is a list of (timestamp, source_currency,
+        # target_currency, amount), the result is a list of (exchange_rate,
+        # converted_amount) in the same order, or None when no rate applies.
+        # the conversions are walked in time order along the index, so each
+        # table is searched and decoded only once, and the amounts are
+        # converted (and rounded) exactly as /convert does
+        conversions = list(conversions)
+        order = sorted(range(len(conversions)), key=lambda i: conversions[i][0])
+        results = [None] * len(conversions)
+
+        with self._lock:
+            self._sync()
+
+            position = 0
+            cross_rates = None
+            rates_position = -1
+            for i in order:
+                timestamp, source_currency, target_currency, amount = conversions[i]
+
+                while position < len(self._times) and self._times[position] <= timestamp:
+                    position += 1
+                if position == 0:
+                    continue
+
+                if position - 1 != rates_position:
+                    rates_position = position - 1
+                    cross_rates = self._table(self._ids[rates_position]).cross_rates()
+
+                try:
+                    exchange_rate = cross_rates.rate(source_currency, target_currency)
+                    results[i] = (exchange_rate, convert_amount(amount, exchange_rate, source_currency, target_currency))
+                except ValueError:
+                    # an unknown currency, or an amount with more decimals
+                    # than its currency
+                    continue
+
+        return results
+
+    # must be called with self._lock held
+    def _sync(self):
+        # adds the tables recorded since the last sync (by any process)
+        for rate_table_id, fetched_at in self.dbh.get_rate_history_index(self._last_id):
+            i = bisect.bisect_right(self._times, fetched_at)
+            self._times.insert(i, fetched_at)
+            self._ids.insert(i, rate_table_id)
+            self._last_id = max(self._last_id, rate_table_id)
+
+    # must be called with self._lock held
+    def _table(self, rate_table_id):
+        table = self._tables.get(rate_table_id)
+        if table is not None:
+            self._tables.move_to_end(rate_table_id)
+            return table
+
+        fetched_at, base_currency, currencies, packed_rates = self.dbh.get_rate_table(rate_table_id)
+        rates = array('d')
+        rates.frombytes(packed_rates)
+        table = RateTable(base_currency, dict(zip(currencies.split(','), rates)), fetched_at)
+
+        self._tables[rate_table_id] = table
+        if len(self._tables) > self.cache_size:
+            self._tables.popitem(last=False)
+        return table
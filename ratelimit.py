@@ -0,0 +1,79 @@
+import threading, time
+from contextlib import contextmanager
+
+# load shedding of the conversion endpoints: a token bucket per user, kept
+# in the database so the limit holds across worker processes, and an
+# admission check of the requests this process is already serving
+
+class RequestShed(RuntimeError):
+    def __init__(self, message, reason, retry_after):
+        super().__init__(message)
+        self.reason = reason
+        # seconds the client should wait before retrying
+        self.retry_after = retry_after
+
+class UserRateLimiter:
+    def __init__(self, dbh, rate, burst):
+        self.dbh = dbh
+        # conversions per second of each user, and how many of them may come
+        # at once after being idle
+        self.rate = rate
+        self.burst = burst
+
+    def check(self, user_id, cost=1):
+        # more than 'burst' tokens at once would never be available
+        if cost > self.burst:
+            raise ValueError(f'Invalid batch. user id "{user_id}" has {cost} conversions, '
+                             f'more than its rate limit burst of {self.burst:g}')
+
+        wait = self.dbh.take_tokens(f'user:{user_id}', cost, self.rate, self.burst, time.time())
+        if wait > 0:
+            raise RequestShed(f'user id "{user_id}" is over its rate limit of {self.rate:g} conversions per second',
+                              'rate_limited', wait)
+
+class AdmissionController:
+    def __init__(self, max_inflight=None, max_upstream_waiters=None, retry_after=1):
+        # None disables a limit
+        self.max_inflight = max_inflight
+        self.max_upstream_waiters = max_upstream_waiters
+        self.retry_after = retry_after
+        # requests being served, and how many of them are waiting on a rate
+        # lookup (i.e. on the external API, as cached lookups return at once)
+        self.inflight = 0
+        self.upstream_waiters = 0
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def admit(self):
+        # a new request is shed when the process is already full, instead of
+        # queueing behind the ones it cannot finish in time
+        with self._lock:
+            if self.max_inflight is not None and self.inflight >= self.max_inflight:
+                reason = 'too_many_inflight'
+            elif self.max_upstream_waiters is not None and self.upstream_waiters >= self.max_upstream_waiters:
+                reason = 'upstream_backlog'
+            else:
+                reason = None
+                self.inflight += 1
+
+        if reason is not None:
+            raise RequestShed('the server is overloaded, retry later', reason, self.retry_after)
+
+        try:
+            yield
+        finally:
+            with self._lock:
+                self.inflight -= 1
+
+    @contextmanager
+    def upstream_wait(self):
+        with self._lock:
+            self.upstream_waiters += 1
+        try:
+            yield
+        finally:
+            with self._lock:
+                self.upstream_waiters -= 1
+
+    def stats(self):
+        return { 'inflight': self.inflight, 'upstream_waiters': self.upstream_waiters }
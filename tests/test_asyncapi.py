@@ -0,0 +1,280 @@
+import unittest, asyncio, os, time, json, tempfile, threading
+from unittest.mock import patch, MagicMock
+from starlette.testclient import TestClient
+from test_exchangeapi import TEST_DATA, TRANSACTION_ID
+import asyncapi
+from asyncapi import app, AsyncRateClient
+from exchangeapi import dbh, rate_cache, rate_source
+from database import DatabaseHandler
+from providers import CircuitBreaker, ExchangeRatesApiProvider, ErApiProvider, HedgedRateSource
+from ratelimit import UserRateLimiter
+from tools.stub_rate_server import StubRateServer
+
+@patch.dict(os.environ, {"ACCESS_KEY": "123key456"})
+class TestAsyncConversionEndpoint(unittest.TestCase):
+    def setUp(self):
+        rate_cache.clear()
+        self.server = StubRateServer().start()
+        os.environ['EXCHANGE_API_URL'] = self.server.url
+        for provider in rate_source.providers:
+            provider.breaker.reset()
+
+    def tearDown(self):
+        del os.environ['EXCHANGE_API_URL']
+        self.server.stop()
+
+    @patch.object(dbh, 'insert_transaction', MagicMock(return_value=TRANSACTION_ID))
+    def test_async_conversion_endpoint_success(self):
+        test_data = {
+            'user_id': 1,
+            'source_currency': 'USD',
+            'target_currency': 'BRL',
+            'amount': 100
+        }
+
+        with TestClient(app) as client:
+            response = client.post('/convert', json=test_data)
+            client.post('/convert', json=test_data)
+
+        self.assertEqual(response.status_code, 200)
+        response_data = response.json()
+        self.assertEqual(response_data['transaction_id'], TRANSACTION_ID)
+        self.assertAlmostEqual(response_data['exchange_rate'], 5.244123 / 1.104252)
+        # rounded to BRL cents
+        self.assertEqual(response_data['converted_amount'], 474.9)
+
+        # the second request is served from the rate cache
+        self.assertEqual(self.server.request_count, 1)
+        self.assertEqual(dbh.insert_transaction.call_count, 2)
+
+    @patch.object(dbh, 'insert_transaction', MagicMock(return_value=TRANSACTION_ID))
+    def test_async_conversion_endpoint_with_write_behind(self):
+        threads = []
+        writer = MagicMock()
+        writer.submit.side_effect = lambda *transaction: threads.append(threading.current_thread()) or 456
+
+        with patch('exchangeapi.transaction_writer', writer), TestClient(app) as client:
+            response = client.post('/convert', json={ 'user_id': 1, 'source_currency': 'EUR',
+                                                      'target_currency': 'USD', 'amount': 100 })
+
+        # the journal write runs on the database threads, not the event loop
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()['transaction_id'], 456)
+        self.assertEqual(len(threads), 1)
+        self.assertTrue(threads[0].name.startswith('async-db'))
+        dbh.insert_transaction.assert_not_called()
+
+    @patch.object(dbh, 'insert_transaction', MagicMock(return_value=TRANSACTION_ID))
+    def test_async_conversion_endpoint_with_invalid_user(self):
+        with TestClient(app) as client:
+            response = client.post('/convert', json={ 'user_id': 0, 'source_currency': 'EUR',
+                                                      'target_currency': 'USD', 'amount': 100 })
+
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.json()['message'], 'user id "0" is not allowed!')
+        self.assertEqual(self.server.request_count, 0)
+        dbh.insert_transaction.assert_not_called()
+
+    @patch.object(dbh, 'insert_transaction', MagicMock(return_value=TRANSACTION_ID))
+    def test_async_conversion_endpoint_with_idempotency_key(self):
+        with TestClient(app) as client:
+            response = client.post('/convert', json={ 'user_id': 1, 'source_currency': 'EUR',
+                                                      'target_currency': 'USD', 'amount': 100 },
+                                   headers={ 'Idempotency-Key': 'key-1' })
+
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.json()['message'],
+                         'Invalid Idempotency-Key. it is only supported by the wsgi app, not by the asyncio path')
+        self.assertEqual(self.server.request_count, 0)
+        dbh.insert_transaction.assert_not_called()
+
+    @patch.object(dbh, 'insert_transaction', MagicMock(return_value=TRANSACTION_ID))
+    def test_async_conversion_endpoint_with_external_API_failure(self):
+        self.server.status_code = 500
+
+        with TestClient(app) as client:
+            response = client.post('/convert', json={ 'user_id': 1, 'source_currency': 'EUR',
+                                                      'target_currency': 'USD', 'amount': 100 })
+
+        self.assertEqual(response.status_code, 502)
+        self.assertEqual(response.json()['message'], 'failure getting exchange rate on the external API. Status Code: 500')
+        dbh.insert_transaction.assert_not_called()
+
+    @patch.object(dbh, 'insert_transaction', MagicMock(return_value=TRANSACTION_ID))
+    def test_async_conversion_endpoint_rate_limited(self):
+        test_data = { 'user_id': 1, 'source_currency': 'EUR', 'target_currency': 'USD', 'amount': 100 }
+
+        with tempfile.TemporaryDirectory() as directory:
+            limits = DatabaseHandler(os.path.join(directory, 'limits.db'))
+            limits.create_tables()
+            with patch('exchangeapi.rate_limiter', UserRateLimiter(limits, 0.1, 1)), TestClient(app) as client:
+                first = client.post('/convert', json=test_data)
+                second = client.post('/convert', json=test_data)
+            limits.close()
+
+        self.assertEqual(first.status_code, 200)
+        self.assertEqual(second.status_code, 429)
+        self.assertEqual(second.headers['Retry-After'], '10')
+        dbh.insert_transaction.assert_called_once()
+
+    def test_async_rate_client_concurrent_misses(self):
+        self.server.delay = 0.2
+
+        async def convert_many():
+            client = AsyncRateClient(max_concurrency=5)
+            await client.start()
+            try:
+                return await asyncio.gather(*[client.get_exchange_rate('EUR', 'USD') for _ in range(50)])
+            finally:
+                await client.close()
+
+        started = time.perf_counter()
+        rates = asyncio.run(convert_many())
+
+        # concurrent misses share one upstream call
+        self.assertEqual(rates, [1.104252] * 50)
+        self.assertEqual(self.server.request_count, 1)
+        self.assertLess(time.perf_counter() - started, 1)
+
+    def test_async_rate_client_stores_off_the_event_loop(self):
+        threads = []
+        async def fetch():
+            client = AsyncRateClient()
+            await client.start()
+            try:
+                return await client.get_exchange_rate('EUR', 'USD'), threading.current_thread()
+            finally:
+                await client.close()
+
+        with patch.object(rate_cache, 'on_store', lambda table: threads.append(threading.current_thread())):
+            rate, loop_thread = asyncio.run(fetch())
+
+        # the rates history insert runs on the database threads
+        self.assertEqual(rate, 1.104252)
+        self.assertEqual(len(threads), 1)
+        self.assertNotEqual(threads[0], loop_thread)
+        self.assertTrue(threads[0].name.startswith('async-db'))
+
+    def test_async_rate_client_falls_through_providers(self):
+        self.server.status_code = 500
+        secondary_server = StubRateServer().start()
+        os.environ['ERAPI_URL'] = secondary_server.url
+        primary = ExchangeRatesApiProvider(breaker=CircuitBreaker(failure_threshold=1, cooldown=30))
+        secondary = ErApiProvider(breaker=CircuitBreaker(failure_threshold=1, cooldown=30))
+
+        async def fetch_twice():
+            client = AsyncRateClient()
+            await client.start()
+            try:
+                return [await client.fetch_rates('EUR') for _ in range(2)]
+            finally:
+                await client.close()
+
+        try:
+            with patch('exchangeapi.rate_source', HedgedRateSource([primary, secondary])):
+                first, second = asyncio.run(fetch_twice())
+
+                # with both circuits open nothing is called
+                secondary.breaker.record_failure()
+                with self.assertRaises(RuntimeError) as cm:
+                    asyncio.run(fetch_twice())
+        finally:
+            del os.environ['ERAPI_URL']
+            secondary_server.stop()
+
+        self.assertEqual(first, second)
+        self.assertEqual(first['USD'], 1.104252)
+        # the failing primary opened its circuit, and is skipped afterwards
+        self.assertEqual(primary.breaker.state, 'open')
+        self.assertEqual(self.server.request_count, 1)
+        self.assertEqual(secondary_server.request_count, 2)
+        self.assertEqual(str(cm.exception),
+                         'failure getting exchange rate on the external API. Every provider is unavailable (circuit open)')
+
+    def test_async_rate_client_hedges_slow_provider(self):
+        self.server.delay = 1
+        secondary_server = StubRateServer().start()
+        os.environ['ERAPI_URL'] = secondary_server.url
+        source = HedgedRateSource([ExchangeRatesApiProvider(timeout=2), ErApiProvider(timeout=2)], hedge_delay=0.1)
+
+        async def fetch():
+            client = AsyncRateClient()
+            await client.start()
+            try:
+                return await client.fetch_rates('EUR')
+            finally:
+                await client.close()
+
+        started = time.perf_counter()
+        try:
+            with patch('exchangeapi.rate_source', source):
+                rates = asyncio.run(fetch())
+        finally:
+            del os.environ['ERAPI_URL']
+            secondary_server.stop()
+
+        # the secondary was called after hedge_delay, and answered first
+        self.assertEqual(rates['USD'], 1.104252)
+        self.assertLess(time.perf_counter() - started, 0.8)
+        self.assertEqual(source.hedges, 1)
+        self.assertEqual(secondary_server.request_count, 1)
+
+    def test_async_rate_client_timeout(self):
+        self.server.delay = 0.5
+
+        async def fetch():
+            client = AsyncRateClient()
+            await client.start()
+            try:
+                return await client.fetch_rates('EUR')
+            finally:
+                await client.close()
+
+        # the timeout of the provider
+        with patch('exchangeapi.rate_source', HedgedRateSource([ExchangeRatesApiProvider(timeout=0.1)])):
+            with self.assertRaises(RuntimeError) as cm:
+                asyncio.run(fetch())
+        self.assertEqual(str(cm.exception), 'failure getting exchange rate on the external API. Timeout after 0.1s')
+
+class TestAsyncUserTransactionsEndpoint(unittest.TestCase):
+    @patch.object(dbh, 'get_user_transactions', MagicMock(return_value=TEST_DATA))
+    def test_async_user_transaction_endpoint_success(self):
+        with TestClient(app) as client:
+            response = client.get('/transactions/1')
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json(), TEST_DATA)
+        dbh.get_user_transactions.assert_called_once_with(1)
+
+    @patch.object(dbh, 'get_user_transactions', MagicMock(return_value=TEST_DATA))
+    def test_async_user_transaction_endpoint_with_pagination(self):
+        with TestClient(app) as client:
+            response = client.get('/transactions/1?limit=2')
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.headers['X-Next-After'], '2')
+        dbh.get_user_transactions.assert_called_once_with(1, limit=2, after=None)
+
+    @patch.object(dbh, 'get_user_transactions', MagicMock(return_value=TEST_DATA))
+    def test_async_user_transaction_endpoint_with_ndjson_stream(self):
+        with TestClient(app) as client:
+            response = client.get('/transactions/1?stream=ndjson')
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([json.loads(line) for line in response.text.splitlines()], TEST_DATA)
+        dbh.get_user_transactions.assert_called_once_with(1, limit=500, after=None)
+
+    def test_async_iter_user_transactions_pages(self):
+        pages = MagicMock(side_effect=[TEST_DATA, TEST_DATA[:1]])
+
+        async def collect():
+            return [t async for t in asyncapi.iter_user_transactions(1, None, page_size=2)]
+
+        with patch.object(dbh, 'get_user_transactions', pages):
+            transactions = asyncio.run(collect())
+
+        self.assertEqual(transactions, TEST_DATA + TEST_DATA[:1])
+        pages.assert_called_with(1, limit=2, after=2)
+
+if __name__ == '__main__':
+    unittest.main()
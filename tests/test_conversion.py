@@ -0,0 +1,55 @@
+import unittest
+from array import array
+from decimal import Decimal, ROUND_HALF_EVEN
+from conversion import exponent, to_minor_units, from_minor_units, fixed_rate, convert_minor, convert_amount, convert_many
+
+class TestConversion(unittest.TestCase):
+    def test_minor_units(self):
+        self.assertEqual(exponent('USD'), 2)
+        self.assertEqual(exponent('JPY'), 0)
+        self.assertEqual(exponent('KWD'), 3)
+
+        self.assertEqual(to_minor_units(10.05, 'USD'), 1005)
+        self.assertEqual(to_minor_units(0.1, 'EUR'), 10)
+        self.assertEqual(to_minor_units(1500, 'JPY'), 1500)
+        self.assertEqual(to_minor_units(1.234, 'KWD'), 1234)
+        self.assertEqual(from_minor_units(1005, 'USD'), 10.05)
+
+        with self.assertRaises(ValueError) as cm:
+            to_minor_units(10.5, 'JPY')
+        self.assertEqual(str(cm.exception), 'Invalid amount. JPY amounts have at most 0 decimals')
+
+        with self.assertRaises(ValueError):
+            to_minor_units(float('inf'), 'USD')
+
+    def test_convert_rounds_half_to_even(self):
+        rate = fixed_rate(1.0)
+        # 0.125 and 0.135 KWD to USD cents: exact halves
+        self.assertEqual(convert_minor(125, rate, 'KWD', 'USD'), 12)
+        self.assertEqual(convert_minor(135, rate, 'KWD', 'USD'), 14)
+
+        # 0.1 * 3 is not 0.30000000000000004
+        self.assertEqual(convert_amount(0.1, 3.0, 'EUR', 'USD'), 0.3)
+        self.assertEqual(convert_amount(100, 5.244123, 'EUR', 'BRL'), 524.41)
+        self.assertEqual(convert_amount(10.01, 141.085, 'USD', 'JPY'), 1412)
+
+    def test_convert_matches_decimal(self):
+        for amount, rate, source, target in [(10.05, 1.104252, 'EUR', 'USD'), (999.99, 155.787685, 'EUR', 'JPY'),
+                                             (12345, 0.006418, 'JPY', 'EUR'), (0.001, 3.261, 'KWD', 'USD'),
+                                             (1.5, 3.7687642e-05, 'EUR', 'BTC')]:
+            expected = (Decimal(repr(amount)) * Decimal(repr(rate))).quantize(Decimal(1).scaleb(-exponent(target)), ROUND_HALF_EVEN)
+            self.assertEqual(convert_amount(amount, rate, source, target), float(expected))
+
+    def test_convert_many(self):
+        amounts = array('q', [1, 5, 15, 25, 1005, 123456789])
+        rate = 0.5
+
+        converted = convert_many(amounts, rate, 'USD', 'USD')
+
+        self.assertEqual(converted.typecode, 'q')
+        self.assertEqual(list(converted), [convert_minor(a, fixed_rate(rate), 'USD', 'USD') for a in amounts])
+        self.assertEqual(list(converted), [0, 2, 8, 12, 502, 61728394])
+        self.assertEqual(list(convert_many(array('q', [1000, 1005]), 141.085, 'USD', 'JPY')), [1411, 1418])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,264 @@
+import unittest, os, tempfile, threading, sqlite3, stat
+from unittest.mock import patch
+from datetime import datetime, timezone
+import database
+from database import DatabaseHandler
+
+class TestDatabaseHandler(unittest.TestCase):
+    def setUp(self):
+        fd, self.database_file = tempfile.mkstemp(suffix='.db')
+        os.close(fd)
+        self.patcher = patch.object(database, 'DATABASE_FILE', self.database_file)
+        self.patcher.start()
+
+        self.dbh = DatabaseHandler()
+        self.dbh.create_tables()
+
+    def tearDown(self):
+        self.dbh.close()
+        self.patcher.stop()
+        for suffix in ('', '-wal', '-shm'):
+            if os.path.exists(self.database_file + suffix):
+                os.remove(self.database_file + suffix)
+
+    def test_insert_transactions(self):
+        first_id = self.dbh.insert_transaction(1, 'EUR', 10, 'USD', 11, 1.1, '2023-07-21T12:34:56Z')
+
+        transaction_ids = self.dbh.insert_transactions([
+            (1, 'EUR', 100, 'USD', 110, 1.1, '2023-07-22T09:15:00Z'),
+            (2, 'EUR', 50, 'BRL', 250, 5.0, '2023-07-22T09:15:00Z'),
+            (1, 'USD', 20, 'EUR', 18, 0.9, '2023-07-22T09:15:00Z')
+        ])
+
+        self.assertEqual(transaction_ids, [first_id + 1, first_id + 2, first_id + 3])
+
+        transactions = self.dbh.get_user_transactions(1)
+        self.assertEqual([t['transaction_id'] for t in transactions], [first_id, first_id + 1, first_id + 3])
+        self.assertEqual(transactions[2]['source_currency'], 'USD')
+        self.assertEqual(transactions[2]['converted_amount'], 18)
+
+    def test_insert_transactions_rolls_back_on_failure(self):
+        with self.assertRaises(Exception):
+            self.dbh.insert_transactions([
+                (1, 'EUR', 100, 'USD', 110, 1.1, '2023-07-22T09:15:00Z'),
+                (1, 'EUR', 100)
+            ])
+
+        self.assertEqual(self.dbh.get_user_transactions(1), [])
+
+    def test_get_user_transactions_pages(self):
+        transaction_ids = self.dbh.insert_transactions([
+            (user_id, 'EUR', 100, 'USD', 110, 1.1, '2023-07-22T09:15:00Z') for user_id in (1, 2, 1, 1, 2, 1, 1)
+        ])
+        user_ids = [transaction_ids[i] for i in (0, 2, 3, 5, 6)]
+
+        first_page = self.dbh.get_user_transactions(1, limit=2)
+        self.assertEqual([t['transaction_id'] for t in first_page], user_ids[:2])
+
+        second_page = self.dbh.get_user_transactions(1, limit=2, after=first_page[-1]['transaction_id'])
+        self.assertEqual([t['transaction_id'] for t in second_page], user_ids[2:4])
+
+        last_page = self.dbh.get_user_transactions(1, limit=2, after=second_page[-1]['transaction_id'])
+        self.assertEqual([t['transaction_id'] for t in last_page], user_ids[4:])
+
+        streamed = self.dbh.iter_user_transactions(1, after=user_ids[0], chunk_size=2)
+        self.assertEqual([t['transaction_id'] for t in streamed], user_ids[1:])
+
+    def test_user_transactions_use_index(self):
+        conn = self.dbh._connection()
+
+        self.assertEqual(conn.execute('PRAGMA user_version').fetchone()[0], len(database.SCHEMA_MIGRATIONS))
+
+        plan = conn.execute('EXPLAIN QUERY PLAN ' + database.SELECT_USER_TRANSACTIONS_PAGE_SQL, (1, 0, 10)).fetchall()
+        self.assertIn('transactions_user_id_idx', ' '.join(row[-1] for row in plan))
+
+    def test_user_summary(self):
+        self.dbh.insert_transaction(1, 'EUR', 100, 'USD', 110, 1.1, '2023-07-21T12:34:56Z')
+        self.dbh.insert_transactions([
+            (1, 'EUR', 50, 'USD', 55, 1.1, '2023-07-21T18:00:00Z'),
+            (1, 'EUR', 10, 'BRL', 50, 5.0, '2023-07-21T18:00:00Z'),
+            (1, 'USD', 20, 'BRL', 90, 4.5, '2023-07-22T09:15:00Z'),
+            (2, 'EUR', 10, 'USD', 11, 1.1, '2023-07-22T09:15:00Z')
+        ])
+
+        self.assertEqual(self.dbh.get_user_summary(1, ['day', 'pair']), [
+            { 'day': '2023-07-21', 'source_currency': 'EUR', 'target_currency': 'BRL', 'transactions': 1, 'amount': 10, 'converted_amount': 50 },
+            { 'day': '2023-07-21', 'source_currency': 'EUR', 'target_currency': 'USD', 'transactions': 2, 'amount': 150, 'converted_amount': 165 },
+            { 'day': '2023-07-22', 'source_currency': 'USD', 'target_currency': 'BRL', 'transactions': 1, 'amount': 20, 'converted_amount': 90 }
+        ])
+
+        # amounts in different currencies are not summed together
+        self.assertEqual(self.dbh.get_user_summary(1, ['day']), [
+            { 'day': '2023-07-21', 'transactions': 3 },
+            { 'day': '2023-07-22', 'transactions': 1 }
+        ])
+        self.assertEqual(self.dbh.get_user_summary(1, ['target_currency'], since='2023-07-22'), [
+            { 'target_currency': 'BRL', 'transactions': 1, 'converted_amount': 90 }
+        ])
+        self.assertEqual(self.dbh.get_user_summary(2, []), [{ 'transactions': 1 }])
+        self.assertEqual(self.dbh.get_user_summary(3, []), [])
+
+    def test_backfill_summaries(self):
+        self.dbh.insert_transaction(1, 'EUR', 100, 'USD', 110, 1.1, '2023-07-21T12:34:56Z')
+        summary = self.dbh.get_user_summary(1, ['day', 'pair'])
+
+        # transactions inserted before the rollup table existed
+        conn = self.dbh._connection()
+        conn.execute('DELETE FROM transaction_summaries')
+        self.assertEqual(self.dbh.get_user_summary(1, ['day', 'pair']), [])
+
+        self.assertEqual(self.dbh.backfill_summaries(), 1)
+        self.assertEqual(self.dbh.get_user_summary(1, ['day', 'pair']), summary)
+
+    def test_connection_settings(self):
+        conn = self.dbh._connection()
+
+        self.assertEqual(conn.execute('PRAGMA journal_mode').fetchone()[0], 'wal')
+        self.assertEqual(conn.execute('PRAGMA synchronous').fetchone()[0], 1)
+        self.assertEqual(conn.execute('PRAGMA busy_timeout').fetchone()[0], 5000)
+
+        # the connection is kept for the thread, and reopened after close()
+        self.assertIs(self.dbh._connection(), conn)
+        self.dbh.close()
+        self.assertIsNot(self.dbh._connection(), conn)
+
+    def test_connections_of_finished_threads_are_closed(self):
+        connections = []
+
+        def query():
+            connections.append(self.dbh._connection())
+            self.dbh.get_user_transactions(1)
+
+        for _ in range(50):
+            t = threading.Thread(target=query)
+            t.start()
+            t.join()
+
+        # only the connection of this thread is left open
+        self.dbh._connection()
+        self.assertEqual(len(self.dbh._threads), 1)
+        with self.assertRaises(sqlite3.ProgrammingError):
+            connections[0].execute('SELECT 1')
+
+    def test_concurrent_writers(self):
+        writers, inserts_per_writer = 16, 50
+        errors = []
+
+        def writer(user_id):
+            try:
+                for i in range(inserts_per_writer):
+                    if i % 10 == 0:
+                        self.dbh.insert_transactions([(user_id, 'EUR', i, 'USD', i * 1.1, 1.1, '2023-07-22T09:15:00Z')] * 3)
+                    else:
+                        self.dbh.insert_transaction(user_id, 'EUR', i, 'USD', i * 1.1, 1.1, '2023-07-22T09:15:00Z')
+            except sqlite3.Error as e:
+                errors.append(e)
+
+        threads = [threading.Thread(target=writer, args=(user_id,)) for user_id in range(writers)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+        # no 'database is locked' errors and no lost writes
+        self.assertEqual(errors, [])
+        for user_id in range(writers):
+            self.assertEqual(len(self.dbh.get_user_transactions(user_id)), inserts_per_writer + 10)
+
+class TestPartitionedTransactions(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.archive_directory = os.path.join(self.directory.name, 'archive')
+        self.dbh = DatabaseHandler(os.path.join(self.directory.name, 'hot.db'), archive_directory=self.archive_directory)
+        self.dbh.create_tables()
+
+        self.ids = self.dbh.insert_transactions([
+            (1, 'EUR', 100, 'USD', 110, 1.1, '2023-06-30T23:59:59Z'),
+            (1, 'EUR', 50, 'BRL', 250, 5.0, '2023-07-01T00:00:00Z'),
+            (2, 'USD', 20, 'EUR', 18, 0.9, '2023-07-15T10:00:00Z'),
+            (1, 'USD', 10, 'EUR', 9, 0.9, '2023-07-31T12:00:00Z'),
+            (1, 'EUR', 30, 'USD', 33, 1.1, '2023-08-01T08:00:00Z')
+        ])
+
+    def tearDown(self):
+        self.dbh.close()
+        self.directory.cleanup()
+
+    def hot_count(self):
+        cursor = self.dbh._connection().cursor()
+        cursor.execute('SELECT COUNT(*) FROM transactions')
+        return cursor.fetchone()[0]
+
+    def test_archive_partitions_keeps_the_local_current_month(self):
+        # 01:00 UTC on August 1st is still July 31st at UTC-3, the clock of
+        # the stored timestamps (freezegun also shifts now(timezone.utc))
+        class UTCMinus3(datetime):
+            @classmethod
+            def now(cls, tz=None):
+                now = datetime(2023, 8, 1, 1, 0, tzinfo=timezone.utc)
+                return now.astimezone(tz) if tz is not None else datetime(2023, 7, 31, 22, 0)
+
+        with patch.object(database, 'datetime', UTCMinus3):
+            self.assertEqual(self.dbh.archive_partitions(), [('2023-06', 1)])
+        self.assertEqual(self.hot_count(), 4)
+
+    def test_archive_partitions(self):
+        self.assertEqual(self.dbh.archive_partitions('2023-08'), [('2023-06', 1), ('2023-07', 3)])
+
+        # only the open month is left in the hot database
+        self.assertEqual(self.hot_count(), 1)
+        path = os.path.join(self.archive_directory, 'transactions-2023-07.db')
+        self.assertFalse(os.stat(path).st_mode & stat.S_IWUSR)
+
+        # nothing left to archive
+        self.assertEqual(self.dbh.archive_partitions('2023-08'), [])
+
+        with self.assertRaises(ValueError) as cm:
+            self.dbh.archive_partitions('August')
+        self.assertEqual(str(cm.exception), 'Invalid month "August". expected YYYY-MM')
+
+    def test_queries_fan_out_to_partitions(self):
+        self.dbh.archive_partitions('2023-08')
+
+        transactions = self.dbh.get_user_transactions(1)
+        self.assertEqual([t['transaction_id'] for t in transactions], [self.ids[0], self.ids[1], self.ids[3], self.ids[4]])
+        self.assertEqual(transactions[1]['converted_amount'], 250)
+
+        # pages across partitions
+        page = self.dbh.get_user_transactions(1, limit=2, after=self.ids[0])
+        self.assertEqual([t['transaction_id'] for t in page], [self.ids[1], self.ids[3]])
+        page = self.dbh.get_user_transactions(1, limit=2, after=self.ids[3])
+        self.assertEqual([t['transaction_id'] for t in page], [self.ids[4]])
+
+        streamed = self.dbh.iter_user_transactions(1, after=self.ids[0], chunk_size=1)
+        self.assertEqual([t['transaction_id'] for t in streamed], [self.ids[1], self.ids[3], self.ids[4]])
+
+        chunks = list(self.dbh.iter_transaction_chunks('2023-07-15T00:00:00Z', '2023-08-02T00:00:00Z', chunk_size=2))
+        self.assertEqual([[t[0] for t in chunk] for chunk in chunks], [[self.ids[2], self.ids[3]], [self.ids[4]]])
+
+        # only the partitions overlapping the range are read (july and the hot database)
+        self.assertEqual(len(self.dbh._sources(since='2023-07-15T00:00:00Z', until='2023-08-02T00:00:00Z')), 2)
+        self.assertEqual(len(self.dbh._sources(after=self.ids[3])), 1)
+
+    def test_archived_rows_are_not_imported_again(self):
+        rows = list(self.dbh.iter_transaction_chunks())[0]
+        self.dbh.archive_partitions('2023-08')
+
+        late_row = (self.ids[-1] + 1, 3, 'EUR', 1, 'USD', 1.1, 1.1, '2023-07-20T00:00:00Z')
+        self.assertEqual(self.dbh.import_transactions(rows + [late_row]), 1)
+
+        # the late row goes to the hot database, and to the archive on the next run
+        self.assertEqual(self.dbh.archive_partitions('2023-08'), [('2023-07', 1)])
+        self.assertEqual(self.hot_count(), 1)
+        self.assertEqual(len(list(self.dbh.iter_transaction_chunks('2023-07-01T00:00:00Z', '2023-08-01T00:00:00Z'))[0]), 4)
+
+    def test_backfill_summaries_includes_partitions(self):
+        self.dbh.archive_partitions('2023-08')
+
+        self.dbh.backfill_summaries()
+        self.assertEqual(self.dbh.get_user_summary(1, []), [{ 'transactions': 4 }])
+        self.assertEqual(self.dbh.get_user_summary(1, ['day'], since='2023-07-01', until='2023-07-31'),
+                         [{ 'day': '2023-07-01', 'transactions': 1 }, { 'day': '2023-07-31', 'transactions': 1 }])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,19 +1,42 @@
-import unittest, requests, os
+import unittest, requests, os, sys, json, uuid, tempfile, subprocess
 from unittest.mock import patch, MagicMock
 from freezegun import freeze_time
 from flask import Flask
 from flask.testing import FlaskClient
-from exchangeapi import app, dbh, get_exchange_rate
+import exchangeapi
+
+# the tests never touch the currency_conversion.db of the working directory:
+# the app of this process is created on a throwaway database before its
+# components are imported (the patches below are bound to them), and the
+# other test modules sharing it import this module first
+DATABASE_DIRECTORY = tempfile.TemporaryDirectory()
+exchangeapi.create_app(database_file=os.path.join(DATABASE_DIRECTORY.name, 'test.db'))
+
+from exchangeapi import app, dbh, rate_cache, rate_history, rate_source, admission_controller, get_exchange_rate, start, \
+                        convert_batch
+from conversion import convert_amount
+from ratelimit import UserRateLimiter
+from providers import RateProviderError
+from ratecache import RateTable
 from database import DatabaseHandler
+from metrics import UPSTREAM_ERRORS, SHED_REQUESTS
+from tools.stub_rate_server import StubRateServer
 
 TRANSACTION_ID = 123
 
+def setUpModule():
+    # what the first request of a worker runs (the schema of the throwaway
+    # database), so the tests below see only their own database calls
+    start()
+
+CONVERSION = { 'user_id': 1, 'source_currency': 'EUR', 'target_currency': 'USD', 'amount': 100 }
+
 class TestConversionEndpoint(unittest.TestCase):
     def setUp(self):
         self.app = app.test_client()
         self.mock_get_exchange_rate = MagicMock(return_value=1.4)
         self.mock_get_exchange_rate_failure = MagicMock()
-        self.mock_get_exchange_rate_failure.side_effect = RuntimeError("failure getting exchange rate on the external API. Status Code: 500")
+        self.mock_get_exchange_rate_failure.side_effect = RateProviderError("failure getting exchange rate on the external API. Status Code: 500")
 
     @freeze_time("2023-07-24 22:30:00", tz_offset=-3)
     @patch.object(dbh, 'create_tables', MagicMock(return_value=None))
@@ -55,9 +78,90 @@ class TestConversionEndpoint(unittest.TestCase):
                                                            test_data['target_currency'],
                                                            140,
                                                            1.4,
-                                                           '2023-07-24T19:30:00Z')
+                                                           '2023-07-24T19:30:00Z',
+                                                           idempotency_key=None)
             dbh.get_user_transactions.assert_not_called()
 
+    @patch.object(dbh, 'insert_transaction', MagicMock(return_value=TRANSACTION_ID))
+    def test_conversion_endpoint_at_timestamp(self):
+        test_data = {
+            'user_id': 1,
+            'source_currency': 'USD',
+            'target_currency': 'EUR',
+            'amount': 110
+        }
+
+        table_at = MagicMock(return_value=RateTable('EUR', { 'USD': 1.1 }, 1690156800))
+        with patch.object(rate_history, 'table_at', table_at), \
+             patch('exchangeapi.get_exchange_rate', self.mock_get_exchange_rate):
+            response = self.app.post('/convert?at=2023-07-24T10:00:00Z', json=test_data)
+
+        # answered from the rate history, nothing is persisted
+        self.assertEqual(response.status_code, 200)
+        response_data = response.get_json()
+        self.assertIsNone(response_data['transaction_id'])
+        self.assertAlmostEqual(response_data['exchange_rate'], 1 / 1.1)
+        self.assertAlmostEqual(response_data['converted_amount'], 100)
+        self.assertEqual(response_data['timestamp'], '2023-07-24T10:00:00Z')
+        self.assertEqual(response_data['rate_timestamp'], '2023-07-24T00:00:00Z')
+        table_at.assert_called_once_with(1690192800)
+        self.mock_get_exchange_rate.assert_not_called()
+        dbh.insert_transaction.assert_not_called()
+
+    def test_conversion_endpoint_at_invalid_timestamp(self):
+        test_data = { 'user_id': 1, 'source_currency': 'USD', 'target_currency': 'EUR', 'amount': 110 }
+
+        response = self.app.post('/convert?at=yesterday', json=test_data)
+
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.get_json()['message'], 'Invalid timestamp "yesterday". expected unix seconds or ISO 8601')
+
+    @patch.object(dbh, 'insert_transaction', MagicMock(return_value=TRANSACTION_ID))
+    def test_conversion_endpoint_with_write_behind(self):
+        test_data = {
+            'user_id': 1,
+            'source_currency': 'EUR',
+            'target_currency': 'USD',
+            'amount': 100
+        }
+
+        writer = MagicMock()
+        writer.submit.return_value = 456
+        with patch('exchangeapi.get_exchange_rate', self.mock_get_exchange_rate), \
+             patch('exchangeapi.transaction_writer', writer):
+            response = self.app.post('/convert', json=test_data)
+
+        # the transaction is queued instead of inserted
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.get_json()['transaction_id'], 456)
+        writer.submit.assert_called_once()
+        dbh.insert_transaction.assert_not_called()
+
+    @patch.object(dbh, 'insert_transaction', MagicMock(return_value=TRANSACTION_ID))
+    def test_conversion_endpoint_with_idempotency_key(self):
+        test_data = { 'user_id': 1, 'source_currency': 'EUR', 'target_currency': 'USD', 'amount': 100 }
+        headers = { 'Idempotency-Key': str(uuid.uuid4()) }
+
+        with patch('exchangeapi.get_exchange_rate', self.mock_get_exchange_rate):
+            first = self.app.post('/convert', json=test_data, headers=headers)
+            retry = self.app.post('/convert', json=test_data, headers=headers)
+            reused = self.app.post('/convert', json=dict(test_data, amount=200), headers=headers)
+
+        # the retry gets the stored response, without converting again
+        self.assertEqual(first.status_code, 200)
+        self.assertEqual(retry.status_code, 200)
+        self.assertEqual(retry.get_json(), first.get_json())
+        self.assertEqual(retry.headers['Idempotent-Replayed'], 'true')
+        self.assertNotIn('Idempotent-Replayed', first.headers)
+        self.mock_get_exchange_rate.assert_called_once_with('EUR', 'USD')
+        dbh.insert_transaction.assert_called_once()
+        # recorded on the key in the same transaction as the insert
+        self.assertEqual(dbh.insert_transaction.call_args.kwargs['idempotency_key'], headers['Idempotency-Key'])
+
+        self.assertEqual(reused.status_code, 422)
+        self.assertEqual(reused.get_json()['message'],
+                         f'Idempotency-Key "{headers["Idempotency-Key"]}" was already used with a different request')
+
     @patch.object(dbh, 'create_tables', MagicMock(return_value=None))
     @patch.object(dbh, 'insert_transaction', MagicMock(return_value=TRANSACTION_ID))
     @patch.object(dbh, 'get_user_transactions', MagicMock(return_value=[]))
@@ -86,6 +190,32 @@ class TestConversionEndpoint(unittest.TestCase):
             dbh.insert_transaction.assert_not_called()
             dbh.get_user_transactions.assert_not_called()
 
+    @patch.object(dbh, 'insert_transaction', MagicMock(return_value=TRANSACTION_ID))
+    def test_conversion_endpoint_with_unhashable_user_or_body(self):
+        with patch('exchangeapi.get_exchange_rate', self.mock_get_exchange_rate):
+            unhashable = self.app.post('/convert', json=dict(CONVERSION, user_id=[1]))
+            listed = self.app.post('/convert', json=[CONVERSION])
+
+        self.assertEqual(unhashable.status_code, 400)
+        self.assertEqual(unhashable.get_json()['message'], 'user id "[1]" is not allowed!')
+        self.assertEqual(listed.status_code, 400)
+        self.assertEqual(listed.get_json()['message'], 'Invalid conversion. expected a json object')
+        self.mock_get_exchange_rate.assert_not_called()
+        dbh.insert_transaction.assert_not_called()
+
+    @patch.object(dbh, 'insert_transaction', MagicMock(return_value=TRANSACTION_ID))
+    def test_conversion_endpoint_with_invalid_currency(self):
+        with patch('exchangeapi.get_exchange_rate', self.mock_get_exchange_rate):
+            responses = [self.app.post('/convert', json=dict(CONVERSION, **currency))
+                         for currency in ({ 'source_currency': ['EUR'] }, { 'target_currency': { 'code': 'USD' } },
+                                          { 'source_currency': None })]
+
+        self.assertEqual([r.status_code for r in responses], [400] * 3)
+        self.assertEqual(responses[0].get_json()['message'],
+                         'Invalid currency. source_currency and target_currency must be strings')
+        self.mock_get_exchange_rate.assert_not_called()
+        dbh.insert_transaction.assert_not_called()
+
     @patch.object(dbh, 'create_tables', MagicMock(return_value=None))
     @patch.object(dbh, 'insert_transaction', MagicMock(return_value=TRANSACTION_ID))
     @patch.object(dbh, 'get_user_transactions', MagicMock(return_value=[]))
@@ -142,6 +272,30 @@ class TestConversionEndpoint(unittest.TestCase):
             dbh.insert_transaction.assert_not_called()
             dbh.get_user_transactions.assert_not_called()
 
+    @patch.object(dbh, 'insert_transaction', MagicMock(return_value=TRANSACTION_ID))
+    def test_conversion_endpoint_with_sub_cent_amount(self):
+        test_data = { 'user_id': 1, 'source_currency': 'EUR', 'target_currency': 'USD', 'amount': 10.005 }
+
+        with patch('exchangeapi.get_exchange_rate', self.mock_get_exchange_rate):
+            response = self.app.post('/convert', json=test_data)
+
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.get_json()['message'], 'Invalid amount. EUR amounts have at most 2 decimals')
+        self.mock_get_exchange_rate.assert_not_called()
+        dbh.insert_transaction.assert_not_called()
+
+    @patch.object(dbh, 'insert_transaction', MagicMock(return_value=TRANSACTION_ID))
+    def test_conversion_endpoint_rounds_to_minor_units(self):
+        test_data = { 'user_id': 1, 'source_currency': 'USD', 'target_currency': 'JPY', 'amount': 10.01 }
+
+        with patch('exchangeapi.get_exchange_rate', MagicMock(return_value=141.0850)):
+            response = self.app.post('/convert', json=test_data)
+
+        # 1412.26085 yen, rounded exactly to the yen
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.get_json()['converted_amount'], 1412)
+        self.assertEqual(dbh.insert_transaction.call_args[0][4], 1412)
+
     @patch.object(dbh, 'create_tables', MagicMock(return_value=None))
     @patch.object(dbh, 'insert_transaction', MagicMock(return_value=TRANSACTION_ID))
     @patch.object(dbh, 'get_user_transactions', MagicMock(return_value=[]))
@@ -160,7 +314,7 @@ class TestConversionEndpoint(unittest.TestCase):
             response = self.app.post('/convert', json=test_data)
 
             # assert communication
-            self.assertEqual(response.status_code, 400)
+            self.assertEqual(response.status_code, 502)
             response_data = response.get_json()
             self.assertEqual(response_data['message'], 'failure getting exchange rate on the external API. Status Code: 500')
             self.mock_get_exchange_rate_failure.assert_called_once_with(test_data['source_currency'],
@@ -171,6 +325,233 @@ class TestConversionEndpoint(unittest.TestCase):
             dbh.insert_transaction.assert_not_called()
             dbh.get_user_transactions.assert_not_called()
 
+    @patch.object(dbh, 'insert_transaction', MagicMock(return_value=TRANSACTION_ID))
+    def test_conversion_endpoint_rate_limited(self):
+        shed = SHED_REQUESTS.value(reason='rate_limited')
+
+        with tempfile.TemporaryDirectory() as directory:
+            limits = DatabaseHandler(os.path.join(directory, 'limits.db'))
+            limits.create_tables()
+            with patch('exchangeapi.rate_limiter', UserRateLimiter(limits, 0.5, 2)), \
+                 patch('exchangeapi.get_exchange_rate', self.mock_get_exchange_rate):
+                responses = [self.app.post('/convert', json=dict(CONVERSION, user_id=1)) for _ in range(3)]
+                # the limit is per user
+                other_user = self.app.post('/convert', json=dict(CONVERSION, user_id=2))
+            limits.close()
+
+        self.assertEqual([r.status_code for r in responses], [200, 200, 429])
+        self.assertEqual(responses[2].headers['Retry-After'], '2')
+        self.assertEqual(responses[2].get_json()['message'], 'user id "1" is over its rate limit of 0.5 conversions per second')
+        self.assertEqual(other_user.status_code, 200)
+        self.assertEqual(dbh.insert_transaction.call_count, 3)
+        self.assertEqual(SHED_REQUESTS.value(reason='rate_limited'), shed + 1)
+
+    @patch.object(dbh, 'insert_transaction', MagicMock(return_value=TRANSACTION_ID))
+    def test_conversion_endpoint_overloaded(self):
+        shed = SHED_REQUESTS.value(reason='upstream_backlog')
+
+        # requests are already waiting on the external API
+        with patch.object(admission_controller, 'max_upstream_waiters', 1), \
+             patch.object(admission_controller, 'retry_after', 1.5), \
+             patch('exchangeapi.get_exchange_rate', self.mock_get_exchange_rate):
+            with admission_controller.upstream_wait():
+                response = self.app.post('/convert', json=CONVERSION)
+            after = self.app.post('/convert', json=CONVERSION)
+
+        self.assertEqual(response.status_code, 429)
+        self.assertEqual(response.headers['Retry-After'], '2')
+        self.assertEqual(response.get_json()['message'], 'the server is overloaded, retry later')
+        self.assertEqual(SHED_REQUESTS.value(reason='upstream_backlog'), shed + 1)
+        self.mock_get_exchange_rate.assert_called_once()
+        self.assertEqual(after.status_code, 200)
+        self.assertEqual(admission_controller.stats(), { 'inflight': 0, 'upstream_waiters': 0 })
+
+class TestBatchConversionEndpoint(unittest.TestCase):
+    def setUp(self):
+        self.app = app.test_client()
+        self.mock_get_exchange_rate = MagicMock(side_effect=lambda source, target: { 'USD': 1.4, 'BRL': 5.0 }[target])
+
+    @freeze_time("2023-07-24 22:30:00", tz_offset=-3)
+    @patch.object(dbh, 'insert_transaction', MagicMock(return_value=TRANSACTION_ID))
+    @patch.object(dbh, 'insert_transactions', MagicMock(return_value=[10, 11, 12]))
+    def test_batch_conversion_endpoint_success(self):
+        # Prepare the test data
+        test_data = [
+            { 'user_id': 1, 'source_currency': 'EUR', 'target_currency': 'USD', 'amount': 100 },
+            { 'user_id': 0, 'source_currency': 'EUR', 'target_currency': 'USD', 'amount': 100 },
+            { 'user_id': 2, 'source_currency': 'EUR', 'target_currency': 'BRL', 'amount': 10 },
+            { 'user_id': 1, 'source_currency': 'EUR', 'target_currency': 'USD', 'amount': -1 },
+            { 'user_id': 2, 'source_currency': 'EUR', 'target_currency': 'USD', 'amount': 50 }
+        ]
+
+        # Mock the get_exchange_rate function
+        with patch('exchangeapi.get_exchange_rate', self.mock_get_exchange_rate):
+            response = self.app.post('/convert/batch', json=test_data)
+
+        # assert communication
+        self.assertEqual(response.status_code, 200)
+        results = response.get_json()['results']
+        self.assertEqual(len(results), 5)
+        self.assertEqual(results[0]['transaction_id'], 10)
+        self.assertEqual(results[0]['converted_amount'], 140)
+        self.assertEqual(results[1], { 'error': 'user id "0" is not allowed!' })
+        self.assertEqual(results[2]['transaction_id'], 11)
+        self.assertEqual(results[2]['converted_amount'], 50)
+        self.assertEqual(results[3], { 'error': 'Invalid amount. amount must be a positive number' })
+        self.assertEqual(results[4]['transaction_id'], 12)
+        self.assertEqual(results[4]['converted_amount'], 70)
+
+        # each distinct currency pair is resolved once
+        self.assertEqual(self.mock_get_exchange_rate.call_count, 2)
+
+        # assert persistency (one bulk insert for the whole batch)
+        dbh.insert_transaction.assert_not_called()
+        dbh.insert_transactions.assert_called_once_with([
+            (1, 'EUR', 100, 'USD', 140, 1.4, '2023-07-24T19:30:00Z'),
+            (2, 'EUR', 10, 'BRL', 50, 5.0, '2023-07-24T19:30:00Z'),
+            (2, 'EUR', 50, 'USD', 70, 1.4, '2023-07-24T19:30:00Z')
+        ])
+
+    def test_convert_batch_rounds_as_convert(self):
+        items = [
+            { 'source_currency': 'USD', 'target_currency': 'JPY', 'amount': 10.05 },
+            { 'source_currency': 'EUR', 'target_currency': 'USD', 'amount': 0.1 },
+            { 'source_currency': 'USD', 'target_currency': 'JPY', 'amount': 10 },
+            # beyond 64 bits of minor units
+            { 'source_currency': 'USD', 'target_currency': 'JPY', 'amount': 10 ** 17 }
+        ]
+        rates = [141.085, 1.104252, 141.085, 141.085]
+
+        self.assertEqual(convert_batch(items, rates),
+                         [convert_amount(item['amount'], rate, item['source_currency'], item['target_currency'])
+                          for item, rate in zip(items, rates)])
+        self.assertEqual(convert_batch(items, rates)[:3], [1418, 0.11, 1411])
+
+    @patch.object(dbh, 'insert_transactions', MagicMock(return_value=[]))
+    def test_batch_conversion_endpoint_with_exchange_rate_failure(self):
+        test_data = [
+            { 'user_id': 1, 'source_currency': 'EUR', 'target_currency': 'WTF', 'amount': 100 },
+            { 'user_id': 2, 'source_currency': 'EUR', 'target_currency': 'WTF', 'amount': 10 }
+        ]
+
+        failure = MagicMock(side_effect=ValueError('exchange rate for WTF not available in the external API response'))
+        with patch('exchangeapi.get_exchange_rate', failure):
+            response = self.app.post('/convert/batch', json=test_data)
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.get_json()['results'],
+                         [{ 'error': 'exchange rate for WTF not available in the external API response' }] * 2)
+        failure.assert_called_once_with('EUR', 'WTF')
+        dbh.insert_transactions.assert_not_called()
+
+    @patch.object(dbh, 'insert_transactions', MagicMock(return_value=[10, 11]))
+    def test_batch_conversion_endpoint_rate_limited(self):
+        test_data = [
+            { 'user_id': 1, 'source_currency': 'EUR', 'target_currency': 'USD', 'amount': 100 },
+            { 'user_id': 1, 'source_currency': 'EUR', 'target_currency': 'BRL', 'amount': 10 }
+        ]
+
+        # every conversion of a batch takes a token of its user
+        with tempfile.TemporaryDirectory() as directory:
+            limits = DatabaseHandler(os.path.join(directory, 'limits.db'))
+            limits.create_tables()
+            with patch('exchangeapi.rate_limiter', UserRateLimiter(limits, 0.01, 3)), \
+                 patch('exchangeapi.get_exchange_rate', self.mock_get_exchange_rate):
+                first = self.app.post('/convert/batch', json=test_data)
+                second = self.app.post('/convert/batch', json=test_data)
+                too_large = self.app.post('/convert/batch', json=test_data * 2)
+            limits.close()
+
+        self.assertEqual(first.status_code, 200)
+        self.assertEqual(second.status_code, 429)
+        self.assertEqual(second.headers['Retry-After'], '100')
+        self.assertEqual(too_large.status_code, 400)
+        self.assertEqual(too_large.get_json()['message'],
+                         'Invalid batch. user id "1" has 4 conversions, more than its rate limit burst of 3')
+        dbh.insert_transactions.assert_called_once()
+
+    @patch.object(dbh, 'insert_transactions', MagicMock(return_value=[10]))
+    def test_batch_conversion_endpoint_with_invalid_currency(self):
+        test_data = [
+            { 'user_id': 1, 'source_currency': ['EUR'], 'target_currency': 'USD', 'amount': 100 },
+            { 'user_id': 1, 'source_currency': 'EUR', 'target_currency': { 'code': 'USD' }, 'amount': 100 },
+            { 'user_id': 1, 'source_currency': 'EUR', 'target_currency': 'USD', 'amount': 100 }
+        ]
+
+        with patch('exchangeapi.get_exchange_rate', self.mock_get_exchange_rate):
+            response = self.app.post('/convert/batch', json=test_data)
+
+        self.assertEqual(response.status_code, 200)
+        results = response.get_json()['results']
+        self.assertEqual(results[:2], [{ 'error': 'Invalid currency. source_currency and target_currency must be strings' }] * 2)
+        self.assertEqual(results[2]['transaction_id'], 10)
+
+    @patch.object(dbh, 'insert_transactions', MagicMock(return_value=[10]))
+    def test_batch_conversion_endpoint_with_unhashable_user(self):
+        test_data = [
+            { 'user_id': [1], 'source_currency': 'EUR', 'target_currency': 'USD', 'amount': 100 },
+            { 'user_id': { 'id': 1 }, 'source_currency': 'EUR', 'target_currency': 'USD', 'amount': 100 },
+            { 'user_id': 1, 'source_currency': 'EUR', 'target_currency': 'USD', 'amount': 100 }
+        ]
+
+        with patch('exchangeapi.get_exchange_rate', self.mock_get_exchange_rate):
+            response = self.app.post('/convert/batch', json=test_data)
+
+        # a per item error, the valid item is still converted
+        self.assertEqual(response.status_code, 200)
+        results = response.get_json()['results']
+        self.assertEqual(results[:2], [{ 'error': 'user id "[1]" is not allowed!' },
+                                       { 'error': 'user id "{\'id\': 1}" is not allowed!' }])
+        self.assertEqual(results[2]['transaction_id'], 10)
+
+    @patch.object(dbh, 'insert_transactions', MagicMock(return_value=[]))
+    def test_batch_conversion_endpoint_with_too_large_batch(self):
+        test_data = [{ 'user_id': 1, 'source_currency': 'EUR', 'target_currency': 'USD', 'amount': 100 }] * 3
+
+        with patch('exchangeapi.MAX_BATCH_SIZE', 2), \
+             patch('exchangeapi.get_exchange_rate', self.mock_get_exchange_rate):
+            response = self.app.post('/convert/batch', json=test_data)
+
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.get_json()['message'], 'Invalid batch. a batch has at most 2 conversions')
+        self.mock_get_exchange_rate.assert_not_called()
+        dbh.insert_transactions.assert_not_called()
+
+    def test_batch_conversion_endpoint_with_invalid_batch(self):
+        response = self.app.post('/convert/batch', json={ 'user_id': 1 })
+
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.get_json()['message'], 'Invalid batch. expected a non-empty list of conversions')
+
+class TestMetricsEndpoint(unittest.TestCase):
+    def setUp(self):
+        self.app = app.test_client()
+
+    @patch.object(dbh, 'insert_transaction', MagicMock(return_value=TRANSACTION_ID))
+    def test_metrics_endpoint(self):
+        test_data = { 'user_id': 1, 'source_currency': 'EUR', 'target_currency': 'USD', 'amount': 100 }
+
+        with patch('exchangeapi.get_exchange_rate', MagicMock(return_value=1.4)):
+            self.app.post('/convert', json=test_data)
+        self.app.post('/convert', json=dict(test_data, user_id=0))
+
+        response = self.app.get('/metrics')
+
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.content_type.startswith('text/plain'))
+        text = response.get_data(as_text=True)
+        for stage in ('parse', 'rate_lookup', 'persist', 'serialize'):
+            self.assertIn(f'exchangeapi_stage_duration_seconds_count{{stage="{stage}"}}', text)
+        self.assertIn('exchangeapi_db_duration_seconds_count{operation="insert_transaction"}', text)
+        self.assertIn('exchangeapi_request_duration_seconds_count{endpoint="/convert"}', text)
+        self.assertIn('exchangeapi_rejected_requests_total{reason="invalid_request"}', text)
+        self.assertIn('exchangeapi_rate_cache_events_total{result="hits"}', text)
+
+    def test_profile_endpoint_disabled(self):
+        response = self.app.get('/debug/profile')
+
+        self.assertEqual(response.status_code, 404)
+
 TEST_DATA = [
             {
                 'transaction_id': 1,
@@ -217,6 +598,108 @@ class TestUserTransactionsEndpoint(unittest.TestCase):
         dbh.insert_transaction.assert_not_called()
         dbh.get_user_transactions.assert_called_once_with(1)
 
+    @patch.object(dbh, 'get_user_transactions', MagicMock(return_value=TEST_DATA))
+    def test_user_transaction_endpoint_with_pagination(self):
+        # send a GET request for a page of the user transactions
+        response = self.app.get('/transactions/1?limit=2&after=0')
+
+        # assert communication
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.get_json(), TEST_DATA)
+        self.assertEqual(response.headers['X-Next-After'], '2')
+
+        # assert persistency
+        dbh.get_user_transactions.assert_called_once_with(1, limit=2, after=0)
+
+    @patch.object(dbh, 'get_user_transactions', MagicMock(return_value=TEST_DATA[1:]))
+    def test_user_transaction_endpoint_with_last_page(self):
+        response = self.app.get('/transactions/1?limit=2&after=1')
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.get_json(), TEST_DATA[1:])
+        self.assertNotIn('X-Next-After', response.headers)
+        dbh.get_user_transactions.assert_called_once_with(1, limit=2, after=1)
+
+    @patch.object(dbh, 'get_user_transactions', MagicMock(return_value=[]))
+    def test_user_transaction_endpoint_with_invalid_limit(self):
+        response = self.app.get('/transactions/1?limit=abc')
+
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.get_json()['message'], 'Invalid limit. limit must be an integer greater than or equal to 1')
+        dbh.get_user_transactions.assert_not_called()
+
+    @patch.object(dbh, 'iter_user_transactions', MagicMock(side_effect=lambda user_id, after: iter(TEST_DATA)))
+    def test_user_transaction_endpoint_with_ndjson_stream(self):
+        response = self.app.get('/transactions/1?stream=ndjson')
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.mimetype, 'application/x-ndjson')
+        lines = response.get_data(as_text=True).splitlines()
+        self.assertEqual([json.loads(line) for line in lines], TEST_DATA)
+        dbh.iter_user_transactions.assert_called_once_with(1, after=None)
+
+    @patch.object(dbh, 'iter_user_transactions', MagicMock(side_effect=lambda user_id, after: iter(TEST_DATA)))
+    def test_user_transaction_endpoint_with_json_stream(self):
+        response = self.app.get('/transactions/1?stream=json&after=5')
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.get_json(), TEST_DATA)
+        dbh.iter_user_transactions.assert_called_once_with(1, after=5)
+
+    @patch.object(dbh, 'get_user_summary', MagicMock(return_value=[{ 'day': '2023-07-21', 'transactions': 2 }]))
+    def test_user_transactions_summary_endpoint_success(self):
+        response = self.app.get('/transactions/1/summary?group_by=day&since=2023-07-01')
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.get_json(), [{ 'day': '2023-07-21', 'transactions': 2 }])
+        dbh.get_user_summary.assert_called_once_with(1, ['day'], since='2023-07-01', until=None)
+
+    @patch.object(dbh, 'get_user_summary', MagicMock(return_value=[]))
+    def test_user_transactions_summary_endpoint_default_groups(self):
+        response = self.app.get('/transactions/1/summary')
+
+        self.assertEqual(response.status_code, 200)
+        dbh.get_user_summary.assert_called_once_with(1, ['day', 'pair'], since=None, until=None)
+
+    @patch.object(dbh, 'get_user_summary', MagicMock(return_value=[]))
+    def test_user_transactions_summary_endpoint_with_invalid_group(self):
+        response = self.app.get('/transactions/1/summary?group_by=day,hour')
+
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.get_json()['message'],
+                         'Invalid group_by. groups must be in: day, pair, source_currency, target_currency')
+        dbh.get_user_summary.assert_not_called()
+
+    @patch.object(dbh, 'iter_transaction_chunks', MagicMock(return_value=iter([])))
+    def test_transactions_export_endpoint_disabled(self):
+        response = self.app.get('/transactions/export')
+
+        self.assertEqual(response.status_code, 404)
+        self.assertEqual(response.get_json()['message'],
+                         'transactions export disabled, set TRANSACTIONS_EXPORT_ENDPOINT=1 to enable it')
+        dbh.iter_transaction_chunks.assert_not_called()
+
+    @patch.dict('exchangeapi.settings', { 'TRANSACTIONS_EXPORT_ENDPOINT': '1' })
+    @patch.object(dbh, 'iter_transaction_chunks', MagicMock(return_value=iter([[(1, 1, 'EUR', 100.0, 'USD', 110.0, 1.1, '2023-07-22T09:15:00Z')]])))
+    def test_transactions_export_endpoint_csv(self):
+        response = self.app.get('/transactions/export?since=2023-07-01&until=2023-08-01')
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.mimetype, 'text/csv')
+        self.assertEqual(response.get_data(as_text=True),
+                         'id,user_id,source_currency,amount,target_currency,converted_amount,exchange_rate,timestamp\n'
+                         '1,1,EUR,100.0,USD,110.0,1.1,2023-07-22T09:15:00Z\n')
+        dbh.iter_transaction_chunks.assert_called_once_with('2023-07-01T00:00:00Z', '2023-08-01T00:00:00Z', 10000)
+
+    @patch.dict('exchangeapi.settings', { 'TRANSACTIONS_EXPORT_ENDPOINT': '1' })
+    @patch.object(dbh, 'iter_transaction_chunks', MagicMock(return_value=iter([])))
+    def test_transactions_export_endpoint_with_invalid_format(self):
+        response = self.app.get('/transactions/export?format=xml')
+
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.get_json()['message'], 'Invalid format. format must be in: csv, columnar')
+        dbh.iter_transaction_chunks.assert_not_called()
+
 API_RESPONSE_SUCCESS_JSON = '''
 {
   "success": true,
@@ -252,6 +735,10 @@ API_RESPONSE_FAILURE_JSON = '''
 @patch.dict(os.environ, {"ACCESS_KEY": "123key456"})
 class TestGetExchangeRateFunction(unittest.TestCase):
     def setUp(self):
+        rate_cache.clear()
+        for provider in rate_source.providers:
+            provider.breaker.reset()
+
         r = requests.Response()
         r.status_code = 200
         r.encoding = 'UTF-8'
@@ -269,45 +756,127 @@ class TestGetExchangeRateFunction(unittest.TestCase):
         self.mock_requests_get_with_other_server_error = MagicMock(return_value=r)
 
     def test_get_exchange_rate_success(self):
-        # Mock the requests.get() function
-        with patch('requests.get', self.mock_requests_get):
+        # Mock the requests.Session.get() function
+        with patch('requests.Session.get', self.mock_requests_get):
             exchange_rate = get_exchange_rate('EUR', 'USD')
 
         self.assertEqual(exchange_rate, 1.104252)
-        self.mock_requests_get.assert_called_once_with('http://api.exchangeratesapi.io/latest?base=EUR&access_key=123key456')
+        self.mock_requests_get.assert_called_once_with('http://api.exchangeratesapi.io/latest?base=EUR&access_key=123key456', timeout=5.0)
+
+    def test_get_exchange_rate_from_cache(self):
+        # Mock the requests.Session.get() function
+        with patch('requests.Session.get', self.mock_requests_get):
+            self.assertEqual(get_exchange_rate('EUR', 'USD'), 1.104252)
+            self.assertEqual(get_exchange_rate('EUR', 'BRL'), 5.244123)
+
+        # the whole rates table is cached, so only one call is made
+        self.mock_requests_get.assert_called_once_with('http://api.exchangeratesapi.io/latest?base=EUR&access_key=123key456', timeout=5.0)
+
+    def test_get_exchange_rate_with_cross_rate(self):
+        # Mock the requests.Session.get() function
+        with patch('requests.Session.get', self.mock_requests_get):
+            self.assertAlmostEqual(get_exchange_rate('USD', 'BRL'), 5.244123 / 1.104252)
+            self.assertAlmostEqual(get_exchange_rate('BRL', 'EUR'), 1 / 5.244123)
+            self.assertEqual(get_exchange_rate('USD', 'USD'), 1)
+
+        # every pair is computed from the single EUR based table
+        self.mock_requests_get.assert_called_once_with('http://api.exchangeratesapi.io/latest?base=EUR&access_key=123key456', timeout=5.0)
 
     def test_get_exchange_rate_with_source_currency_not_supported(self):
-        with self.assertRaises(ValueError) as cm:
-            exchange_rate = get_exchange_rate('USD', 'BRL')
+        # Mock the requests.Session.get() function
+        with patch('requests.Session.get', self.mock_requests_get):
+            with self.assertRaises(ValueError) as cm:
+                exchange_rate = get_exchange_rate('WTF', 'BRL')
 
-        self.assertEqual(str(cm.exception), 'free API supports only EUR as base currency')
+            self.assertEqual(str(cm.exception), 'exchange rate for WTF not available in the external API response')
 
     def test_get_exchange_rate_with_target_currency_not_supported(self):
-        # Mock the requests.get() function
-        with patch('requests.get', self.mock_requests_get):
+        # Mock the requests.Session.get() function
+        with patch('requests.Session.get', self.mock_requests_get):
             with self.assertRaises(ValueError) as cm:
                 exchange_rate = get_exchange_rate('EUR', 'WTF')
 
             self.assertEqual(str(cm.exception), 'exchange rate for WTF not available in the external API response')
-            self.mock_requests_get.assert_called_once_with('http://api.exchangeratesapi.io/latest?base=EUR&access_key=123key456')
+            self.mock_requests_get.assert_called_once_with('http://api.exchangeratesapi.io/latest?base=EUR&access_key=123key456', timeout=5.0)
 
     def test_get_exchange_rate_with_api_call_internal_server_error(self):
-        # Mock the requests.get() function
-        with patch('requests.get', self.mock_requests_get_with_internal_server_error):
+        # Mock the requests.Session.get() function
+        with patch('requests.Session.get', self.mock_requests_get_with_internal_server_error):
             with self.assertRaises(RuntimeError) as cm:
                 exchange_rate = get_exchange_rate('EUR', 'USD')
 
             self.assertEqual(str(cm.exception), "failure getting exchange rate on the external API. Status Code: 500")
-            self.mock_requests_get_with_internal_server_error.assert_called_once_with('http://api.exchangeratesapi.io/latest?base=EUR&access_key=123key456')
+            self.assertGreaterEqual(UPSTREAM_ERRORS.value(provider='exchangeratesapi', status_code='500'), 1)
+            self.mock_requests_get_with_internal_server_error.assert_called_once_with('http://api.exchangeratesapi.io/latest?base=EUR&access_key=123key456', timeout=5.0)
 
     def test_get_exchange_rate_with_api_call_other_server_error(self):
-        # Mock the requests.get() function
-        with patch('requests.get', self.mock_requests_get_with_other_server_error):
-            with self.assertRaises(ValueError) as cm:
+        # Mock the requests.Session.get() function
+        with patch('requests.Session.get', self.mock_requests_get_with_other_server_error):
+            with self.assertRaises(RateProviderError) as cm:
                 exchange_rate = get_exchange_rate('EUR', 'USD')
 
             self.assertEqual(str(cm.exception), "failure getting exchange rate on the external API. Error: {'code': 101, 'type': 'invalid_access_key', 'info': 'You have not supplied a valid API Access Key'}")
-            self.mock_requests_get_with_other_server_error.assert_called_once_with('http://api.exchangeratesapi.io/latest?base=EUR&access_key=123key456')
+            self.mock_requests_get_with_other_server_error.assert_called_once_with('http://api.exchangeratesapi.io/latest?base=EUR&access_key=123key456', timeout=5.0)
+
+PROJECT_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+
+# run in a new interpreter, as create_app replaces the app components of the
+# process
+FACTORY_SCRIPT = '''
+import os, sys, json
+import exchangeapi
+app = exchangeapi.create_app(database_file=sys.argv[1], RATE_CACHE_TTL='600')
+exchangeapi.warmup()
+for _ in range(2):
+    pid = os.fork()
+    if pid == 0:
+        response = app.test_client().post('/convert', json={ 'user_id': 1, 'source_currency': 'EUR',
+                                                             'target_currency': 'USD', 'amount': 100 })
+        print(json.dumps([response.status_code, response.get_json()['transaction_id']]), flush=True)
+        os._exit(0)
+    os.waitpid(pid, 0)
+'''
+
+@unittest.skipUnless(hasattr(os, 'fork'), 'needs fork')
+class TestAppFactory(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.server = StubRateServer().start()
+        self.env = dict(os.environ, PYTHONPATH=PROJECT_DIR, ACCESS_KEY='123key456', EXCHANGE_API_URL=self.server.url)
+
+    def tearDown(self):
+        self.server.stop()
+        self.directory.cleanup()
+
+    def test_import_touches_no_database(self):
+        subprocess.run([sys.executable, '-c', 'import exchangeapi'], cwd=self.directory.name, env=self.env, check=True)
+
+        self.assertEqual(os.listdir(self.directory.name), [])
+
+    def test_create_app_prefetches_the_base_table(self):
+        script = ('import exchangeapi\n'
+                  'print(exchangeapi.create_app(RATE_PREFETCH=1, RATE_BASE_CURRENCY="USD") and exchangeapi.rate_prefetcher.currencies)\n'
+                  'print(exchangeapi.create_app() and exchangeapi.rate_prefetcher)')
+        result = subprocess.run([sys.executable, '-c', script], cwd=self.directory.name,
+                                env=self.env, capture_output=True, text=True, check=True)
+
+        # every pair is served from the base currency table, nothing else is
+        # worth prefetching
+        self.assertEqual(result.stdout.splitlines(), ["['USD']", 'None'])
+
+    def test_create_app_with_warmup_before_fork(self):
+        database_file = os.path.join(self.directory.name, 'factory.db')
+        result = subprocess.run([sys.executable, '-c', FACTORY_SCRIPT, database_file], cwd=self.directory.name,
+                                env=self.env, capture_output=True, text=True, check=True)
+
+        # both workers converted with the rates loaded by the master, into
+        # the given database
+        self.assertEqual([json.loads(line) for line in result.stdout.splitlines()], [[200, 1], [200, 2]])
+        self.assertEqual(self.server.request_count, 1)
+        factory_dbh = DatabaseHandler(database_file)
+        self.assertEqual(len(factory_dbh.get_user_transactions(1)), 2)
+        factory_dbh.close()
+        self.assertNotIn('currency_conversion.db', os.listdir(self.directory.name))
 
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,135 @@
+import unittest, os, json, sqlite3, tempfile, threading, time
+from unittest.mock import patch, MagicMock
+from database import DatabaseHandler
+from idempotency import IdempotencyStore, IdempotencyKeyInProgress, IdempotencyKeyReused
+
+RESPONSE = { 'transaction_id': 1, 'converted_amount': 110.4 }
+
+class TestIdempotencyStore(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.dbh = DatabaseHandler(os.path.join(self.directory.name, 'idempotency.db'))
+        self.dbh.create_tables()
+        self.store = IdempotencyStore(self.dbh, wait_timeout=2, poll_interval=0.01)
+
+    def tearDown(self):
+        self.dbh.close()
+        self.directory.cleanup()
+
+    def test_idempotency_store_replays_response(self):
+        execute = MagicMock(return_value=RESPONSE)
+
+        self.assertEqual(self.store.run('key-1', 'a', execute), (RESPONSE, False))
+        self.assertEqual(self.store.run('key-1', 'a', execute), (RESPONSE, True))
+        execute.assert_called_once_with()
+
+        # also from the database, e.g. in another process or after a restart
+        store = IdempotencyStore(self.dbh)
+        self.assertEqual(store.run('key-1', 'a', execute), (RESPONSE, True))
+        execute.assert_called_once_with()
+
+    def test_idempotency_store_with_reused_key(self):
+        self.store.run('key-1', 'a', MagicMock(return_value=RESPONSE))
+
+        with self.assertRaises(IdempotencyKeyReused) as cm:
+            self.store.run('key-1', 'b', MagicMock(return_value=RESPONSE))
+        self.assertEqual(str(cm.exception), 'Idempotency-Key "key-1" was already used with a different request')
+
+    def test_idempotency_store_failure_releases_key(self):
+        with self.assertRaises(RuntimeError):
+            self.store.run('key-1', 'a', MagicMock(side_effect=RuntimeError('upstream failure')))
+
+        # the retry runs again
+        self.assertEqual(self.store.run('key-1', 'a', MagicMock(return_value=RESPONSE)), (RESPONSE, False))
+
+    def test_idempotency_store_concurrent_duplicates_wait(self):
+        calls = []
+
+        def execute():
+            calls.append(1)
+            time.sleep(0.2)
+            return RESPONSE
+
+        results = []
+        def run():
+            results.append(self.store.run('key-1', 'a', execute))
+
+        threads = [threading.Thread(target=run) for _ in range(8)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(sorted(replayed for _, replayed in results), [False] + [True] * 7)
+        self.assertTrue(all(response == RESPONSE for response, _ in results))
+
+    def test_idempotency_store_waits_on_another_process(self):
+        # another process claimed the key and is still running
+        now = time.time()
+        self.assertTrue(self.dbh.claim_idempotency_key('key-1', 'a', now, now - 60))
+        self.assertFalse(self.dbh.claim_idempotency_key('key-1', 'a', now, now - 60))
+
+        threading.Timer(0.1, self.dbh.complete_idempotency_key, ('key-1', '{"transaction_id": 1}')).start()
+        execute = MagicMock(return_value=RESPONSE)
+        self.assertEqual(self.store.run('key-1', 'a', execute), ({ 'transaction_id': 1 }, True))
+        execute.assert_not_called()
+
+        self.dbh.claim_idempotency_key('key-2', 'a', now, now - 60)
+        store = IdempotencyStore(self.dbh, wait_timeout=0.1, poll_interval=0.01)
+        with self.assertRaises(IdempotencyKeyInProgress):
+            store.run('key-2', 'a', execute)
+
+    def test_idempotency_store_takes_over_abandoned_claim(self):
+        # the process holding the key died before answering
+        self.dbh.claim_idempotency_key('key-1', 'a', time.time() - 120, 0)
+
+        execute = MagicMock(return_value=RESPONSE)
+        self.assertEqual(self.store.run('key-1', 'a', execute), (RESPONSE, False))
+        execute.assert_called_once_with()
+
+    def test_idempotency_store_replays_inserted_transaction(self):
+        def execute():
+            transaction_id = self.dbh.insert_transaction(1, 'EUR', 100.0, 'USD', 110.43, 1.104252,
+                                                         '2023-07-21T12:34:56Z', idempotency_key='key-1')
+            return self.dbh.get_transaction(transaction_id)
+
+        # the transaction is inserted, then storing the response fails
+        failure = sqlite3.OperationalError('database is locked')
+        with patch.object(self.dbh, 'complete_idempotency_key', MagicMock(side_effect=failure)):
+            with self.assertRaises(sqlite3.OperationalError):
+                self.store.run('key-1', 'a', execute)
+
+        # even once the claim expired (e.g. in another process), the retry
+        # gets the inserted transaction instead of inserting another one
+        retry = MagicMock(side_effect=execute)
+        with patch('time.time', MagicMock(return_value=time.time() + 120)):
+            response, replayed = IdempotencyStore(self.dbh).run('key-1', 'a', retry)
+
+        retry.assert_not_called()
+        self.assertTrue(replayed)
+        self.assertEqual(response['converted_amount'], 110.43)
+        self.assertEqual([t['transaction_id'] for t in self.dbh.get_user_transactions(1)], [response['transaction_id']])
+        self.assertEqual(self.dbh.get_idempotency_key('key-1')[1], json.dumps(response))
+
+    def test_idempotency_store_forgets_keys_past_retention(self):
+        store = IdempotencyStore(self.dbh, retention=3600)
+        execute = MagicMock(return_value=RESPONSE)
+
+        with patch('time.time', MagicMock(return_value=1000)):
+            store.run('key-1', 'a', execute)
+            store.run('key-2', 'a', execute)
+        with patch('time.time', MagicMock(return_value=4000)):
+            self.assertEqual(store.run('key-1', 'a', execute), (RESPONSE, True))
+        self.assertEqual(execute.call_count, 2)
+
+        # an hour later key-1 runs again (a new request), and the claim
+        # deletes key-2 as well
+        with patch('time.time', MagicMock(return_value=5000)):
+            self.assertEqual(store.run('key-1', 'b', execute), (RESPONSE, False))
+        self.assertEqual(execute.call_count, 3)
+        self.assertIsNone(self.dbh.get_idempotency_key('key-2'))
+        self.assertEqual(self.dbh.get_idempotency_key('key-1')[:2], ('b', json.dumps(RESPONSE)))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,171 @@
+import unittest, os, tempfile, json, shutil, glob, fcntl, threading, time
+from unittest.mock import patch
+from database import DatabaseHandler
+from journal import WriteBehindWriter
+
+TIMESTAMP = '2023-07-22T09:15:00Z'
+
+class TestWriteBehindWriter(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.journal_file = os.path.join(self.directory, 'transactions.journal')
+
+        self.dbh = DatabaseHandler(os.path.join(self.directory, 'test.db'))
+        self.dbh.create_tables()
+
+    def tearDown(self):
+        self.dbh.close()
+        shutil.rmtree(self.directory)
+
+    def journal_files(self):
+        return sorted(glob.glob(self.journal_file + '*'))
+
+    def journaled_records(self):
+        records = 0
+        for path in self.journal_files():
+            with open(path) as journal:
+                records += sum(1 for _ in journal)
+        return records
+
+    def test_write_behind_group_commit(self):
+        writer = WriteBehindWriter(self.dbh, self.journal_file, batch_size=100, flush_interval=0.5).start()
+        try:
+            transaction_ids = [writer.submit(1, 'EUR', i, 'USD', i * 1.1, 1.1, TIMESTAMP) for i in range(1, 51)]
+            transaction_ids += writer.submit_many([(2, 'EUR', 10, 'BRL', 50, 5.0, TIMESTAMP)] * 10)
+
+            self.assertTrue(writer.flush(timeout=5))
+        finally:
+            writer.close()
+
+        # ids are allocated up front and the records are committed together
+        self.assertEqual(len(set(transaction_ids)), 60)
+        self.assertEqual(writer.records_written, 60)
+        self.assertLess(writer.batches_written, 60)
+
+        transactions = self.dbh.get_user_transactions(1)
+        self.assertEqual([t['transaction_id'] for t in transactions], transaction_ids[:50])
+        self.assertEqual(transactions[9]['amount'], 10)
+        self.assertEqual(len(self.dbh.get_user_transactions(2)), 10)
+
+        # nothing is left in the journal once it is committed
+        self.assertEqual(self.journal_files(), [])
+
+    def test_write_behind_ids_do_not_collide_with_inserts(self):
+        writer = WriteBehindWriter(self.dbh, self.journal_file, id_block_size=10).start()
+        try:
+            queued_id = writer.submit(1, 'EUR', 100, 'USD', 110, 1.1, TIMESTAMP)
+            inserted_id = self.dbh.insert_transaction(1, 'EUR', 100, 'USD', 110, 1.1, TIMESTAMP)
+            writer.flush(timeout=5)
+        finally:
+            writer.close()
+
+        self.assertGreater(inserted_id, queued_id + 9)
+        self.assertEqual(len(self.dbh.get_user_transactions(1)), 2)
+
+    def test_write_behind_flushes_on_close(self):
+        writer = WriteBehindWriter(self.dbh, self.journal_file, batch_size=1000, flush_interval=60).start()
+        writer.submit(1, 'EUR', 100, 'USD', 110, 1.1, TIMESTAMP)
+        writer.close()
+
+        self.assertEqual(len(self.dbh.get_user_transactions(1)), 1)
+        with self.assertRaises(RuntimeError):
+            writer.submit(1, 'EUR', 100, 'USD', 110, 1.1, TIMESTAMP)
+
+    def test_write_behind_replays_journal(self):
+        transaction_ids = self.dbh.reserve_transaction_ids(3)
+
+        # a journal left behind by a crash, the first record was already
+        # committed and the last one was cut in the middle
+        self.dbh.write_transactions([(transaction_ids[0], 1, 'EUR', 100, 'USD', 110, 1.1, TIMESTAMP)])
+        with open(self.journal_file, 'w') as journal:
+            for transaction_id in transaction_ids[:2]:
+                journal.write(json.dumps([transaction_id, 1, 'EUR', 100, 'USD', 110, 1.1, TIMESTAMP]) + '\n')
+            journal.write(json.dumps([transaction_ids[2], 1, 'EUR', 100])[:10])
+
+        writer = WriteBehindWriter(self.dbh, self.journal_file).start()
+        writer.close()
+
+        transactions = self.dbh.get_user_transactions(1)
+        self.assertEqual([t['transaction_id'] for t in transactions], list(transaction_ids[:2]))
+        self.assertEqual(self.journal_files(), [])
+
+    def test_write_behind_replays_only_dead_processes_journals(self):
+        orphan_id, = self.dbh.reserve_transaction_ids(1)
+        with open(f'{self.journal_file}.999999-0', 'w') as journal:
+            journal.write(json.dumps([orphan_id, 1, 'EUR', 100, 'USD', 110, 1.1, TIMESTAMP]) + '\n')
+
+        # another worker of the same journal, with a record not committed yet
+        worker = WriteBehindWriter(self.dbh, self.journal_file, batch_size=1000, flush_interval=60).start()
+        try:
+            queued_id = worker.submit(2, 'EUR', 100, 'USD', 110, 1.1, TIMESTAMP)
+            self.assertEqual(len(self.journal_files()), 1)
+
+            # a new worker replays the dead one, and keeps off the live one
+            writer = WriteBehindWriter(self.dbh, self.journal_file)
+            self.assertEqual(writer.replay(), 0)
+            self.assertEqual(len(self.journal_files()), 1)
+            self.assertEqual(self.dbh.get_user_transactions(2), [])
+        finally:
+            worker.close()
+
+        self.assertEqual([t['transaction_id'] for t in self.dbh.get_user_transactions(1)], [orphan_id])
+        self.assertEqual([t['transaction_id'] for t in self.dbh.get_user_transactions(2)], [queued_id])
+        self.assertEqual(self.journal_files(), [])
+
+    def test_write_behind_segment_is_locked_before_it_is_visible(self):
+        worker = WriteBehindWriter(self.dbh, self.journal_file, flush_interval=60).start()
+        other = WriteBehindWriter(self.dbh, self.journal_file)
+
+        # another worker replays right as this one opens a new segment
+        flock = fcntl.flock
+        def replay_then_lock(fd, operation):
+            if operation == fcntl.LOCK_EX:
+                self.assertEqual(other.replay(), 0)
+            flock(fd, operation)
+
+        try:
+            with patch('fcntl.flock', replay_then_lock):
+                queued_id = worker.submit(2, 'EUR', 100, 'USD', 110, 1.1, TIMESTAMP)
+
+            # the segment was left alone, the record is still journaled
+            self.assertEqual(self.journaled_records(), 1)
+        finally:
+            worker.close()
+
+        self.assertEqual([t['transaction_id'] for t in self.dbh.get_user_transactions(2)], [queued_id])
+        self.assertEqual(self.journal_files(), [])
+
+    def test_write_behind_journal_does_not_grow_without_draining(self):
+        writes = threading.Semaphore(0)
+        write_transactions = self.dbh.write_transactions
+
+        def slow_write(records):
+            writes.acquire()
+            write_transactions(records)
+
+        writer = WriteBehindWriter(self.dbh, self.journal_file, batch_size=1, flush_interval=0).start()
+        try:
+            with patch.object(self.dbh, 'write_transactions', slow_write):
+                # a record is always queued, the queue never drains
+                for i in range(5):
+                    writer.submit(1, 'EUR', 100, 'USD', 110, 1.1, TIMESTAMP)
+                    if i:
+                        writes.release()
+                        deadline = time.monotonic() + 5
+                        while writer.records_written < i and time.monotonic() < deadline:
+                            time.sleep(0.01)
+
+                # only the record still queued is in the journal
+                self.assertEqual(writer.records_written, 4)
+                self.assertEqual(self.journaled_records(), 1)
+
+                writes.release()
+                self.assertTrue(writer.flush(timeout=5))
+        finally:
+            writer.close()
+
+        self.assertEqual(len(self.dbh.get_user_transactions(1)), 5)
+        self.assertEqual(self.journal_files(), [])
+
+if __name__ == '__main__':
+    unittest.main()
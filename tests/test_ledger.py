@@ -0,0 +1,105 @@
+import unittest, os, io, tempfile
+from database import DatabaseHandler
+from freezegun import freeze_time
+from ratehistory import parse_timestamp
+from ledger import csv_blocks, columnar_blocks, read_csv_rows, read_columnar_chunks, export_blocks, import_file
+
+ROWS = [
+    (1, 1, 'EUR', 100.0, 'USD', 110.42, 1.104252, '2023-07-21T12:34:56Z'),
+    (2, 2, 'EUR', 50.0, 'BRL', 262.21, 5.244123, '2023-07-22T09:15:00Z'),
+    (3, 1, 'USD', 0.1, 'EUR', 0.09, 0.905591, '2023-07-22T09:15:00Z'),
+    (4, 3, 'JPY', 12345.0, 'GBP', 67.91, 0.005501, '2023-08-01T00:00:00Z')
+]
+
+class TestLedger(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.dbh = DatabaseHandler(os.path.join(self.directory.name, 'source.db'))
+        self.dbh.create_tables()
+        self.dbh.import_transactions(ROWS)
+
+    def tearDown(self):
+        self.dbh.close()
+        self.directory.cleanup()
+
+    def test_csv_round_trip(self):
+        data = ''.join(csv_blocks([ROWS[:2], ROWS[2:]]))
+
+        self.assertTrue(data.startswith('id,user_id,source_currency,amount,target_currency,converted_amount,exchange_rate,timestamp\n'))
+        self.assertEqual(list(read_csv_rows(io.StringIO(data))), ROWS)
+
+    def test_columnar_round_trip(self):
+        data = b''.join(columnar_blocks([ROWS[:3], ROWS[3:]]))
+
+        chunks = list(read_columnar_chunks(io.BytesIO(data)))
+        self.assertEqual(chunks, [ROWS[:3], ROWS[3:]])
+
+    def test_text_and_null_user_ids(self):
+        # rows of clients that sent a text user id, or none at all
+        rows = ROWS + [
+            (5, 'John Doe', 'EUR', 10.0, 'USD', 11.04, 1.104252, '2023-08-02T00:00:00Z'),
+            (6, None, 'EUR', 20.0, 'USD', 22.09, 1.104252, '2023-08-02T00:00:00Z'),
+            (7, 'John Doe', 'USD', 30.0, 'EUR', 27.17, 0.905591, '2023-08-03T00:00:00Z')
+        ]
+        self.dbh.import_transactions(rows[4:])
+        self.assertEqual(list(self.dbh.iter_transaction_chunks()), [rows])
+
+        self.assertEqual(list(read_csv_rows(io.StringIO(''.join(csv_blocks([rows]))))), rows)
+        for export_format in ('csv', 'columnar'):
+            data = b''.join(block.encode('UTF-8') if isinstance(block, str) else block
+                            for block in export_blocks(self.dbh, export_format))
+
+            target = DatabaseHandler(os.path.join(self.directory.name, f'{export_format}.db'))
+            target.create_tables()
+            try:
+                self.assertEqual(import_file(target, io.BytesIO(data), export_format), 7)
+                self.assertEqual(list(target.iter_transaction_chunks()), [rows])
+            finally:
+                target.close()
+
+    def test_columnar_invalid_file(self):
+        with self.assertRaises(ValueError) as cm:
+            list(read_columnar_chunks(io.BytesIO(b'id,user_id\n')))
+        self.assertEqual(str(cm.exception), 'Invalid columnar export. unknown file header')
+
+        data = b''.join(columnar_blocks([ROWS]))
+        with self.assertRaises(ValueError) as cm:
+            list(read_columnar_chunks(io.BytesIO(data[:-20])))
+        self.assertEqual(str(cm.exception), 'Invalid columnar export. the file is truncated')
+
+    def test_export_chunks_and_time_range(self):
+        chunks = list(self.dbh.iter_transaction_chunks(chunk_size=3))
+        self.assertEqual(chunks, [ROWS[:3], ROWS[3:]])
+
+        # 'since' is inclusive and 'until' exclusive
+        chunks = list(self.dbh.iter_transaction_chunks('2023-07-22T09:15:00Z', '2023-08-01T00:00:00Z'))
+        self.assertEqual(chunks, [ROWS[1:3]])
+
+    @freeze_time('2023-08-01 00:00:00', tz_offset=-3)
+    def test_export_range_on_the_clock_of_the_stored_rows(self):
+        # the rows at 09:15 local time (UTC-3) were written at 12:15 UTC
+        data = ''.join(export_blocks(self.dbh, 'csv', parse_timestamp('2023-07-22T12:15:00Z'),
+                                     parse_timestamp('2023-07-22T12:16:00Z')))
+
+        self.assertEqual(list(read_csv_rows(io.StringIO(data))), ROWS[1:3])
+
+    def test_export_and_import(self):
+        for export_format in ('csv', 'columnar'):
+            data = b''.join(block.encode('UTF-8') if isinstance(block, str) else block
+                            for block in export_blocks(self.dbh, export_format, chunk_size=2))
+
+            target = DatabaseHandler(os.path.join(self.directory.name, f'{export_format}.db'))
+            target.create_tables()
+            try:
+                self.assertEqual(import_file(target, io.BytesIO(data), export_format, batch_size=3), 4)
+                self.assertEqual(list(target.iter_transaction_chunks()), [ROWS])
+                # the rollup table is filled by the same trigger as any insert
+                self.assertEqual(target.get_user_summary(1, []), [{ 'transactions': 2 }])
+
+                # rows already there are skipped
+                self.assertEqual(import_file(target, io.BytesIO(data), export_format), 0)
+            finally:
+                target.close()
+
+if __name__ == '__main__':
+    unittest.main()
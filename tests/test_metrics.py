@@ -0,0 +1,76 @@
+import unittest, threading, time
+from metrics import Registry, CallbackMetric, SamplingProfiler
+
+class TestMetrics(unittest.TestCase):
+    def test_counter_render(self):
+        registry = Registry()
+        errors = registry.counter('upstream_errors_total', 'Failed calls', ['status_code'])
+
+        errors.inc(status_code='500')
+        errors.inc(2, status_code='500')
+        errors.inc(status_code='timeout')
+
+        self.assertEqual(errors.value(status_code='500'), 3)
+        self.assertEqual(registry.render(),
+                         '# HELP upstream_errors_total Failed calls\n'
+                         '# TYPE upstream_errors_total counter\n'
+                         'upstream_errors_total{status_code="500"} 3\n'
+                         'upstream_errors_total{status_code="timeout"} 1\n')
+
+    def test_histogram_render(self):
+        registry = Registry()
+        duration = registry.histogram('db_duration_seconds', 'Database time', buckets=(0.01, 0.1))
+
+        duration.observe(0.005)
+        duration.observe(0.01)
+        duration.observe(0.05)
+        duration.observe(3)
+
+        self.assertEqual(duration.count(), 4)
+        self.assertEqual(registry.render(),
+                         '# HELP db_duration_seconds Database time\n'
+                         '# TYPE db_duration_seconds histogram\n'
+                         'db_duration_seconds_bucket{le="0.01"} 2\n'
+                         'db_duration_seconds_bucket{le="0.1"} 3\n'
+                         'db_duration_seconds_bucket{le="+Inf"} 4\n'
+                         'db_duration_seconds_sum 3.065\n'
+                         'db_duration_seconds_count 4\n')
+
+    def test_histogram_time(self):
+        registry = Registry()
+        duration = registry.histogram('stage_duration_seconds', 'Stage time', ['stage'])
+
+        with duration.time(stage='rate_lookup'):
+            pass
+        with self.assertRaises(ValueError):
+            with duration.time(stage='rate_lookup'):
+                raise ValueError()
+
+        self.assertEqual(duration.count(stage='rate_lookup'), 2)
+        self.assertEqual(duration.count(stage='parse'), 0)
+
+    def test_callback_metric_render(self):
+        registry = Registry()
+        registry.register(CallbackMetric('cache_events_total', 'Cache events', 'counter', 'result',
+                                         lambda: { 'hits': 5, 'misses': 1 }))
+
+        self.assertIn('cache_events_total{result="hits"} 5\ncache_events_total{result="misses"} 1\n',
+                      registry.render())
+
+    def test_sampling_profiler(self):
+        def hot_loop(deadline):
+            while time.monotonic() < deadline:
+                pass
+
+        profiler = SamplingProfiler(interval=0.001)
+        profiler.start()
+        worker = threading.Thread(target=hot_loop, args=(time.monotonic() + 0.2,))
+        worker.start()
+        worker.join()
+        profiler.stop()
+
+        self.assertGreater(profiler.samples, 0)
+        self.assertIn('hot_loop', profiler.dump())
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,127 @@
+import unittest, os, time
+from unittest.mock import patch, MagicMock
+from providers import CircuitBreaker, ExchangeRatesApiProvider, ErApiProvider, HedgedRateSource, RateProviderError
+from tools.stub_rate_server import StubRateServer, DEFAULT_RATES
+
+class TestCircuitBreaker(unittest.TestCase):
+    def test_circuit_breaker_opens_after_failures(self):
+        breaker = CircuitBreaker(failure_threshold=2, cooldown=30)
+
+        breaker.record_failure()
+        self.assertTrue(breaker.allow())
+        breaker.record_failure()
+
+        self.assertEqual(breaker.state, 'open')
+        self.assertFalse(breaker.allow())
+
+    def test_circuit_breaker_half_open_probe(self):
+        breaker = CircuitBreaker(failure_threshold=1, cooldown=30)
+        with patch('time.monotonic', MagicMock(return_value=1000)):
+            breaker.record_failure()
+
+        with patch('time.monotonic', MagicMock(return_value=1031)):
+            self.assertEqual(breaker.state, 'half_open')
+            # a single trial call is let through
+            self.assertTrue(breaker.allow())
+            self.assertFalse(breaker.allow())
+
+            breaker.record_failure()
+            self.assertEqual(breaker.state, 'open')
+
+        with patch('time.monotonic', MagicMock(return_value=1062)):
+            self.assertTrue(breaker.allow())
+            breaker.record_success()
+
+        self.assertEqual(breaker.state, 'closed')
+        self.assertTrue(breaker.allow())
+
+@patch.dict(os.environ, {"ACCESS_KEY": "123key456"})
+class TestHedgedRateSource(unittest.TestCase):
+    def setUp(self):
+        self.primary_server = StubRateServer().start()
+        self.secondary_server = StubRateServer(rates={ 'EUR': 1, 'USD': 1.1 }).start()
+        os.environ['EXCHANGE_API_URL'] = self.primary_server.url
+        os.environ['ERAPI_URL'] = self.secondary_server.url
+
+        self.primary = ExchangeRatesApiProvider(timeout=2, breaker=CircuitBreaker(failure_threshold=2, cooldown=30))
+        self.secondary = ErApiProvider(timeout=2, breaker=CircuitBreaker(failure_threshold=2, cooldown=30))
+        self.source = HedgedRateSource([self.primary, self.secondary], hedge_delay=0.1)
+
+    def tearDown(self):
+        self.source.close()
+        del os.environ['EXCHANGE_API_URL']
+        del os.environ['ERAPI_URL']
+        self.primary_server.stop()
+        self.secondary_server.stop()
+
+    def test_hedged_rate_source_uses_primary(self):
+        self.assertEqual(self.source.fetch('EUR'), DEFAULT_RATES)
+
+        self.assertEqual(self.primary_server.request_count, 1)
+        self.assertEqual(self.secondary_server.request_count, 0)
+        self.assertEqual(self.source.hedges, 0)
+
+    def test_hedged_rate_source_hedges_slow_primary(self):
+        self.primary_server.delay = 0.5
+
+        started = time.monotonic()
+        rates = self.source.fetch('EUR')
+
+        # answered by the secondary, without waiting for the primary
+        self.assertEqual(rates, { 'EUR': 1, 'USD': 1.1 })
+        self.assertLess(time.monotonic() - started, 0.4)
+        self.assertEqual(self.source.hedges, 1)
+
+    def test_hedged_rate_source_keeps_half_open_secondary_trial(self):
+        with patch('time.monotonic', MagicMock(return_value=1000)):
+            self.secondary.breaker.record_failure()
+            self.secondary.breaker.record_failure()
+
+        # the cooldown is over, but the primary answers before the hedge
+        # delay: the secondary is not called, so its trial call is not used
+        with patch('providers.time.monotonic', MagicMock(return_value=1031)):
+            self.assertEqual(self.source.fetch('EUR'), DEFAULT_RATES)
+            self.assertEqual(self.secondary.breaker.state, 'half_open')
+
+            # and it is still there when the primary fails
+            self.primary_server.status_code = 500
+            self.assertEqual(self.source.fetch('EUR'), { 'EUR': 1, 'USD': 1.1 })
+
+        self.assertEqual(self.secondary_server.request_count, 1)
+        self.assertEqual(self.secondary.breaker.state, 'closed')
+
+    def test_hedged_rate_source_fails_over(self):
+        self.primary_server.status_code = 500
+
+        self.assertEqual(self.source.fetch('EUR'), { 'EUR': 1, 'USD': 1.1 })
+        self.assertEqual(self.source.hedges, 0)
+        self.assertEqual(self.primary.breaker.failures, 1)
+
+    def test_hedged_rate_source_skips_open_circuit(self):
+        self.primary_server.status_code = 500
+        self.source.fetch('EUR')
+        self.source.fetch('EUR')
+        self.assertEqual(self.primary.breaker.state, 'open')
+
+        # the primary is not called while its circuit is open
+        self.source.fetch('EUR')
+        self.assertEqual(self.primary_server.request_count, 2)
+        self.assertEqual(self.secondary_server.request_count, 3)
+
+    def test_hedged_rate_source_every_provider_failing(self):
+        self.primary_server.status_code = 500
+        self.secondary_server.status_code = 503
+
+        with self.assertRaises(RateProviderError) as cm:
+            self.source.fetch('EUR')
+        self.assertEqual(str(cm.exception), 'failure getting exchange rate on the external API. Status Code: 500')
+
+        with self.assertRaises(RateProviderError):
+            self.source.fetch('EUR')
+
+        with self.assertRaises(RateProviderError) as cm:
+            self.source.fetch('EUR')
+        self.assertEqual(str(cm.exception), 'failure getting exchange rate on the external API. Every provider is unavailable (circuit open)')
+
+if __name__ == '__main__':
+    unittest.main()
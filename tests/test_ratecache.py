@@ -0,0 +1,169 @@
+import unittest, threading, time, os
+from unittest.mock import patch, MagicMock
+from ratecache import RateCache, RatePrefetcher
+# creates the app of the tests on a throwaway database
+import test_exchangeapi
+from exchangeapi import fetch_rates, rate_source
+from tools.stub_rate_server import StubRateServer, DEFAULT_RATES
+
+RATES = { 'USD': 1.104252, 'BRL': 5.244123 }
+
+class TestRateCache(unittest.TestCase):
+    def test_rate_cache_hit_and_miss(self):
+        cache = RateCache(ttl=60)
+        fetch = MagicMock(return_value=RATES)
+
+        self.assertEqual(cache.get('EUR', fetch).rates, RATES)
+        self.assertEqual(cache.get('EUR', fetch).rates, RATES)
+
+        fetch.assert_called_once_with('EUR')
+        self.assertEqual(cache.stats(), { 'hits': 1, 'stale_hits': 0, 'misses': 1, 'refreshes': 1,
+                                          'refresh_errors': 0, 'entries': 1 })
+
+    def test_rate_cache_expired_entry(self):
+        cache = RateCache(ttl=60)
+        fetch = MagicMock(return_value=RATES)
+
+        with patch('time.time', MagicMock(return_value=1000)):
+            cache.get('EUR', fetch)
+        with patch('time.time', MagicMock(return_value=1061)):
+            cache.get('EUR', fetch)
+
+        self.assertEqual(fetch.call_count, 2)
+        self.assertEqual(cache.refreshes, 2)
+
+    def test_rate_cache_failure_is_not_cached(self):
+        cache = RateCache(ttl=60)
+        fetch = MagicMock(side_effect=[RuntimeError('upstream down'), RATES])
+
+        with self.assertRaises(RuntimeError):
+            cache.get('EUR', fetch)
+        self.assertEqual(cache.get('EUR', fetch).rates, RATES)
+        self.assertEqual(fetch.call_count, 2)
+
+    def test_rate_cache_single_flight(self):
+        cache = RateCache(ttl=60)
+        calls = []
+
+        def slow_fetch(base_currency):
+            calls.append(base_currency)
+            time.sleep(0.1)
+            return RATES
+
+        results = []
+        threads = [threading.Thread(target=lambda: results.append(cache.get('EUR', slow_fetch).rates))
+                   for _ in range(10)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+        # concurrent misses collapse into one upstream fetch
+        self.assertEqual(calls, ['EUR'])
+        self.assertEqual(results, [RATES] * 10)
+        self.assertEqual(cache.refreshes, 1)
+
+    def test_rate_cache_serves_stale_table_while_refreshing(self):
+        cache = RateCache(ttl=60, max_staleness=300)
+        refreshed = threading.Event()
+
+        def fetch(base_currency):
+            if cache.refreshes:
+                refreshed.set()
+                raise RuntimeError('upstream down')
+            return RATES
+
+        with patch('time.time', MagicMock(return_value=1000)):
+            cache.get('EUR', fetch)
+        with patch('time.time', MagicMock(return_value=1100)):
+            table = cache.get('EUR', fetch)
+            self.assertEqual(table.rates, RATES)
+            self.assertEqual(table.age(), 100)
+
+        # the background refresh failed, the stale table is kept
+        self.assertTrue(refreshed.wait(1))
+        self.assertEqual(cache.stale_hits, 1)
+        with patch('time.time', MagicMock(return_value=1200)):
+            self.assertEqual(cache.get('EUR', fetch).rates, RATES)
+
+        # past the maximum staleness the upstream error is raised
+        with patch('time.time', MagicMock(return_value=1361)):
+            with self.assertRaises(RuntimeError):
+                cache.get('EUR', fetch)
+
+    def test_rate_cache_revalidates_on_one_thread(self):
+        cache = RateCache(ttl=60, max_staleness=300)
+        fetched = threading.Semaphore(0)
+        threads = []
+
+        def fetch(base_currency):
+            threads.append(threading.current_thread())
+            fetched.release()
+            return RATES
+
+        for now in (1000, 1100, 1200, 1300):
+            with patch('time.time', MagicMock(return_value=now)):
+                cache.get('EUR', fetch)
+                self.assertTrue(fetched.acquire(timeout=1))
+
+        # the miss is fetched by the caller, the stale tables by a single
+        # background thread
+        self.assertIs(threads[0], threading.current_thread())
+        self.assertEqual(len(set(threads[1:])), 1)
+        self.assertEqual(threads[1].name, 'rate-revalidator')
+
+@patch.dict(os.environ, {"ACCESS_KEY": "123key456"})
+class TestRatePrefetcher(unittest.TestCase):
+    def setUp(self):
+        self.server = StubRateServer().start()
+        os.environ['EXCHANGE_API_URL'] = self.server.url
+        for provider in rate_source.providers:
+            provider.breaker.reset()
+
+    def tearDown(self):
+        del os.environ['EXCHANGE_API_URL']
+        self.server.stop()
+
+    def test_rate_prefetcher_loads_tables(self):
+        cache = RateCache(ttl=60)
+        prefetcher = RatePrefetcher(cache, fetch_rates, ['EUR', 'USD'])
+        prefetcher.prefetch()
+
+        self.assertEqual(cache.peek('EUR').rates, DEFAULT_RATES)
+        self.assertEqual(cache.peek('USD').rates, DEFAULT_RATES)
+        self.assertEqual(self.server.request_count, 2)
+
+        # fresh tables are not reloaded, requests are served from the cache
+        prefetcher.prefetch()
+        cache.get('EUR', fetch_rates)
+        self.assertEqual(self.server.request_count, 2)
+
+    def test_rate_prefetcher_reloads_before_expiry(self):
+        cache = RateCache(ttl=0.5)
+        prefetcher = RatePrefetcher(cache, fetch_rates, ['EUR'], interval=0.05, lead=0.3)
+        prefetcher.start()
+        try:
+            time.sleep(0.6)
+        finally:
+            prefetcher.stop()
+
+        self.assertGreaterEqual(cache.refreshes, 2)
+        self.assertLess(cache.peek('EUR').age(), 0.5)
+        self.assertEqual(cache.misses, 0)
+
+    def test_rate_prefetcher_keeps_last_known_good_table(self):
+        cache = RateCache(ttl=0.2, max_staleness=60)
+        prefetcher = RatePrefetcher(cache, fetch_rates, ['EUR'], lead=0.1)
+        prefetcher.prefetch()
+
+        self.server.status_code = 500
+        time.sleep(0.2)
+        prefetcher.prefetch()
+
+        table = cache.get('EUR', fetch_rates)
+        self.assertEqual(table.rates, DEFAULT_RATES)
+        self.assertGreaterEqual(table.age(), 0.2)
+        self.assertGreaterEqual(cache.refresh_errors, 1)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,80 @@
+import unittest, os, tempfile, shutil
+from database import DatabaseHandler
+from ratecache import RateTable, RateCache
+from ratehistory import RateHistory, parse_timestamp, format_timestamp
+from conversion import convert_amount
+
+JULY_24 = parse_timestamp('2023-07-24T00:00:00Z')
+JULY_25 = parse_timestamp('2023-07-25T00:00:00Z')
+
+class TestRateHistory(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.dbh = DatabaseHandler(os.path.join(self.directory, 'test.db'))
+        self.dbh.create_tables()
+
+        self.history = RateHistory(self.dbh)
+        self.history.record(RateTable('EUR', { 'EUR': 1, 'USD': 1.1, 'BRL': 5.5 }, JULY_24))
+        self.history.record(RateTable('EUR', { 'EUR': 1, 'USD': 1.2, 'BRL': 6.0 }, JULY_25))
+
+    def tearDown(self):
+        self.dbh.close()
+        shutil.rmtree(self.directory)
+
+    def test_parse_timestamp(self):
+        self.assertEqual(parse_timestamp('1690156800'), JULY_24)
+        self.assertEqual(parse_timestamp('2023-07-24T00:00:00'), JULY_24)
+        self.assertEqual(parse_timestamp('2023-07-23T21:00:00-03:00'), JULY_24)
+        self.assertEqual(format_timestamp(JULY_24), '2023-07-24T00:00:00Z')
+        with self.assertRaises(ValueError):
+            parse_timestamp('yesterday')
+
+    def test_table_at(self):
+        self.assertEqual(self.history.table_at(JULY_24).rates['USD'], 1.1)
+        self.assertEqual(self.history.table_at(JULY_24 + 3600).rates['USD'], 1.1)
+        self.assertEqual(self.history.table_at(JULY_25 + 3600).rates['USD'], 1.2)
+        self.assertEqual(self.history.table_at(JULY_25 + 3600).fetched_at, JULY_25)
+        self.assertAlmostEqual(self.history.rate_at(JULY_24 + 1, 'USD', 'BRL'), 5.5 / 1.1)
+
+        with self.assertRaises(ValueError) as cm:
+            self.history.table_at(JULY_24 - 1)
+        self.assertEqual(str(cm.exception), 'no exchange rates recorded at or before 2023-07-23T23:59:59Z')
+
+    def test_table_at_sees_tables_recorded_elsewhere(self):
+        self.history.table_at(JULY_25)
+
+        # e.g. recorded by another worker process
+        RateHistory(self.dbh).record(RateTable('EUR', { 'EUR': 1, 'USD': 1.3 }, JULY_25 + 60))
+
+        self.assertEqual(self.history.table_at(JULY_25 + 120).rates['USD'], 1.3)
+
+    def test_reprice(self):
+        results = self.history.reprice([
+            (JULY_25 + 10, 'EUR', 'USD', 100),
+            (JULY_24 + 10, 'EUR', 'USD', 100),
+            (JULY_24 - 10, 'EUR', 'USD', 100),
+            (JULY_24 + 20, 'USD', 'BRL', 11),
+            (JULY_25 + 20, 'EUR', 'WTF', 100)
+        ])
+
+        # rounded to cents, as /convert does (the float product of the
+        # second one is 110.00000000000001)
+        self.assertEqual(results[0], (1.2, 120))
+        self.assertEqual(results[1], (1.1, 110))
+        self.assertIsNone(results[2])
+        self.assertEqual(results[3][1], 55)
+        self.assertIsNone(results[4])
+
+        # the same rate and amount as a conversion at that time
+        exchange_rate = self.history.rate_at(JULY_24 + 20, 'USD', 'BRL')
+        self.assertEqual(results[3], (exchange_rate, convert_amount(11, exchange_rate, 'USD', 'BRL')))
+
+    def test_rate_cache_records_fetched_tables(self):
+        cache = RateCache(ttl=60, on_store=self.history.record)
+        cache.get('EUR', lambda base_currency: { 'USD': 1.4 })
+
+        self.assertEqual(len(self.dbh.get_rate_history_index()), 3)
+        self.assertEqual(self.history.rate_at(parse_timestamp('2100-01-01T00:00:00Z'), 'EUR', 'USD'), 1.4)
+
+if __name__ == '__main__':
+    unittest.main()
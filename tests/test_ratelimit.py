@@ -0,0 +1,107 @@
+import unittest, os, tempfile, threading
+from database import DatabaseHandler
+from ratelimit import RequestShed, UserRateLimiter, AdmissionController
+
+class TestUserRateLimiter(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.dbh = DatabaseHandler(os.path.join(self.directory.name, 'ratelimit.db'))
+        self.dbh.create_tables()
+
+    def tearDown(self):
+        self.dbh.close()
+        self.directory.cleanup()
+
+    def test_take_tokens_refills_over_time(self):
+        # 2 tokens per second, up to 4
+        self.assertEqual([self.dbh.take_tokens('user:1', 1, 2, 4, 1000) for _ in range(4)], [0, 0, 0, 0])
+        self.assertAlmostEqual(self.dbh.take_tokens('user:1', 1, 2, 4, 1000), 0.5)
+
+        # a denied request takes nothing
+        self.assertAlmostEqual(self.dbh.take_tokens('user:1', 1, 2, 4, 1000.25), 0.25)
+        self.assertEqual(self.dbh.take_tokens('user:1', 1, 2, 4, 1000.5), 0)
+
+        # never more than the burst, and the other buckets are apart
+        self.assertEqual([self.dbh.take_tokens('user:1', 1, 2, 4, 2000) for _ in range(4)], [0, 0, 0, 0])
+        self.assertGreater(self.dbh.take_tokens('user:1', 1, 2, 4, 2000), 0)
+        self.assertEqual(self.dbh.take_tokens('user:2', 1, 2, 4, 2000), 0)
+
+    def test_rate_limiter_is_shared_by_connections(self):
+        # e.g. two worker processes of the same database
+        other = DatabaseHandler(self.dbh.database_file)
+        limiters = [UserRateLimiter(self.dbh, 0.001, 10), UserRateLimiter(other, 0.001, 10)]
+
+        allowed = []
+        def run(limiter):
+            for _ in range(10):
+                try:
+                    limiter.check(1)
+                    allowed.append(1)
+                except RequestShed:
+                    pass
+
+        threads = [threading.Thread(target=run, args=(limiters[i % 2],)) for i in range(4)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        other.close()
+
+        self.assertEqual(len(allowed), 10)
+
+    def test_rate_limiter_check(self):
+        limiter = UserRateLimiter(self.dbh, 0.5, 1)
+        limiter.check(1)
+
+        with self.assertRaises(RequestShed) as cm:
+            limiter.check(1)
+        self.assertEqual(str(cm.exception), 'user id "1" is over its rate limit of 0.5 conversions per second')
+        self.assertEqual(cm.exception.reason, 'rate_limited')
+        self.assertTrue(0 < cm.exception.retry_after <= 2)
+
+    def test_rate_limiter_check_with_cost(self):
+        limiter = UserRateLimiter(self.dbh, 0.001, 5)
+        limiter.check(1, cost=3)
+
+        # 2 tokens are left
+        with self.assertRaises(RequestShed):
+            limiter.check(1, cost=3)
+        limiter.check(1, cost=2)
+
+        with self.assertRaises(ValueError) as cm:
+            limiter.check(2, cost=6)
+        self.assertEqual(str(cm.exception), 'Invalid batch. user id "2" has 6 conversions, more than its rate limit burst of 5')
+
+class TestAdmissionController(unittest.TestCase):
+    def test_admission_controller_sheds_over_max_inflight(self):
+        controller = AdmissionController(max_inflight=2, retry_after=3)
+
+        with controller.admit(), controller.admit():
+            self.assertEqual(controller.stats(), { 'inflight': 2, 'upstream_waiters': 0 })
+            with self.assertRaises(RequestShed) as cm:
+                with controller.admit():
+                    pass
+            self.assertEqual(cm.exception.reason, 'too_many_inflight')
+            self.assertEqual(cm.exception.retry_after, 3)
+
+        # the finished requests leave room
+        with controller.admit():
+            pass
+        self.assertEqual(controller.stats(), { 'inflight': 0, 'upstream_waiters': 0 })
+
+    def test_admission_controller_sheds_over_upstream_waiters(self):
+        controller = AdmissionController(max_upstream_waiters=1)
+
+        with controller.admit(), controller.upstream_wait():
+            with self.assertRaises(RequestShed) as cm:
+                with controller.admit():
+                    pass
+            self.assertEqual(cm.exception.reason, 'upstream_backlog')
+
+        with self.assertRaises(ValueError):
+            with controller.admit(), controller.upstream_wait():
+                raise ValueError('failed')
+        self.assertEqual(controller.stats(), { 'inflight': 0, 'upstream_waiters': 0 })
+
+if __name__ == '__main__':
+    unittest.main()
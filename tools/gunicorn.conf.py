@@ -0,0 +1,24 @@
+import os
+
+# pre-forking deployment of the WSGI app (gunicorn is not in
+# requirements.txt, install it to use this), from the project directory:
+#
+#   gunicorn -c tools/gunicorn.conf.py "exchangeapi:create_app()"
+#
+# the master imports the app once and loads the rates tables, then every
+# worker is forked from it with a warm rate cache and opens its own
+# database connections, HTTP sessions and threads
+
+bind = os.environ.get('BIND', '127.0.0.1:5000')
+workers = int(os.environ.get('WEB_CONCURRENCY', 4))
+threads = int(os.environ.get('GUNICORN_THREADS', 8))
+preload_app = True
+
+def when_ready(server):
+    # the master loaded the app and has not forked any worker yet
+    import exchangeapi
+    exchangeapi.warmup()
+
+def post_fork(server, worker):
+    import exchangeapi
+    exchangeapi.start()
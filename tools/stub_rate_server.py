@@ -0,0 +1,102 @@
+import json, sys, threading, time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+
+# a local replacement for api.exchangeratesapi.io and open.er-api.com, used
+# by the tests and the benchmarks (point EXCHANGE_API_URL or ERAPI_URL to it)
+
+DEFAULT_RATES = {
+    'EUR': 1, 'USD': 1.104252, 'BRL': 5.244123, 'GBP': 0.856933,
+    'JPY': 155.787685, 'CHF': 0.954935, 'CAD': 1.454466, 'CNY': 7.880275
+}
+
+class StubRateServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, host='127.0.0.1', port=0, rates=None):
+        super().__init__((host, port), _StubRateHandler)
+        self.rates = dict(DEFAULT_RATES if rates is None else rates)
+        # change these to inject failures and latency
+        self.status_code = 200
+        self.delay = 0
+        self.request_count = 0
+        self._thread = None
+
+    @property
+    def url(self):
+        host, port = self.server_address[:2]
+        return f'http://{host}:{port}'
+
+    def start(self):
+        self._thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def handle_error(self, request, client_address):
+        # clients giving up on a slow response are expected here
+        pass
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+        if self._thread is not None:
+            self._thread.join()
+
+class _StubRateHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        server = self.server
+        server.request_count += 1
+
+        if server.delay:
+            time.sleep(server.delay)
+
+        url = urlparse(self.path)
+        query = parse_qs(url.query)
+
+        if url.path.startswith('/v6/latest/'):
+            self._send_erapi(url.path[len('/v6/latest/'):])
+        elif url.path != '/latest':
+            self._send(404, {'success': False, 'error': {'code': 404, 'type': 'not_found'}})
+        elif server.status_code != 200:
+            self._send(server.status_code, {'success': False})
+        elif not query.get('access_key'):
+            self._send(200, {'success': False,
+                             'error': {'code': 101, 'type': 'missing_access_key'}})
+        else:
+            base = query.get('base', ['EUR'])[0]
+            self._send(200, {
+                'success': True,
+                'timestamp': int(time.time()),
+                'base': base,
+                'date': time.strftime('%Y-%m-%d'),
+                'rates': server.rates
+            })
+
+    def _send_erapi(self, base):
+        server = self.server
+        if server.status_code != 200:
+            self._send(server.status_code, {'result': 'error', 'error-type': 'unavailable'})
+        else:
+            self._send(200, {
+                'result': 'success',
+                'time_last_update_unix': int(time.time()),
+                'base_code': base,
+                'rates': server.rates
+            })
+
+    def _send(self, status_code, body):
+        payload = json.dumps(body).encode('UTF-8')
+        self.send_response(status_code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def log_message(self, format, *args):
+        pass
+
+if __name__ == '__main__':
+    port = int(sys.argv[1]) if len(sys.argv) > 1 else 8001
+    server = StubRateServer(port=port)
+    print(f'serving stub rates on {server.url}')
+    server.serve_forever()